@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any, Optional
+
+
+def _next_midnight(now: datetime) -> datetime:
+    return datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+
+
+class AccountPool:
+    """
+    Usage of the email addresses that send the data requests, persisted in a JSON file of the workspace so that it
+    survives restarts: the requests and lines of the current day and in total, the last error and the end of the
+    cooldown of each address.
+
+    An address cools down when Dext3r refuses it (403), until the next day, when it answers 429 with a Retry-After
+    header, for that long, and when it has used its daily budget. `choose` picks the available address with the most
+    remaining budget, so the requests are spread over every address.
+
+    Args:
+        path (str | Path): The JSON file of the usage.
+        emails (list[str]): The addresses to use. The usage of other addresses in the file is kept.
+        daily_requests (int, optional): The data requests that an address can send per day. Defaults to None (no
+            budget).
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        emails: list[str],
+        daily_requests: Optional[int] = None,
+    ):
+        self.path = Path(path)
+        self.emails = list(dict.fromkeys(emails))
+        self.daily_requests = daily_requests
+        self.lock = threading.Lock()
+        self.usage: dict[str, dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path, "rt") as f:
+                self.usage = json.load(f)
+        for email in self.emails:
+            self.usage.setdefault(
+                email,
+                {
+                    "day": None,
+                    "requests": 0,
+                    "lines": 0,
+                    "total_requests": 0,
+                    "total_lines": 0,
+                    "last_used": None,
+                    "last_error": None,
+                    "last_error_time": None,
+                    "cooldown_until": None,
+                },
+            )
+
+    def _today(self, email: str) -> dict[str, Any]:
+        # The daily counts restart on a new day
+        usage = self.usage[email]
+        today = date.today().isoformat()
+        if usage["day"] != today:
+            usage.update(day=today, requests=0, lines=0)
+        return usage
+
+    def save(self):
+        """
+        Writes the usage atomically.
+        """
+        with self.lock:
+            tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp_path, "wt") as f:
+                json.dump(self.usage, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def remaining(self, email: str) -> Optional[int]:
+        """
+        Returns the requests that an address can still send today, or None without a budget.
+        """
+        if self.daily_requests is None:
+            return None
+        return max(self.daily_requests - self._today(email)["requests"], 0)
+
+    def cooldown(self, email: str) -> float:
+        """
+        Returns the seconds until an address can be used again, 0 if it is available.
+        """
+        until = self.usage[email]["cooldown_until"]
+        if until is None:
+            return 0.0
+        return max((datetime.fromisoformat(until) - datetime.now()).total_seconds(), 0)
+
+    def choose(self, exclude: tuple[str, ...] = ()) -> Optional[str]:
+        """
+        Returns the available address with the most remaining budget, the least used today and then the least recently
+        used, or None if every address is cooling down.
+
+        Args:
+            exclude (tuple[str, ...], optional): Addresses that must not be chosen, e.g. those in use. Defaults to ().
+        """
+        available = [
+            email
+            for email in self.emails
+            if email not in exclude and self.cooldown(email) == 0
+        ]
+        if not available:
+            return None
+
+        def priority(email):
+            remaining = self.remaining(email)
+            usage = self._today(email)
+            return (
+                -remaining if remaining is not None else 0,
+                usage["requests"],
+                usage["last_used"] or "",
+            )
+
+        return min(available, key=priority)
+
+    def wait_time(self) -> float:
+        """
+        Returns the seconds until the first address is available again, 0 if one is available.
+        """
+        return min(self.cooldown(email) for email in self.emails)
+
+    def _cool_down(self, email: str, until: datetime) -> datetime:
+        usage = self.usage[email]
+        current = usage["cooldown_until"]
+        if current is None or datetime.fromisoformat(current) < until:
+            usage["cooldown_until"] = until.isoformat(timespec="seconds")
+        return datetime.fromisoformat(usage["cooldown_until"])
+
+    def record_success(self, email: str, lines: int) -> Optional[datetime]:
+        """
+        Counts a registered task of an address.
+
+        Returns:
+            datetime | None: The end of the cooldown of the address, if it used its daily budget.
+        """
+        now = datetime.now()
+        usage = self._today(email)
+        usage["requests"] += 1
+        usage["lines"] += lines
+        usage["total_requests"] += 1
+        usage["total_lines"] += lines
+        usage["last_used"] = now.isoformat(timespec="seconds")
+        usage["cooldown_until"] = None
+        cooldown_until = None
+        if self.remaining(email) == 0:
+            cooldown_until = self._cool_down(email, _next_midnight(now))
+        self.save()
+        return cooldown_until
+
+    def record_error(
+        self,
+        email: str,
+        status: int | str,
+        detail: Optional[str] = None,
+        retry_after: Optional[float] = None,
+    ) -> Optional[datetime]:
+        """
+        Records a failed request of an address.
+
+        Args:
+            email (str): The address.
+            status (int | str): The status code of the response, or the exception.
+            detail (str, optional): The detail of the response. Defaults to None.
+            retry_after (float, optional): The seconds of the Retry-After header of the response. Defaults to None.
+
+        Returns:
+            datetime | None: The end of the cooldown of the address, if the error started one.
+        """
+        now = datetime.now()
+        usage = self._today(email)
+        usage["last_error"] = f"{status}: {detail}" if detail else str(status)
+        usage["last_error_time"] = now.isoformat(timespec="seconds")
+        usage["last_used"] = usage["last_error_time"]
+        cooldown_until = None
+        if status == 403:
+            cooldown_until = self._cool_down(email, _next_midnight(now))
+        elif retry_after is not None:
+            cooldown_until = self._cool_down(
+                email, now + timedelta(seconds=retry_after)
+            )
+        self.save()
+        return cooldown_until
+
+
+def retry_after(response) -> Optional[float]:
+    """
+    Returns the seconds of the Retry-After header of a response, if given in seconds.
+    """
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
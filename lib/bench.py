@@ -0,0 +1,341 @@
+"""
+Offline benchmarks of the request planning, the task ledger and the result parser, on synthetic data.
+
+Run them with `python -m lib.bench`, e.g. `python -m lib.bench --stations 2000 --repeat 5 --only planning`. Each
+benchmark runs in a new process, so that its peak memory is not affected by the others.
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import statistics
+import tempfile
+import tracemalloc
+from datetime import date, timedelta
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from .download_manager import Dext3rDownloader
+from .metas import list_available_stations
+from .mock_server import dext3r_csv
+from .read import read_dext3r_tables
+from .requests import slice_payload
+from .stack import plan_slices
+from .stations import StationResolver
+from .write import register_task
+
+# Temperature series of the benchmark workspaces: (aggregation code, aggregation period)
+SERIES_KINDS = [(2, 86400), (3, 86400), (2, 3600), (3, 3600)]
+
+
+def synthetic_stations(
+    n: int, seed: int = 0, duplicate_rate: float = 0.02
+) -> list[dict[str, Any]]:
+    """
+    Generates the content of station_infos.json.
+
+    Args:
+        n (int): The number of stations.
+        seed (int, optional): The seed of the generator. Defaults to 0.
+        duplicate_rate (float, optional): The probability that a station has the name of a station of another network.
+            Defaults to 0.02.
+
+    Returns:
+        list[dict[str, Any]]: The stations.
+    """
+    rng = random.Random(seed)
+    networks = ["agrmet", "locali", "simnbo", "simnpr", "urbane"]
+    stations = []
+    for i in range(n):
+        name = f"Stazione {i}"
+        if stations and rng.random() < duplicate_rate:
+            name = rng.choice(stations)["name"]
+        stations.append(
+            {
+                "id": str(10000 + i),
+                "name": name,
+                "network": networks[i % len(networks)],
+                "lon": rng.randrange(900000, 1280000),
+                "lat": rng.randrange(4380000, 4510000),
+                "height": float(rng.randrange(0, 2000)),
+            }
+        )
+    return stations
+
+
+def synthetic_series(
+    stations: list[dict[str, Any]],
+    seed: int = 0,
+    first_day: date = date(1960, 1, 1),
+    last_day: date = date(2024, 12, 31),
+) -> list[dict[str, Any]]:
+    """
+    Generates the content of series_infos.json: the daily and hourly minimum and maximum temperatures of every station,
+    with random begin and end dates.
+    """
+    rng = random.Random(seed)
+    span = (last_day - first_day).days
+    series = []
+    for station in stations:
+        begin = first_day + timedelta(days=rng.randrange(span // 2))
+        end = last_day - timedelta(days=rng.randrange(span // 4))
+        for agg_code, agg_period in SERIES_KINDS:
+            if agg_period < 86400 and rng.random() < 0.5:
+                continue
+            series.append(
+                {
+                    "station": station["id"],
+                    "variable": f"{agg_code},0,{agg_period}/103,2000,-,-/B12101",
+                    "begin": f"{begin:%Y-%m-%d}T00:00:00",
+                    "end": f"{end:%Y-%m-%d}T00:00:00",
+                }
+            )
+    return series
+
+
+def write_workspace(base: Path, n_stations: int, seed: int = 0) -> Path:
+    """
+    Writes the synthetic station_infos.json and series_infos.json of a workspace.
+    """
+    base = Path(base)
+    base.mkdir(parents=True, exist_ok=True)
+    stations = synthetic_stations(n_stations, seed)
+    (base / "station_infos.json").write_text(json.dumps(stations))
+    (base / "series_infos.json").write_text(
+        json.dumps(synthetic_series(stations, seed))
+    )
+    return base
+
+
+def synthetic_results(
+    slices: list[list[dict[str, Any]]],
+    stations: list[dict[str, Any]],
+    seed: int = 0,
+    ragged_rate: float = 0.01,
+    empty_rate: float = 0.05,
+) -> list[tuple[str, dict[str, Any], bytes]]:
+    """
+    Generates the Dext3r CSV results of planned slices, with ragged lines and empty tables. Stations sharing their name
+    produce results with duplicated names, as in real results.
+
+    Returns:
+        list[tuple[str, dict[str, Any], bytes]]: The task id, the payload and the content of each result.
+    """
+    rng = random.Random(seed)
+    results = []
+    for i, queue_slice in enumerate(slices):
+        task = f"{i:08x}-0000-4000-8000-{seed:012x}"
+        payload = slice_payload(queue_slice, "bench@example.com")
+        query = payload | {
+            "begin_datetime": [payload["begin_datetime"]],
+            "end_datetime": [payload["end_datetime"]],
+            "variable": (
+                [payload["variable"]]
+                if isinstance(payload["variable"], str)
+                else payload["variable"]
+            ),
+        }
+        content = dext3r_csv(query, stations, rng, ragged_rate, empty_rate)
+        results.append((task, payload, content.encode()))
+    return results
+
+
+def measure(function: Callable[[], Any], repeat: int) -> dict[str, Any]:
+    """
+    Runs a function `repeat` times, measuring its duration and the peak of the Python allocations of the first run.
+
+    Returns:
+        dict[str, Any]: The minimum and median durations in seconds, the Python peak memory and the maximum resident
+            set size of the process, in bytes.
+    """
+    tracemalloc.start()
+    start = perf_counter()
+    function()
+    times = [perf_counter() - start]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for _ in range(repeat - 1):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "python_peak_bytes": peak,
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def _queue(base: Path, aggregation_span: int, max_lines: int):
+    # The sections must be short enough for a single station to fit in a request
+    max_days = min(5 * 365, max_lines * aggregation_span // 86400 - 1)
+    downloader = Dext3rDownloader(base, date(1960, 1, 1), max_days=max_days)
+    return downloader.make_request_queue(
+        "B12101", [2, 3], aggregation_span, date(2024, 12, 31), resume=False
+    )
+
+
+def bench_queue(
+    base: Path, repeat: int, aggregation_span: int, max_lines: int, **_
+) -> dict[str, Any]:
+    """
+    Times `make_request_queue` on the whole workspace.
+    """
+    result = measure(lambda: _queue(base, aggregation_span, max_lines), repeat)
+    return result | {"elements": len(_queue(base, aggregation_span, max_lines))}
+
+
+def bench_planning(
+    base: Path, repeat: int, aggregation_span: int, strategy: str, max_lines: int, **_
+) -> dict[str, Any]:
+    """
+    Times `plan_slices` on the whole queue.
+    """
+    queue = _queue(base, aggregation_span, max_lines)
+    result = measure(lambda: plan_slices(queue, max_lines, strategy), repeat)
+    return result | {"requests": len(plan_slices(queue, max_lines, strategy))}
+
+
+def bench_registration(
+    base: Path, repeat: int, aggregation_span: int, max_lines: int, **_
+) -> dict[str, Any]:
+    """
+    Times the registration of every planned task in a new ledger, with `register_task`.
+    """
+    slices = plan_slices(_queue(base, aggregation_span, max_lines), max_lines)
+    payloads = [slice_payload(s, "bench@example.com") for s in slices]
+
+    def register():
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [
+                Path(directory) / "requests.jsonl",
+                Path(directory) / "payloads.jsonl",
+            ]
+            for i, (queue_slice, payload) in enumerate(zip(slices, payloads)):
+                register_task(f"task-{i}", queue_slice, payload, paths)
+
+    return measure(register, repeat) | {"tasks": len(slices)}
+
+
+def bench_parsing(
+    base: Path,
+    repeat: int,
+    aggregation_span: int,
+    max_lines: int,
+    results: int,
+    seed: int,
+    **_,
+) -> dict[str, Any]:
+    """
+    Times `read_dext3r_tables` on the synthetic results of the first planned slices.
+    """
+    stations = json.loads((base / "station_infos.json").read_text())
+    slices = plan_slices(_queue(base, aggregation_span, max_lines), max_lines)[:results]
+    files = synthetic_results(slices, stations, seed)
+    payloads = {task: payload for task, payload, _ in files}
+    resolver = StationResolver(list_available_stations(base))
+
+    def parse():
+        for task, _, content in files:
+            read_dext3r_tables(content, payloads, resolver, task)
+
+    return measure(parse, repeat) | {
+        "results": len(files),
+        "bytes": sum(len(content) for _, _, content in files),
+    }
+
+
+BENCHMARKS = {
+    "queue": bench_queue,
+    "planning": bench_planning,
+    "registration": bench_registration,
+    "parsing": bench_parsing,
+}
+
+
+def _run(name: str, options: dict[str, Any]) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        base = write_workspace(Path(directory), options["stations"], options["seed"])
+        return BENCHMARKS[name](base, **options)
+
+
+def run_benchmarks(
+    names: Optional[list[str]] = None, isolate: bool = True, **options
+) -> dict[str, dict[str, Any]]:
+    """
+    Runs the benchmarks on a synthetic workspace.
+
+    Args:
+        names (list[str], optional): The benchmarks to run, among "queue", "planning", "registration" and "parsing".
+            Defaults to all.
+        isolate (bool, optional): Whether to run each benchmark in a new process. Defaults to True.
+        **options: stations, seed, repeat, aggregation_span, strategy, max_lines and results. See `main`.
+
+    Returns:
+        dict[str, dict[str, Any]]: The measurements of each benchmark.
+    """
+    options = {
+        "stations": 1000,
+        "seed": 0,
+        "repeat": 3,
+        "aggregation_span": 86400,
+        "strategy": "greedy",
+        "max_lines": 18000,
+        "results": 20,
+    } | options
+    reports = {}
+    for name in names or list(BENCHMARKS):
+        if isolate:
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                reports[name] = pool.apply(_run, (name, options))
+        else:
+            reports[name] = _run(name, options)
+    return reports
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lib.bench", description="Runs the offline benchmarks."
+    )
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS))
+    parser.add_argument("--stations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--aggregation-span", type=int, default=86400)
+    parser.add_argument(
+        "--strategy", default="greedy", choices=["greedy", "merge", "bfd", "best"]
+    )
+    parser.add_argument("--max-lines", type=int, default=18000)
+    parser.add_argument("--results", type=int, default=20)
+    parser.add_argument("--json", type=Path, help="Also writes the results here")
+    args = parser.parse_args(argv)
+    reports = run_benchmarks(
+        args.only,
+        stations=args.stations,
+        seed=args.seed,
+        repeat=args.repeat,
+        aggregation_span=args.aggregation_span,
+        strategy=args.strategy,
+        max_lines=args.max_lines,
+        results=args.results,
+    )
+    for name, report in reports.items():
+        details = ", ".join(
+            f"{k}={v}"
+            for k, v in report.items()
+            if k not in ("min_s", "median_s", "python_peak_bytes", "max_rss_bytes")
+        )
+        print(
+            f"{name:<13} min {report['min_s']:8.3f}s  median {report['median_s']:8.3f}s  "
+            f"python peak {report['python_peak_bytes'] / 2**20:7.1f} MiB  "
+            f"max RSS {report['max_rss_bytes'] / 2**20:7.1f} MiB  {details}"
+        )
+    if args.json is not None:
+        args.json.write_text(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
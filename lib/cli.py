@@ -0,0 +1,369 @@
+"""
+Command line interface of the downloader, for headless runs on a server: `python -m lib <command> ...`.
+
+The commands work on a workspace directory, as `Dext3rDownloader` does:
+
+- plan: plans the requests of a download and reports their number, without sending them;
+- download: plans and sends the requests;
+- update: requests the data published after the last covered day of each series;
+- repair: requests again, in smaller requests, the missing periods of the failed, truncated and partial tasks;
+- retrieve: downloads the archives of the completed tasks;
+- ingest: merges the downloaded archives into the measurement store;
+- status: summarizes the workspace;
+- compact: rewrites the ledger of the sent tasks without its duplicated records;
+- catalog: lists the ingested series, with their first and last measurement and their rows;
+- query: exports the ingested measurements to a parquet or CSV file.
+
+The modules of the package, and polars with them, are imported only when a command runs, so that `--help` is
+immediate. SIGTERM and SIGINT stop a download after the request in progress, which is registered in the ledger; a
+second signal interrupts it immediately.
+"""
+
+import argparse
+import signal
+import sys
+from datetime import date
+from pathlib import Path
+from typing import Optional
+
+from .progress import BACKENDS
+
+
+def _downloader(args, from_date: Optional[date] = None):
+    from .download_manager import Dext3rDownloader
+    from .transport import Transport
+
+    transport = Transport(args.base_url) if args.base_url is not None else None
+    return Dext3rDownloader(
+        args.workspace,
+        from_date,
+        max_days=args.max_days,
+        transport=transport,
+        progress=args.progress,
+        daily_requests=getattr(args, "daily_requests", None),
+    )
+
+
+def _stop_on_signals(downloader):
+    # The first signal asks the downloader to stop, the second one interrupts it
+    def handler(signum, frame):
+        if downloader.stopping.is_set():
+            raise KeyboardInterrupt
+        print(
+            f"Received {signal.Signals(signum).name}: stopping after the current request",
+            flush=True,
+        )
+        downloader.stop()
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def _vertex(text: str) -> tuple[float, float]:
+    lon, lat = text.split(",")
+    return float(lon), float(lat)
+
+
+def _area(args):
+    if not any(
+        getattr(args, name) is not None
+        for name in ("bbox", "radius", "polygon", "basin", "province")
+    ):
+        return None
+    from .spatial import StationFilter
+
+    return StationFilter(
+        bbox=args.bbox,
+        radius=args.radius,
+        polygon=args.polygon,
+        basin=args.basin,
+        province=args.province,
+    )
+
+
+def _plan_options(args) -> dict:
+    return {
+        "variable": args.variable,
+        "aggregation_code": args.aggregation_code,
+        "aggregation_span": args.aggregation_span,
+        "max_lines": args.max_lines,
+        "strategy": args.strategy,
+        "safety_margin": args.safety_margin,
+        "area": _area(args),
+    }
+
+
+def plan(args):
+    downloader = _downloader(args, args.from_date)
+    downloader.plan(
+        to_date=args.to_date, resume=not args.no_resume, **_plan_options(args)
+    )
+
+
+def download(args):
+    downloader = _downloader(args, args.from_date)
+    _stop_on_signals(downloader)
+    options = _plan_options(args) | {
+        "email": args.email,
+        "to_date": args.to_date,
+        "pause": args.pause,
+        "resume": not args.no_resume,
+        "max_tries": args.max_tries,
+    }
+    if args.concurrent:
+        import asyncio
+
+        asyncio.run(downloader.download_async(**options))
+    else:
+        downloader.download(**options)
+
+
+def update(args):
+    downloader = _downloader(args)
+    _stop_on_signals(downloader)
+    downloader.update(
+        args.email,
+        args.variable,
+        args.aggregation_code,
+        args.aggregation_span,
+        to_date=args.to_date,
+        pause=args.pause,
+        max_lines=args.max_lines,
+        max_tries=args.max_tries,
+        strategy=args.strategy,
+        safety_margin=args.safety_margin,
+        area=_area(args),
+    )
+
+
+def repair(args):
+    downloader = _downloader(args)
+    _stop_on_signals(downloader)
+    downloader.repair(
+        args.email,
+        max_lines=args.max_lines,
+        shrink=args.shrink,
+        pause=args.pause,
+        max_tries=args.max_tries,
+        strategy=args.strategy,
+    )
+
+
+def retrieve(args):
+    outcomes = _downloader(args).retrieve(
+        args.workers,
+        args.poll_interval,
+        args.max_interval,
+        args.timeout,
+        args.max_errors,
+    )
+    counts: dict[str, int] = {}
+    for outcome in outcomes.values():
+        outcome = outcome.split(":")[0]
+        counts[outcome] = counts.get(outcome, 0) + 1
+    print(", ".join(f"{outcome}: {n}" for outcome, n in counts.items()) or "No tasks")
+
+
+def ingest(args):
+    report = _downloader(args).ingest(args.workers, args.force)
+    print(
+        f"Ingested {report['tasks']} tasks ({report['rows']} rows), skipped {len(report['skipped'])}, "
+        f"{len(report['failures'])} failures, {len(report['partial'])} truncated or partial"
+    )
+
+
+def status(args):
+    for key, value in _downloader(args).status().items():
+        print(f"{key:<9} {value}")
+
+
+def compact(args):
+    dropped = _downloader(args).compact()
+    print(
+        f"Dropped {dropped['requests']} request records and {dropped['payloads']} payloads"
+    )
+
+
+def catalog(args):
+    import polars as pl
+
+    series = _downloader(args).catalog()
+    if args.ids is not None:
+        series = series.filter(pl.col("id").is_in(args.ids))
+    if args.variable is not None:
+        series = series.filter(pl.col("variable").is_in(args.variable))
+    if args.output is not None:
+        series.write_parquet(args.output)
+        return
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=40):
+        print(series.drop("files", "tasks"))
+
+
+def query(args):
+    data = _downloader(args).query(
+        args.ids, args.from_date, args.to_date, args.variable, args.agg_period
+    )
+    if args.output.suffix == ".csv":
+        data.sink_csv(args.output)
+    else:
+        data.sink_parquet(args.output)
+
+
+def parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "-w",
+        "--workspace",
+        type=Path,
+        default=Path("."),
+        help="The workspace directory. Defaults to the current directory.",
+    )
+    common.add_argument(
+        "--base-url", help="The root of the Dext3r service, e.g. of a mock server."
+    )
+    common.add_argument("--max-days", type=int, default=15 * 365)
+    common.add_argument(
+        "--progress",
+        choices=BACKENDS,
+        default="auto",
+        help="How to report the progress. Defaults to a bar in a terminal and to periodic lines otherwise.",
+    )
+
+    series = argparse.ArgumentParser(add_help=False)
+    series.add_argument("--variable", nargs="+", required=True, help="e.g. B12101")
+    series.add_argument(
+        "--aggregation-code", nargs="+", type=int, required=True, help="e.g. 2 3"
+    )
+    series.add_argument(
+        "--aggregation-span", type=int, default=86400, help="In seconds."
+    )
+    series.add_argument("--max-lines", type=int, default=18000)
+    series.add_argument(
+        "--strategy", default="greedy", choices=["greedy", "merge", "bfd", "best"]
+    )
+    series.add_argument("--safety-margin", type=float)
+    area = series.add_argument_group(
+        "area", "Restricts the stations; the conditions must all hold."
+    )
+    area.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+    )
+    area.add_argument("--radius", nargs=3, type=float, metavar=("LON", "LAT", "KM"))
+    area.add_argument(
+        "--polygon", nargs="+", type=_vertex, metavar="LON,LAT", help="The vertices."
+    )
+    area.add_argument(
+        "--basin", nargs="+", help="From the metadata of the ingested tasks."
+    )
+    area.add_argument(
+        "--province", nargs="+", help="From the metadata of the ingested tasks."
+    )
+
+    sending = argparse.ArgumentParser(add_help=False)
+    sending.add_argument("--email", nargs="+", required=True)
+    sending.add_argument("--pause", type=int, default=120)
+    sending.add_argument("--max-tries", type=int, default=5)
+    sending.add_argument(
+        "--daily-requests",
+        type=int,
+        help="The requests that an email address can send per day. Defaults to no budget.",
+    )
+
+    main_parser = argparse.ArgumentParser(
+        prog="python -m lib", description="Downloads data from the Dext3r service."
+    )
+    commands = main_parser.add_subparsers(dest="command", required=True)
+
+    for name, function, parents in (
+        ("plan", plan, [common, series]),
+        ("download", download, [common, series, sending]),
+    ):
+        command = commands.add_parser(name, parents=parents)
+        command.add_argument(
+            "--from", dest="from_date", type=date.fromisoformat, required=True
+        )
+        command.add_argument(
+            "--to", dest="to_date", type=date.fromisoformat, required=True
+        )
+        command.add_argument(
+            "--no-resume", action="store_true", help="Requests everything again."
+        )
+        command.set_defaults(function=function)
+    commands.choices["download"].add_argument(
+        "--concurrent",
+        action="store_true",
+        help="Sends the requests of every email address concurrently.",
+    )
+
+    command = commands.add_parser("update", parents=[common, series, sending])
+    command.add_argument(
+        "--to", dest="to_date", type=date.fromisoformat, help="Defaults to today."
+    )
+    command.set_defaults(function=update)
+
+    command = commands.add_parser("repair", parents=[common, sending])
+    command.add_argument("--max-lines", type=int, default=18000)
+    command.add_argument(
+        "--shrink",
+        type=float,
+        default=0.5,
+        help="The factor applied to --max-lines for the new requests.",
+    )
+    command.add_argument(
+        "--strategy", default="greedy", choices=["greedy", "merge", "bfd", "best"]
+    )
+    command.set_defaults(function=repair)
+
+    command = commands.add_parser("retrieve", parents=[common])
+    command.add_argument("--workers", type=int, default=4)
+    command.add_argument("--poll-interval", type=float, default=60)
+    command.add_argument("--max-interval", type=float, default=900)
+    command.add_argument("--timeout", type=float)
+    command.add_argument(
+        "--max-errors",
+        type=int,
+        default=5,
+        help="The transient errors in a row after which a task is left for a later call.",
+    )
+    command.set_defaults(function=retrieve)
+
+    command = commands.add_parser("ingest", parents=[common])
+    command.add_argument("--workers", type=int)
+    command.add_argument("--force", action="store_true")
+    command.set_defaults(function=ingest)
+
+    command = commands.add_parser("status", parents=[common])
+    command.set_defaults(function=status)
+
+    command = commands.add_parser("compact", parents=[common])
+    command.set_defaults(function=compact)
+
+    command = commands.add_parser("catalog", parents=[common])
+    command.add_argument("--ids", nargs="+")
+    command.add_argument("--variable", nargs="+")
+    command.add_argument(
+        "--output", type=Path, help="A .parquet file, with the files and the tasks."
+    )
+    command.set_defaults(function=catalog)
+
+    command = commands.add_parser("query", parents=[common])
+    command.add_argument("output", type=Path, help="A .parquet or .csv file.")
+    command.add_argument("--ids", nargs="+")
+    command.add_argument("--from", dest="from_date", type=date.fromisoformat)
+    command.add_argument("--to", dest="to_date", type=date.fromisoformat)
+    command.add_argument("--variable", nargs="+")
+    command.add_argument("--agg-period", type=int)
+    command.set_defaults(function=query)
+    return main_parser
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parser().parse_args(argv)
+    try:
+        args.function(args)
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        sys.exit(130)
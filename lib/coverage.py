@@ -0,0 +1,252 @@
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Optional
+
+import polars as pl
+
+from .ledger import TaskLedger
+from .store import query
+from .variables import with_variable_names
+
+SERIES = ["id", "v", "agg_period"]
+INTERVAL_SCHEMA = {
+    "id": pl.Utf8(),
+    "v": pl.Utf8(),
+    "agg_period": pl.Int32(),
+    "from": pl.Date(),
+    "to": pl.Date(),
+}
+# Bounds of the gaps before the first and after the last covered interval
+_FIRST_DAY = date(1800, 1, 1)
+_LAST_DAY = date(2999, 12, 31)
+
+
+def covered_days(data_path: str | Path, ledger: TaskLedger) -> pl.LazyFrame:
+    """
+    Lists the days with ingested data of each series. The series of the rows is the one their task requested for their
+    station and variable, and their day is the one of the request: requests start one hour before midnight UTC (see
+    `slice_payload`).
+
+    Returns:
+        pl.LazyFrame: The distinct (id, v, agg_period, day) rows.
+    """
+    requested = with_variable_names(
+        ledger.scan_requests()
+        .select(pl.col("task_id").alias("task"), "id", "v", "agg_period")
+        .unique(["task", "id", "v"])
+    )
+    return (
+        query(data_path)
+        .select(
+            "task",
+            "id",
+            "variable",
+            "agg_period",
+            (pl.col("start") + timedelta(hours=1)).dt.date().alias("day"),
+        )
+        .unique()
+        .join(requested, on=["task", "id", "variable", "agg_period"], how="inner")
+        .select(*SERIES, "day")
+        .unique()
+    )
+
+
+def days_to_intervals(days: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Turns the (id, v, agg_period, day) rows into intervals of consecutive days.
+    """
+    return (
+        days.sort(*SERIES, "day")
+        .with_columns(
+            (pl.col("day").diff().over(SERIES) != timedelta(days=1))
+            # The rows are sorted by series, and the first day of each series starts a run
+            .fill_null(True)
+            .cum_sum()
+            .alias("run")
+        )
+        .group_by(*SERIES, "run")
+        .agg(pl.col("day").min().alias("from"), pl.col("day").max().alias("to"))
+        .select(*INTERVAL_SCHEMA)
+    )
+
+
+def merge_intervals(intervals: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Merges the overlapping or adjacent intervals of each series.
+    """
+    return (
+        intervals.sort(*SERIES, "from")
+        .with_columns(
+            (
+                pl.col("from")
+                > (pl.col("to").cum_max().shift(1) + timedelta(days=1)).over(SERIES)
+            )
+            # The rows are sorted by series, and the first day of each series starts a run
+            .fill_null(True)
+            .cum_sum()
+            .alias("run")
+        )
+        .group_by(*SERIES, "run")
+        .agg(pl.col("from").min(), pl.col("to").max())
+        .select(*INTERVAL_SCHEMA)
+    )
+
+
+def requested_intervals(ledger: TaskLedger, tasks: list[str]) -> pl.LazyFrame:
+    """
+    Lists the periods requested by the given tasks.
+    """
+    return (
+        ledger.scan_requests()
+        .filter(pl.col("task_id").is_in(list(tasks)))
+        .select(*INTERVAL_SCHEMA)
+    )
+
+
+def pending_intervals(
+    ledger: TaskLedger, ingested_tasks: list[str], invalid_tasks: list[str]
+) -> pl.LazyFrame:
+    """
+    Lists the periods requested by the tasks that were neither ingested nor flagged as invalid: their data is still to
+    come.
+    """
+    return (
+        ledger.scan_requests()
+        .filter(~pl.col("task_id").is_in(list(ingested_tasks) + list(invalid_tasks)))
+        .select(*INTERVAL_SCHEMA)
+    )
+
+
+def coverage(
+    data_path: str | Path,
+    ledger: TaskLedger,
+    ingested_tasks: list[str],
+    invalid_tasks: list[str],
+    partial_tasks: Optional[list[str]] = None,
+) -> pl.DataFrame:
+    """
+    Computes the covered periods of each series: the days with ingested data, the periods of the pending tasks and the
+    periods of the complete tasks, i.e. the ingested ones that are neither invalid nor partial. A complete task covers
+    its whole requested period even where it returned no rows, as Dext3r has no data there.
+
+    Args:
+        data_path (str | Path): The root directory of the measurement store.
+        ledger (TaskLedger): The ledger of the sent tasks.
+        ingested_tasks (list[str]): The tasks whose results were ingested.
+        invalid_tasks (list[str]): The tasks flagged as invalid.
+        partial_tasks (list[str], optional): The ingested tasks whose results are truncated or partial (see
+            `lib.read.task_problem`): only their days with data are covered. Defaults to None.
+
+    Returns:
+        pl.DataFrame: The disjoint (id, v, agg_period, from, to) intervals, inclusive.
+    """
+    complete_tasks = set(ingested_tasks) - set(invalid_tasks) - set(partial_tasks or [])
+    return merge_intervals(
+        pl.concat(
+            [
+                days_to_intervals(covered_days(data_path, ledger)),
+                pending_intervals(ledger, ingested_tasks, invalid_tasks),
+                requested_intervals(ledger, list(complete_tasks)),
+            ],
+            how="vertical_relaxed",
+        ).cast(INTERVAL_SCHEMA)
+    ).collect()
+
+
+def missing_parts(
+    queue: pl.LazyFrame, covered: pl.DataFrame, min_gap_days: int = 1
+) -> pl.LazyFrame:
+    """
+    Cuts the queue elements to the periods that are not covered, dropping the covered ones. An element spanning several
+    holes is split into one element per hole.
+
+    Args:
+        queue (pl.LazyFrame): The queue elements, as returned by `init_request_queue`.
+        covered (pl.DataFrame): The covered intervals, as returned by `coverage`.
+        min_gap_days (int, optional): The shortest hole that is requested, in days. Defaults to 1.
+
+    Returns:
+        pl.LazyFrame: The queue elements of the holes, with their count updated.
+    """
+    # The holes of each series are the gaps between its covered intervals
+    holes = (
+        covered.lazy()
+        .sort(*SERIES, "from")
+        .select(
+            *SERIES,
+            (pl.col("to").shift(1).over(SERIES) + timedelta(days=1))
+            .fill_null(_FIRST_DAY)
+            .alias("hole_from"),
+            (pl.col("from") - timedelta(days=1)).alias("hole_to"),
+        )
+    )
+    after_last = (
+        covered.lazy()
+        .group_by(SERIES)
+        .agg((pl.col("to").max() + timedelta(days=1)).alias("hole_from"))
+        .with_columns(pl.lit(_LAST_DAY).alias("hole_to"))
+    )
+    holes = pl.concat([holes, after_last], how="vertical_relaxed").filter(
+        pl.col("hole_from") <= pl.col("hole_to")
+    )
+    uncovered = queue.join(
+        covered.lazy().select(SERIES).unique(), on=SERIES, how="anti"
+    )
+    cut = (
+        queue.join(holes, on=SERIES, how="inner")
+        .filter(
+            pl.col("hole_from") <= pl.col("to"), pl.col("hole_to") >= pl.col("from")
+        )
+        .with_columns(
+            pl.max_horizontal("from", "hole_from").alias("from"),
+            pl.min_horizontal("to", "hole_to").alias("to"),
+        )
+        .drop("hole_from", "hole_to")
+    )
+    return (
+        pl.concat([uncovered, cut.select(queue.collect_schema().names())])
+        .filter((pl.col("to") - pl.col("from")).dt.total_days() + 1 >= min_gap_days)
+        .with_columns(
+            (
+                (pl.col("to") - pl.col("from") + timedelta(days=1)).dt.total_seconds()
+                // pl.col("agg_period")
+            ).alias("count")
+        )
+    )
+
+
+def split_elements(queue: pl.LazyFrame, max_count: int) -> pl.LazyFrame:
+    """
+    Splits the queue elements counting more than `max_count` lines into consecutive elements that fit, of whole days.
+
+    Returns:
+        pl.LazyFrame: The queue elements, with their count updated.
+    """
+    days = (pl.col("to") - pl.col("from")).dt.total_days() + 1
+    max_days = (max_count * pl.col("agg_period") // 86400).clip(lower_bound=1)
+    return (
+        queue.with_columns(max_days.alias("_days"))
+        .with_columns(
+            pl.int_ranges(0, (days + pl.col("_days") - 1) // pl.col("_days")).alias(
+                "_piece"
+            )
+        )
+        .explode("_piece")
+        .with_columns(
+            (
+                pl.col("from") + pl.duration(days=pl.col("_piece") * pl.col("_days"))
+            ).alias("from")
+        )
+        .with_columns(
+            pl.min_horizontal(
+                "to", pl.col("from") + pl.duration(days=pl.col("_days") - 1)
+            ).alias("to")
+        )
+        .drop("_piece", "_days")
+        .with_columns(
+            (
+                (pl.col("to") - pl.col("from") + timedelta(days=1)).dt.total_seconds()
+                // pl.col("agg_period")
+            ).alias("count")
+        )
+    )
@@ -1,28 +1,148 @@
 import re
-from time import sleep
-from datetime import timedelta, date
+import asyncio
+import threading
+from time import monotonic
+from datetime import timedelta, date, datetime
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
-from tqdm.notebook import tqdm
 import polars as pl
 
-from .metas import list_available_meta
-from .stack import pop_biggest_slice
-from .requests import request_slice
+from .metas import list_available_meta, list_available_stations
+from .stack import RequestQueue, plan_slices, plan_summary, request_elements
+from .estimate import RowEstimator
+from .coverage import (
+    SERIES,
+    coverage,
+    missing_parts,
+    split_elements,
+)
+from .manifest import read_manifest
+from .requests import request_slice, response_detail
 from .write import register_task
+from .ledger import TaskLedger
+from .transport import Transport
+from .retrieve import mark_invalid, pending_tasks, retrieve_tasks
+from .ingest import ingest_archives
+from .read import LINE_LIMIT
+from .store import query, read_catalog, read_task_metas, series_catalog
+from .accounts import AccountPool, retry_after
+from .spatial import StationFilter, StationIndex, PLACE_COLUMNS
+from .telemetry import Telemetry
+from .progress import progress_bar
 
 
 class Dext3rDownloader:
-    def __init__(self, workspace_path, from_date: date, max_days=15 * 365):
+    def __init__(
+        self,
+        workspace_path,
+        from_date: date,
+        max_days=15 * 365,
+        transport: Optional[Transport] = None,
+        progress: str = "auto",
+        daily_requests: Optional[int] = None,
+    ):
         self.workspace_path = Path(workspace_path)
         if not self.workspace_path.exists():
             self.workspace_path.mkdir(parents=True)
-        self.sent_requests_path = self.workspace_path / "requests.csv"
+        self.sent_requests_path = self.workspace_path / "requests.jsonl"
         self.invalid_tasks_path = self.workspace_path / "invalid_tasks.txt"
-        self.payloads_path = self.workspace_path / "payloads.json"
+        self.payloads_path = self.workspace_path / "payloads.jsonl"
+        self.archives_path = self.workspace_path / "zip"
+        self.data_path = self.workspace_path / "data"
+        self.ingest_manifest_path = self.workspace_path / "ingest_manifest.parquet"
+        self.accounts_path = self.workspace_path / "accounts.json"
+        self.ledger = TaskLedger(self.sent_requests_path, self.payloads_path)
+        # Workspaces created before the ledger kept the tasks in requests.csv and payloads.json
+        self.ledger.import_legacy(
+            self.workspace_path / "requests.csv", self.workspace_path / "payloads.json"
+        )
         self.from_date = from_date
         self.max_days = max_days
+        # None uses the shared transport to the production service
+        self.transport = transport
+        self.telemetry = Telemetry(
+            self.workspace_path / "telemetry.jsonl",
+            self.workspace_path / "metrics.prom",
+        )
+        # See `lib.progress.progress_bar`
+        self.progress = progress
+        self.stopping = threading.Event()
+        self._station_index: Optional[StationIndex] = None
+        # The data requests that an email address can send per day, see `account_pool`
+        self.daily_requests = daily_requests
+
+    def select_series(
+        self,
+        variable: str | list[str],
+        aggregation_code: str | list[str],
+        aggregation_span: int,
+        force_meta_request=False,
+        area: Optional[StationFilter] = None,
+    ) -> pl.LazyFrame:
+        """
+        Selects the available series of the given variables and aggregations, of the stations selected by `area`, if
+        given.
+
+        Returns:
+            pl.LazyFrame: The name, id, v, begin, end and agg_period of the series.
+        """
+        # Ensure that the inputs are lists
+        if type(variable) != list:
+            variable = [variable]
+        if type(aggregation_code) != list:
+            aggregation_code = [aggregation_code]
+
+        variable = pl.LazyFrame({"variable": variable})
+        aggregation_code = pl.LazyFrame(
+            {"agg_code": aggregation_code}, schema={"agg_code": pl.Int32()}
+        )
+        series_filter = variable.join(aggregation_code, how="cross").with_columns(
+            pl.lit(aggregation_span, pl.Int32()).alias("agg_period")
+        )
+        series = (
+            list_available_meta(self.workspace_path, force_meta_request, self.transport)
+            .lazy()
+            .join(series_filter, on=["variable", "agg_code", "agg_period"], how="semi")
+            .select("name", "id", "v", "begin", "end", "agg_period")
+        )
+        if area is not None:
+            ids = self.station_ids(area, force_meta_request)
+            if ids is not None:
+                series = series.filter(pl.col("id").is_in(list(ids)))
+        return series
+
+    def station_index(self, force_meta_request=False) -> StationIndex:
+        """
+        Returns the spatial index of the available stations, built once.
+        """
+        if self._station_index is None or force_meta_request:
+            self._station_index = StationIndex(
+                list_available_stations(
+                    self.workspace_path, force_meta_request, self.transport
+                )
+            )
+        return self._station_index
+
+    def station_places(self) -> pl.DataFrame:
+        """
+        Returns the last known place (municipality, province, basin...) of each station, from the station metadata of
+        the ingested tasks.
+        """
+        metas = read_task_metas(self.data_path)
+        return metas.select(
+            "id", *(c for c in PLACE_COLUMNS if c in metas.columns)
+        ).unique("id", keep="last", maintain_order=True)
+
+    def station_ids(
+        self, area: StationFilter, force_meta_request=False
+    ) -> Optional[set[str]]:
+        """
+        Returns the ids of the stations selected by `area`, or None if it selects every station.
+        """
+        return area.select(
+            self.station_index(force_meta_request), self.station_places()
+        )
 
     def init_request_queue(
         self,
@@ -31,9 +151,11 @@ class Dext3rDownloader:
         aggregation_span: int,
         to_date: date,
         force_meta_request=False,
-    ) -> pl.DataFrame:
+        area: Optional[StationFilter] = None,
+    ) -> pl.LazyFrame:
         """
-        Initializes the queue for downloading data.
+        Initializes the queue for downloading data. The queue is built lazily: the series are filtered before being
+        joined with the time sections, and only the overlapping (series, section) pairs are generated.
 
         Args:
             variable (str | list[str]): The variable(s) to download.
@@ -41,24 +163,14 @@ class Dext3rDownloader:
             aggregation_span (int): The aggregation span in seconds.
             to_date (date): The end date of the measures.
             force_meta_request (bool, optional): Whether to force a metadata request or use the cached version. Defaults to False.
+            area (StationFilter, optional): The region whose stations are requested. Defaults to None (every station).
 
         Returns:
-            pl.DataFrame: The queue elements as rows of a DataFrame.
+            pl.LazyFrame: The queue elements as rows of a LazyFrame.
 
         Raises:
             None
         """
-        # Ensure that the inputs are lists
-        if type(variable) != list:
-            variable = [variable]
-        if type(aggregation_code) != list:
-            aggregation_code = [aggregation_code]
-
-        variable = pl.from_dict({"variable": variable})
-        aggregation_code = pl.from_dict(
-            {"agg_code": aggregation_code}, schema={"agg_code": pl.Int32()}
-        )
-
         # Computing the time sections
         cut_dates = pl.date_range(
             self.from_date,
@@ -67,20 +179,21 @@ class Dext3rDownloader:
             eager=True,
         ).to_list() + [to_date]
         time_parts = (
-            pl.from_dict({"from": cut_dates[:-1], "to": cut_dates[1:]})
+            pl.LazyFrame({"from": cut_dates[:-1], "to": cut_dates[1:]})
             .filter(pl.col("from") < pl.col("to"))
             .with_row_index("timeline_section")
             .cast({"timeline_section": pl.Int32()})
         )
-        series_filter = variable.join(aggregation_code, how="cross").with_columns(
-            pl.lit(aggregation_span, pl.Int32()).alias("agg_period")
-        )
         return (
-            list_available_meta(self.workspace_path, force_meta_request)
+            self.select_series(
+                variable, aggregation_code, aggregation_span, force_meta_request, area
+            )
             .filter(pl.col("end").ge(self.from_date), pl.col("begin").le(to_date))
-            .join(series_filter, on=["variable", "agg_code", "agg_period"], how="semi")
-            .join(time_parts, how="cross")
-            .filter(pl.col("begin") <= pl.col("to"), pl.col("end") >= pl.col("from"))
+            .join_where(
+                time_parts,
+                pl.col("begin") <= pl.col("to"),
+                pl.col("end") >= pl.col("from"),
+            )
             .with_columns(
                 pl.max_horizontal(pl.col("begin"), pl.col("from")).alias("from"),
                 pl.min_horizontal(pl.col("end"), pl.col("to")).alias("to"),
@@ -108,20 +221,7 @@ class Dext3rDownloader:
         )
 
     def read_sent_requests(self) -> pl.DataFrame:
-        schema = {
-            "task_id": pl.Utf8(),
-            "name": pl.Utf8(),
-            "id": pl.Utf8(),
-            "v": pl.Utf8(),
-            "from": pl.Date(),
-            "to": pl.Date(),
-            "count": pl.Int32(),
-            "timeline_section": pl.Int32(),
-            "agg_period": pl.Int32(),
-        }
-        if not self.sent_requests_path.exists():
-            return pl.DataFrame(schema=schema)
-        return pl.read_csv(self.sent_requests_path, dtypes=schema)
+        return self.ledger.scan_requests().collect()
 
     def read_invalid_tasks(self):
         if not self.invalid_tasks_path.exists():
@@ -134,6 +234,110 @@ class Dext3rDownloader:
             tasks = task_regex.findall(content)
         return pl.from_dict({"task_id": tasks}, schema={"task_id": pl.Utf8()})
 
+    def retrieve(
+        self,
+        max_workers: int = 4,
+        poll_interval: float = 60,
+        max_interval: float = 900,
+        timeout: Optional[float] = None,
+        max_errors: int = 5,
+    ) -> dict[str, str]:
+        """
+        Waits for the sent tasks to complete and downloads their result archives to the `zip` directory of the
+        workspace. Failed tasks are flagged as invalid, so that resuming the download requests them again.
+
+        Args:
+            max_workers (int, optional): The maximum number of concurrent requests. Defaults to 4.
+            poll_interval (float, optional): The initial polling interval of each task in seconds. Defaults to 60.
+            max_interval (float, optional): The maximum polling interval in seconds. Defaults to 900.
+            timeout (float, optional): The seconds after which the tasks still pending are left for a later call. Defaults to None (no timeout).
+            max_errors (int, optional): The consecutive transient errors after which a task is left for a later call.
+                Defaults to 5.
+
+        Returns:
+            dict[str, str]: The outcome of each task. See `retrieve_tasks`.
+        """
+        tasks = pending_tasks(
+            self.ledger,
+            self.archives_path,
+            self.read_invalid_tasks()["task_id"].to_list(),
+        )
+        return retrieve_tasks(
+            tasks,
+            self.archives_path,
+            self.invalid_tasks_path,
+            self.transport,
+            max_workers,
+            poll_interval,
+            max_interval,
+            timeout,
+            max_errors,
+        )
+
+    def ingest(
+        self,
+        workers: Optional[int] = None,
+        force=False,
+        line_limit: int = LINE_LIMIT,
+    ) -> dict[str, Any]:
+        """
+        Reads the downloaded archives in parallel, merging their data into the measurement store in the `data`
+        directory of the workspace. Archives that were already ingested are skipped, unless they, their payload or
+        their station metadata changed. Truncated or partial tasks are flagged as invalid, so that `repair` requests
+        their missing periods again.
+
+        Args:
+            workers (int, optional): The number of processes. Defaults to the number of CPUs.
+            force (bool, optional): Whether to read every archive again. Defaults to False.
+            line_limit (int, optional): The line limit of the requests, reached by truncated results. Defaults to 25000.
+
+        Returns:
+            dict[str, Any]: The ingestion report. See `ingest_archives`.
+        """
+        report = ingest_archives(
+            sorted(self.archives_path.glob("*.zip")),
+            self.data_path,
+            self.workspace_path,
+            self.payloads_path,
+            workers,
+            manifest_path=self.ingest_manifest_path,
+            force=force,
+            line_limit=line_limit,
+        )
+        for source, error in report["failures"]:
+            print(f"Could not ingest {source}: {error}")
+        invalid_tasks = set(self.read_invalid_tasks()["task_id"].to_list())
+        for task, problem in report["partial"]:
+            print(f"Warning: task {task} is {problem}. It is flagged as invalid.")
+        mark_invalid(
+            [task for task, _ in report["partial"] if task not in invalid_tasks],
+            self.invalid_tasks_path,
+        )
+        self.telemetry.inc("dext3r_ingested_rows_total", report["rows"])
+        self.telemetry.event(
+            "ingest",
+            tasks=report["tasks"],
+            rows=report["rows"],
+            skipped=len(report["skipped"]),
+            failures=len(report["failures"]),
+            partial=len(report["partial"]),
+        )
+        self.telemetry.export()
+        return report
+
+    def query(
+        self,
+        ids: Optional[list[str]] = None,
+        from_date: Optional[date] = None,
+        to_date: Optional[date] = None,
+        variable: Optional[str | list[str]] = None,
+        agg_period: Optional[int] = None,
+    ) -> pl.LazyFrame:
+        """
+        Queries the ingested measurements. See `lib.store.query`.
+        """
+        return query(self.data_path, ids, from_date, to_date, variable, agg_period)
+
     def make_request_queue(
         self,
         variable: str | list[str],
@@ -142,21 +346,27 @@ class Dext3rDownloader:
         to_date: date,
         resume: bool,
         force_meta_request: bool = False,
-    ) -> list[dict[str, Any]]:
+        estimator: Optional[RowEstimator] = None,
+        min_gap_days: int = 1,
+        area: Optional[StationFilter] = None,
+    ) -> RequestQueue:
         """
         Creates a sorted request queue based on the given parameters. The queue is sorted by the number of elements in each request, keeping the
-        heaviest elements at the beginning.
+        heaviest elements at the beginning. The already sent requests are removed before the queue is collected.
 
         Args:
             variable (str | list[str]): The variable(s) to include in the request queue.
             aggregation (str | list[str]): The aggregation(s) to include in the request queue.
             aggregation_period (int): The aggregation period to include in the request queue.
             to_date (date): The end date of the request queue.
-            resume (bool): Whether to resume from previous requests or force the request of parts that were already processed.
+            resume (bool): Whether to request only the periods that are not covered yet, either by ingested data or by tasks still to be ingested (see `lib.coverage`), or to request everything again.
             force_meta_request (bool, optional): Whether to force an updated version of metadata from Dext3r. Defaults to False.
+            estimator (RowEstimator, optional): The estimator of the lines of each element. Defaults to None, counting the whole period of every element.
+            min_gap_days (int, optional): When resuming, the shortest uncovered period that is requested, in days. Defaults to 1.
+            area (StationFilter, optional): The region whose stations are requested. Defaults to None (every station).
 
         Returns:
-            list[dict[str, Any]]: A list of dictionaries representing the sorted request queue.
+            RequestQueue: The sorted request queue.
         """
         queue = self.init_request_queue(
             variable,
@@ -164,16 +374,155 @@ class Dext3rDownloader:
             aggregation_period,
             to_date,
             force_meta_request,
+            area,
         )
         if resume:
-            # Remove the requests that were already sent, not counting the tasks flagged as invalid
-            to_remove = self.read_sent_requests().join(
-                self.read_invalid_tasks(), on="task_id", how="anti"
-            )
-            queue = queue.join(
-                to_remove, on=["id", "v", "timeline_section"], how="anti"
-            )
-        return queue.sort("count", "timeline_section", descending=True).to_dicts()
+            queue = missing_parts(queue, self.coverage(), min_gap_days)
+        queue = queue.sort("count", "timeline_section", descending=True).collect()
+        if estimator is not None:
+            queue = estimator.weights(queue)
+        return RequestQueue(queue)
+
+    def ingested_tasks(self) -> list[str]:
+        """
+        Lists the tasks whose results were ingested, according to the ingestion manifest or, without it, to the store
+        catalog.
+        """
+        if self.ingest_manifest_path.exists():
+            return [
+                task
+                for task, entry in read_manifest(self.ingest_manifest_path).items()
+                if entry["status"] != "failed"
+            ]
+        return (
+            read_catalog(self.data_path)["tasks"]
+            .explode()
+            .drop_nulls()
+            .unique()
+            .to_list()
+        )
+
+    def compact(self) -> dict[str, int]:
+        """
+        Rewrites the ledger without its duplicated records. See `TaskLedger.compact`.
+        """
+        return self.ledger.compact()
+
+    def catalog(self) -> pl.DataFrame:
+        """
+        Summarizes the ingested measurements of each series (id, variable, agg_period): their first and last
+        measurement, rows, null values, partition files and tasks. It is read from the store catalog, without scanning
+        the measurements. See `lib.store.series_catalog`.
+        """
+        return series_catalog(self.data_path)
+
+    def coverage(self) -> pl.DataFrame:
+        """
+        Computes the periods of each series that are covered by ingested data, by complete ingested tasks or by tasks
+        still to be ingested. See `lib.coverage.coverage`.
+        """
+        partial_tasks = []
+        if self.ingest_manifest_path.exists():
+            partial_tasks = [
+                task
+                for task, entry in read_manifest(self.ingest_manifest_path).items()
+                if entry["status"] == "partial"
+            ]
+        return coverage(
+            self.data_path,
+            self.ledger,
+            self.ingested_tasks(),
+            self.read_invalid_tasks()["task_id"].to_list(),
+            partial_tasks,
+        )
+
+    def status(self) -> dict[str, int]:
+        """
+        Summarizes the workspace: the sent tasks and their queue elements, the tasks whose archive is still to be
+        downloaded, the downloaded archives, the ingested and the invalid tasks, and the rows of the measurement store.
+        """
+        invalid_tasks = self.read_invalid_tasks()["task_id"].to_list()
+        return {
+            "tasks": self.ledger.scan_payloads()
+            .select(pl.col("task_id").n_unique())
+            .collect()
+            .item(),
+            "elements": self.ledger.scan_requests().select(pl.len()).collect().item(),
+            "pending": len(
+                pending_tasks(self.ledger, self.archives_path, invalid_tasks)
+            ),
+            "archives": len(list(self.archives_path.glob("*.zip"))),
+            "ingested": len(self.ingested_tasks()),
+            "invalid": len(invalid_tasks),
+            "rows": read_catalog(self.data_path)["rows"].sum(),
+        }
+
+    def row_estimator(self, safety_margin: float = 0.1) -> RowEstimator:
+        """
+        Learns how many lines Dext3r returns for each series from the ingested results. See `RowEstimator`.
+        """
+        return RowEstimator.learn(
+            self.data_path,
+            self.ledger,
+            self.read_invalid_tasks()["task_id"].to_list(),
+            margin=safety_margin,
+        )
+
+    def plan(
+        self,
+        variable: str | list[str],
+        aggregation_code: str | list[str],
+        aggregation_span: int,
+        to_date: date,
+        max_lines: int = 18000,
+        resume: bool = True,
+        strategy: str = "greedy",
+        safety_margin: Optional[float] = None,
+        area: Optional[StationFilter] = None,
+    ) -> list[list[dict[str, Any]]]:
+        """
+        Plans the requests needed to download the given series, reporting their number and fill ratio.
+
+        Args:
+            variable (str | list[str]): The variable(s) to download.
+            aggregation_code (str | list[str]): The aggregation code(s) to download.
+            aggregation_span (int): The aggregation span for the data in seconds.
+            to_date (date): The end date for the data.
+            max_lines (int, optional): The maximum number of lines per request. Defaults to 18000.
+            resume (bool, optional): Whether to skip the parts that were already requested. Defaults to True.
+            strategy (str, optional): The planning strategy: "greedy", "merge", "bfd" or "best". See `plan_slices`. Defaults to "greedy".
+            safety_margin (float, optional): If given, the lines of a request are estimated from the rows actually returned by the ingested tasks (see `row_estimator`), increased by this relative margin. Defaults to None, counting the whole requested period of every station.
+            area (StationFilter, optional): The region whose stations are requested, e.g. `StationFilter(radius=(11.34, 44.49, 30))` for 30 km around Bologna. See `lib.spatial.StationFilter`. Defaults to None (every station).
+
+        Returns:
+            list[list[dict[str, Any]]]: The groups of queue elements to request together.
+        """
+        slices = plan_slices(
+            self.make_request_queue(
+                variable,
+                aggregation_code,
+                aggregation_span,
+                to_date,
+                resume,
+                estimator=(
+                    self.row_estimator(safety_margin)
+                    if safety_margin is not None
+                    else None
+                ),
+                area=area,
+            ),
+            max_lines,
+            strategy,
+            LINE_LIMIT,
+        )
+        summary = plan_summary(slices, max_lines)
+        print(
+            f"Planned {summary['requests']} requests ({strategy}), fill ratio {summary['fill_ratio']:.1%}"
+        )
+        self.telemetry.event(
+            "plan", strategy=strategy, max_lines=max_lines, resume=resume, **summary
+        )
+        return slices
 
     def download(
         self,
@@ -186,6 +535,9 @@ class Dext3rDownloader:
         max_lines: int = 18000,
         resume: bool = True,
         max_tries: int = 5,
+        strategy: str = "greedy",
+        safety_margin: Optional[float] = None,
+        area: Optional[StationFilter] = None,
     ):
         """
         Downloads data from the Dext3r service.
@@ -199,32 +551,356 @@ class Dext3rDownloader:
             pause (int, optional): The pause time between requests in seconds. Defaults to 120. It will be dynamically adjusted based on the number of retries.
             max_lines (int, optional): The maximum number of lines to download per request. Defaults to 18000. The Dext3r service imposes a limit of 25000, but computing the effective request size is not an exact task. The higher the value, the higher the risk of exceeding the limit and the longer the response time.
             resume (bool, optional): Whether to resume a previous download. Defaults to True.
-            max_tries (int, optional): The maximum number of retry attempts for failed requests. Defaults to 5.
+            max_tries (int, optional): The maximum number of retry attempts for failed requests. Defaults to 5. A refused email address (403) cools down without spending a try: the slice is sent by another address (see `account_pool`). The refusals spend tries once there were as many as addresses, so a slice refused by every address is eventually abandoned.
+            strategy (str, optional): The planning strategy: "greedy", "merge", "bfd" or "best". See `plan_slices`. Defaults to "greedy".
+            safety_margin (float, optional): If given, requests are sized with the learned row estimator and this safety margin. See `plan`. Defaults to None.
+            area (StationFilter, optional): The region whose stations are downloaded. See `plan`. Defaults to None (every station).
         """
-        # Building the request queue
-        queue: list[dict[str, Any]] = self.make_request_queue(
+        # Grouping the request queue in slices suitable to be sent together
+        slices = self.plan(
             variable,
             aggregation_code,
             aggregation_span,
             to_date,
+            max_lines,
             resume,
+            strategy,
+            safety_margin,
+            area,
+        )
+        self.send_slices(slices, email, pause, max_tries)
+
+    def update_request_queue(
+        self,
+        variable: str | list[str],
+        aggregation_code: str | list[str],
+        aggregation_span: int,
+        max_size: int,
+        to_date: Optional[date] = None,
+        force_meta_request: bool = False,
+        estimator: Optional[RowEstimator] = None,
+        area: Optional[StationFilter] = None,
+    ) -> RequestQueue:
+        """
+        Creates the queue of the new data of the series that were already downloaded: for each series, the period from
+        the day after its last covered one to its current end in the metadata. The covered days are the ones of
+        `coverage`: the days with ingested data and the periods of the pending and complete tasks, so that a series
+        whose last requested days have no data is not requested again. Series that were never downloaded are left to
+        `download`.
+
+        The tails are not tied to the timeline sections, so their timeline_section is -1 and any of them can be packed
+        together. Long tails, e.g. of series not updated for years, are split in time so that each station fits in
+        `max_size` lines with all its variables, as `repair_queue` does.
+
+        Args:
+            variable (str | list[str]): The variable(s) to update.
+            aggregation_code (str | list[str]): The aggregation code(s) to update.
+            aggregation_span (int): The aggregation span in seconds.
+            max_size (int): The maximum number of lines of a request.
+            to_date (date, optional): The last day to request. Defaults to today.
+            force_meta_request (bool, optional): Whether to force an updated version of metadata from Dext3r. Defaults to False.
+            estimator (RowEstimator, optional): The estimator of the lines of each element. See `make_request_queue`.
+            area (StationFilter, optional): The region whose stations are updated. Defaults to None (every station).
+
+        Returns:
+            RequestQueue: The sorted request queue.
+        """
+        to_date = to_date or date.today()
+        last_covered = (
+            self.coverage()
+            .lazy()
+            .group_by(SERIES)
+            .agg(pl.col("to").max().alias("last"))
+        )
+        tails = (
+            self.select_series(
+                variable,
+                aggregation_code,
+                aggregation_span,
+                force_meta_request,
+                area,
+            )
+            .join(last_covered, on=SERIES, how="inner")
+            .select(
+                "name",
+                "id",
+                "v",
+                (pl.col("last") + timedelta(days=1)).alias("from"),
+                pl.min_horizontal(pl.col("end"), pl.lit(to_date)).alias("to"),
+                pl.lit(-1, pl.Int32()).alias("timeline_section"),
+                "agg_period",
+            )
+            .filter(pl.col("from") <= pl.col("to"))
         )
+        n_variables = tails.select(pl.col("v").n_unique()).collect().item()
+        queue = (
+            split_elements(tails, max_size // max(n_variables, 1))
+            .select(
+                "name",
+                "id",
+                "v",
+                "from",
+                "to",
+                "count",
+                "timeline_section",
+                "agg_period",
+            )
+            .sort("count", descending=True)
+            .collect()
+        )
+        if estimator is not None:
+            queue = estimator.weights(queue)
+        return RequestQueue(queue)
+
+    def update(
+        self,
+        email: str | list[str],
+        variable: str | list[str],
+        aggregation_code: str | list[str],
+        aggregation_span: int,
+        to_date: Optional[date] = None,
+        pause: int = 120,
+        max_lines: int = 18000,
+        max_tries: int = 5,
+        strategy: str = "best",
+        safety_margin: Optional[float] = None,
+        area: Optional[StationFilter] = None,
+    ) -> list[list[dict[str, Any]]]:
+        """
+        Requests the new data of the series that were already downloaded (see `update_request_queue`), packing their
+        tails into as few requests as possible. Meant for periodic refreshes: the history is not planned again.
+
+        Args:
+            email (str | list[str]): The email address(es) to use for the requests.
+            variable (str | list[str]): The variable(s) to update.
+            aggregation_code (str | list[str]): The aggregation code(s) to update.
+            aggregation_span (int): The aggregation span for the data in seconds.
+            to_date (date, optional): The last day to request. Defaults to today.
+            pause (int, optional): The pause time between requests in seconds. See `download`. Defaults to 120.
+            max_lines (int, optional): The maximum number of lines per request. See `download`. Defaults to 18000.
+            max_tries (int, optional): The maximum number of retry attempts for failed requests. Defaults to 5.
+            strategy (str, optional): The planning strategy. See `plan_slices`. Defaults to "best".
+            safety_margin (float, optional): If given, requests are sized with the learned row estimator and this safety margin. See `plan`. Defaults to None.
+            area (StationFilter, optional): The region whose stations are updated. Defaults to None (every station).
+
+        Returns:
+            list[list[dict[str, Any]]]: The slices that were planned.
+        """
+        queue = self.update_request_queue(
+            variable,
+            aggregation_code,
+            aggregation_span,
+            max_lines,
+            to_date,
+            estimator=(
+                self.row_estimator(safety_margin) if safety_margin is not None else None
+            ),
+            area=area,
+        )
+        slices = plan_slices(queue, max_lines, strategy, LINE_LIMIT)
+        summary = plan_summary(slices, max_lines)
+        print(
+            f"Planned {summary['requests']} update requests ({strategy}), fill ratio {summary['fill_ratio']:.1%}"
+        )
+        self.telemetry.event(
+            "plan", strategy=strategy, max_lines=max_lines, update=True, **summary
+        )
+        self.send_slices(slices, email, pause, max_tries)
+        return slices
+
+    def repair_queue(self, max_size: int) -> RequestQueue:
+        """
+        Builds the queue of the periods requested by the invalid tasks (failed, truncated or partial) that are not
+        covered yet, neither by ingested data nor by tasks still to be ingested. The elements are split in time so that
+        each station fits in `max_size` lines with all its variables.
+
+        Args:
+            max_size (int): The maximum number of lines of a request.
+
+        Returns:
+            RequestQueue: The sorted request queue.
+        """
+        invalid_tasks = self.read_invalid_tasks()["task_id"].to_list()
+        requested = (
+            self.ledger.scan_requests()
+            .filter(pl.col("task_id").is_in(invalid_tasks))
+            .drop("task_id")
+            .unique(
+                ["id", "v", "agg_period", "from", "to", "timeline_section"],
+                maintain_order=True,
+            )
+        )
+        n_variables = requested.select(pl.col("v").n_unique()).collect().item()
+        queue = split_elements(
+            missing_parts(requested, self.coverage()), max_size // max(n_variables, 1)
+        )
+        return RequestQueue(
+            queue.sort("count", "timeline_section", descending=True).collect()
+        )
+
+    def repair(
+        self,
+        email: str | list[str],
+        max_lines: int = 18000,
+        shrink: float = 0.5,
+        pause: int = 120,
+        max_tries: int = 5,
+        strategy: str = "greedy",
+    ) -> list[list[dict[str, Any]]]:
+        """
+        Requests again the missing periods of the invalid tasks (see `repair_queue`), in requests smaller than the
+        original ones: truncated results came from requests that were too big. Run it after `ingest`, which flags the
+        truncated and partial tasks.
+
+        Args:
+            email (str | list[str]): The email address(es) to use for the requests.
+            max_lines (int, optional): The maximum number of lines per request of the download. Defaults to 18000.
+            shrink (float, optional): The factor applied to `max_lines` for the new requests. Defaults to 0.5.
+            pause (int, optional): The pause time between requests in seconds. See `download`. Defaults to 120.
+            max_tries (int, optional): The maximum number of retry attempts for failed requests. Defaults to 5.
+            strategy (str, optional): The planning strategy. See `plan_slices`. Defaults to "greedy".
+
+        Returns:
+            list[list[dict[str, Any]]]: The slices that were planned.
+        """
+        max_size = int(max_lines * shrink)
+        slices = plan_slices(self.repair_queue(max_size), max_size, strategy)
+        summary = plan_summary(slices, max_size)
+        print(
+            f"Planned {summary['requests']} repair requests ({strategy}), fill ratio {summary['fill_ratio']:.1%}"
+        )
+        self.telemetry.event(
+            "plan", strategy=strategy, max_lines=max_size, repair=True, **summary
+        )
+        self.send_slices(slices, email, pause, max_tries)
+        return slices
+
+    def _record_request(
+        self,
+        account: str,
+        queue_slice: list[dict[str, Any]],
+        attempt: int,
+        seconds: float,
+        response=None,
+        task: Optional[str] = None,
+        detail: Optional[str] = None,
+        error: Optional[Exception] = None,
+    ):
+        """
+        Records a request attempt in the telemetry: its outcome, latency and estimated lines.
+        """
+        lines = request_elements(queue_slice)
+        status = str(response.status_code) if response is not None else "exception"
+        self.telemetry.inc("dext3r_requests_total", account=account, status=status)
+        self.telemetry.observe("dext3r_request_seconds", seconds, account=account)
+        self.telemetry.observe("dext3r_request_lines", lines)
+        fields = {
+            "account": account,
+            "status": status,
+            "seconds": round(seconds, 3),
+            "attempt": attempt,
+            "lines": lines,
+            "stations": len({s["id"] for s in queue_slice}),
+            "variables": len({s["v"] for s in queue_slice}),
+        }
+        if task is not None:
+            self.telemetry.inc("dext3r_tasks_total")
+            fields["task"] = task
+        elif error is not None:
+            self.telemetry.inc("dext3r_request_errors_total", type=type(error).__name__)
+            fields["error"] = repr(error)
+        else:
+            fields["detail"] = detail
+        self.telemetry.event("request", **fields)
+
+    def account_pool(self, email: str | list[str]) -> AccountPool:
+        """
+        Returns the usage of the email addresses, persisted in accounts.json across downloads, with the daily budget
+        of the downloader. See `lib.accounts.AccountPool`.
+        """
         if type(email) == str:
             email = [email]
-        with tqdm(total=len(queue)) as pbar:
+        return AccountPool(self.accounts_path, email, self.daily_requests)
+
+    def _account_cooldown(
+        self, account: str, until: Optional[datetime], status: int | str
+    ):
+        if until is not None:
+            self.telemetry.event(
+                "account_cooldown", account=account, until=until, status=status
+            )
+
+    def stop(self):
+        """
+        Asks the running and later sends of this downloader to stop. The request in progress, if any, is completed and
+        registered, so the ledger stays consistent; the pending slices are left to a later resumed download. It can be
+        called from another thread or from a signal handler.
+        """
+        self.stopping.set()
+
+    def _end_sending(self, n_slices: int, unsent: int):
+        self.telemetry.set("dext3r_queue_slices", unsent)
+        self.telemetry.export()
+        self.telemetry.event(
+            "download_end",
+            slices=n_slices,
+            unsent=unsent,
+            stopped=self.stopping.is_set(),
+        )
+        if self.stopping.is_set():
+            print(f"Stopped: {unsent} slices were not requested")
+
+    async def _pause(self, seconds: float):
+        # Sleeps in short steps, so that a stop request is noticed quickly
+        end = monotonic() + seconds
+        while not self.stopping.is_set() and monotonic() < end:
+            await asyncio.sleep(min(1, end - monotonic()))
+
+    def send_slices(
+        self,
+        slices: list[list[dict[str, Any]]],
+        email: str | list[str],
+        pause: int = 120,
+        max_tries: int = 5,
+    ):
+        """
+        Sends the planned slices one at a time, each from the available email address with the most remaining budget,
+        and registers the tasks in the ledger. The arguments are the same as `download`.
+        """
+        pool = self.account_pool(email)
+        self.telemetry.event(
+            "download_start",
+            slices=len(slices),
+            accounts=len(pool.emails),
+            pause=pause,
+        )
+        done = 0
+        with progress_bar(sum(len(s) for s in slices), self.progress) as pbar:
             task = None
             dyn_pause = pause
-            while len(queue) > 0:
+            for queue_slice in slices:
+                if self.stopping.is_set():
+                    break
+                self.telemetry.set("dext3r_queue_slices", len(slices) - done)
                 sent = False
                 c = 0
-                email_index = 0
-                # Tacking a group of requests suitable to be sent together
-                queue_slice = pop_biggest_slice(queue, max_lines)
-                while not sent and c < max_tries:
+                refusals = 0
+                while not sent and c < max_tries and not self.stopping.is_set():
+                    account = pool.choose()
+                    if account is None:
+                        # Waiting for an address does not spend the tries of the slice
+                        wait = pool.wait_time()
+                        pbar.set_postfix_str(
+                            f"Every account is cooling down for {wait:.0f}s"
+                        )
+                        self.stopping.wait(wait)
+                        continue
+                    start = monotonic()
                     try:
                         response, payload = request_slice(
-                            queue_slice, email[email_index]
+                            queue_slice, account, self.transport
                         )
+                        seconds = monotonic() - start
                         if response.status_code == 200:
                             task = response.json()["task"]
                             # Keeping track of the requests and the payloads
@@ -235,30 +911,258 @@ class Dext3rDownloader:
                                 [self.sent_requests_path, self.payloads_path],
                             )
                             sent = True
+                            self._record_request(
+                                account, queue_slice, c + 1, seconds, response, task
+                            )
+                            self._account_cooldown(
+                                account,
+                                pool.record_success(
+                                    account, request_elements(queue_slice)
+                                ),
+                                "budget",
+                            )
                             pbar.set_postfix_str(f"OK: {task}")
-                            email_index = (email_index + 1) % len(email)
                             if c == 0:
-                                dyn_pause -= 20
+                                dyn_pause = max(dyn_pause - 20, 0)
                         else:
-                            content = response.json()
-                            if "detail" in content:
-                                detail = content["detail"]
-                            elif "details" in content:
-                                detail = content["details"]
-                            else:
-                                detail = None
-                            dyn_pause = min(dyn_pause + 10, 210)
+                            detail = response_detail(response)
+                            self._record_request(
+                                account,
+                                queue_slice,
+                                c + 1,
+                                seconds,
+                                response,
+                                detail=detail,
+                            )
+                            self._account_cooldown(
+                                account,
+                                pool.record_error(
+                                    account,
+                                    response.status_code,
+                                    detail,
+                                    retry_after(response),
+                                ),
+                                response.status_code,
+                            )
+                            if response.status_code != 403:
+                                dyn_pause = min(dyn_pause + 10, 210)
                             pbar.set_postfix_str(
                                 f"Error: {response.status_code} ({detail}) ({c+1}/{max_tries}). Last successful task: {task}"
                             )
                             if response.status_code == 403:
-                                c = max_tries
+                                refusals += 1
+                                if refusals <= len(pool.emails):
+                                    # The account is refused, not the slice: another account sends it. Once every
+                                    # account had its chance, refusals spend tries, so the slice is not retried forever
+                                    c -= 1
                     except Exception as e:
+                        self._record_request(
+                            account, queue_slice, c + 1, monotonic() - start, error=e
+                        )
+                        pool.record_error(account, type(e).__name__, str(e))
                         names = [s["name"] for s in queue_slice]
                         ids = [s["id"] for s in queue_slice]
                         print(
                             f"Exception '{e}' while processing {{names: {names}, ids: {ids}}}"
                         )
                     c += 1
-                    sleep(dyn_pause)
+                    self.telemetry.set(
+                        "dext3r_pause_seconds", dyn_pause, account=account
+                    )
+                    self.telemetry.export()
+                    self.stopping.wait(dyn_pause)
+                if not sent and self.stopping.is_set():
+                    break
+                if not sent:
+                    self.telemetry.inc("dext3r_slices_abandoned_total")
+                    self.telemetry.event(
+                        "slice_abandoned",
+                        ids=[s["id"] for s in queue_slice],
+                        tries=c,
+                    )
+                done += 1
+                pbar.update(len(queue_slice))
+        self._end_sending(len(slices), len(slices) - done)
+
+    async def download_async(
+        self,
+        email: str | list[str],
+        variable: str | list[str],
+        aggregation_code: str | list[str],
+        aggregation_span: int,
+        to_date: date,
+        pause: int = 120,
+        max_lines: int = 18000,
+        resume: bool = True,
+        max_tries: int = 5,
+        strategy: str = "greedy",
+        safety_margin: Optional[float] = None,
+        area: Optional[StationFilter] = None,
+    ):
+        """
+        Downloads data from the Dext3r service, sending requests concurrently from every email address. One pipeline
+        per address takes slices from a shared queue and sends each from the available address with the most remaining
+        budget; an address keeps its own dynamic pause, so the throughput grows with the number of addresses. An
+        address that gets a 403 response cools down and its slice is sent by another one (see `account_pool`). The
+        arguments are the same as `download`. In a notebook, run it with `await dm.download_async(...)`.
+        """
+        slices = self.plan(
+            variable,
+            aggregation_code,
+            aggregation_span,
+            to_date,
+            max_lines,
+            resume,
+            strategy,
+            safety_margin,
+            area,
+        )
+        await self.send_slices_async(slices, email, pause, max_tries)
+
+    async def send_slices_async(
+        self,
+        slices: list[list[dict[str, Any]]],
+        email: str | list[str],
+        pause: int = 120,
+        max_tries: int = 5,
+    ):
+        """
+        Sends the planned slices with one concurrent pipeline per email address. See `download_async`.
+        """
+        pool = self.account_pool(email)
+        queue: asyncio.Queue = asyncio.Queue()
+        for queue_slice in slices:
+            queue.put_nowait(queue_slice)
+        # Only one pipeline at a time appends to the task registry
+        registry_lock = asyncio.Lock()
+        # An account is used by one pipeline at a time, through its request and its pause
+        in_use: set[str] = set()
+        pauses = {account: pause for account in pool.emails}
+
+        async def acquire(pbar) -> Optional[str]:
+            # Waiting for an account does not spend the tries of the slice
+            while not self.stopping.is_set():
+                account = pool.choose(tuple(in_use))
+                if account is not None:
+                    in_use.add(account)
+                    return account
+                wait = pool.wait_time()
+                if wait > 0:
+                    pbar.set_postfix_str(
+                        f"Every account is cooling down for {wait:.0f}s"
+                    )
+                await self._pause(1)
+            return None
+
+        async def pipeline(pbar):
+            while not queue.empty() and not self.stopping.is_set():
+                queue_slice = queue.get_nowait()
+                self.telemetry.set("dext3r_queue_slices", queue.qsize())
+                sent = False
+                c = 0
+                refusals = 0
+                while not sent and c < max_tries and not self.stopping.is_set():
+                    account = await acquire(pbar)
+                    if account is None:
+                        break
+                    dyn_pause = pauses[account]
+                    start = monotonic()
+                    try:
+                        response, payload = await asyncio.to_thread(
+                            request_slice, queue_slice, account, self.transport
+                        )
+                        seconds = monotonic() - start
+                        if response.status_code == 200:
+                            task = response.json()["task"]
+                            async with registry_lock:
+                                await asyncio.to_thread(
+                                    register_task,
+                                    task,
+                                    queue_slice,
+                                    payload,
+                                    [self.sent_requests_path, self.payloads_path],
+                                )
+                            sent = True
+                            self._record_request(
+                                account, queue_slice, c + 1, seconds, response, task
+                            )
+                            self._account_cooldown(
+                                account,
+                                pool.record_success(
+                                    account, request_elements(queue_slice)
+                                ),
+                                "budget",
+                            )
+                            pbar.set_postfix_str(f"OK: {task} ({account})")
+                            if c == 0:
+                                dyn_pause = max(dyn_pause - 20, 0)
+                        else:
+                            detail = response_detail(response)
+                            self._record_request(
+                                account,
+                                queue_slice,
+                                c + 1,
+                                seconds,
+                                response,
+                                detail=detail,
+                            )
+                            self._account_cooldown(
+                                account,
+                                pool.record_error(
+                                    account,
+                                    response.status_code,
+                                    detail,
+                                    retry_after(response),
+                                ),
+                                response.status_code,
+                            )
+                            if response.status_code != 403:
+                                dyn_pause = min(dyn_pause + 10, 210)
+                            pbar.set_postfix_str(
+                                f"Error: {response.status_code} ({detail}) ({c+1}/{max_tries}) ({account})"
+                            )
+                            if response.status_code == 403:
+                                refusals += 1
+                                if refusals <= len(pool.emails):
+                                    # The account is refused, not the slice: another account sends it. Once every
+                                    # account had its chance, refusals spend tries, so the slice is not retried forever
+                                    c -= 1
+                    except Exception as e:
+                        self._record_request(
+                            account, queue_slice, c + 1, monotonic() - start, error=e
+                        )
+                        pool.record_error(account, type(e).__name__, str(e))
+                        names = [s["name"] for s in queue_slice]
+                        ids = [s["id"] for s in queue_slice]
+                        print(
+                            f"Exception '{e}' while processing {{names: {names}, ids: {ids}}} ({account})"
+                        )
+                    c += 1
+                    pauses[account] = dyn_pause
+                    self.telemetry.set(
+                        "dext3r_pause_seconds", dyn_pause, account=account
+                    )
+                    await asyncio.to_thread(self.telemetry.export)
+                    await self._pause(dyn_pause)
+                    in_use.discard(account)
+                if not sent and self.stopping.is_set():
+                    queue.put_nowait(queue_slice)
+                    return
+                if not sent:
+                    self.telemetry.inc("dext3r_slices_abandoned_total")
+                    self.telemetry.event(
+                        "slice_abandoned",
+                        ids=[s["id"] for s in queue_slice],
+                        tries=c,
+                    )
                 pbar.update(len(queue_slice))
+
+        self.telemetry.event(
+            "download_start",
+            slices=len(slices),
+            accounts=len(pool.emails),
+            pause=pause,
+        )
+        with progress_bar(sum(len(s) for s in slices), self.progress) as pbar:
+            await asyncio.gather(*(pipeline(pbar) for _ in pool.emails))
+        self._end_sending(len(slices), queue.qsize())
@@ -0,0 +1,148 @@
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional
+
+import polars as pl
+
+from .ledger import TaskLedger
+from .store import query
+from .variables import with_variable_names
+
+DENSITY_SCHEMA = {
+    "id": pl.Utf8(),
+    "v": pl.Utf8(),
+    "agg_period": pl.Int32(),
+    "density": pl.Float64(),
+    "tasks": pl.UInt32(),
+}
+
+
+def observed_rows(data_path: str | Path) -> pl.LazyFrame:
+    """
+    Counts the rows of each station and variable in each task of the measurement store.
+    """
+    return (
+        query(data_path)
+        .group_by("task", "id", "variable", "agg_period")
+        .agg(pl.len().alias("rows"))
+    )
+
+
+def learn_densities(
+    data_path: str | Path,
+    ledger: TaskLedger,
+    invalid_tasks: Optional[list[str]] = None,
+) -> pl.DataFrame:
+    """
+    Learns the fraction of the requested lines that Dext3r actually returns for each series.
+
+    A task requests every one of its stations over the whole period of its slice, so each (task, station, variable)
+    of an ingested task is expected to return the lines of that period, as counted by `slice_size`. The density of a
+    series is the ratio between the rows found in the store and the expected ones, over all its ingested tasks.
+    Stations missing from the results of an ingested task count as empty.
+
+    Args:
+        data_path (str | Path): The root directory of the measurement store.
+        ledger (TaskLedger): The ledger of the sent tasks.
+        invalid_tasks (list[str], optional): Tasks to ignore, e.g. the failed ones. Defaults to None.
+
+    Returns:
+        pl.DataFrame: The density of each (id, v, agg_period) series and the number of tasks it was learned from.
+    """
+    observed = observed_rows(data_path)
+    requests = ledger.scan_requests()
+    if invalid_tasks:
+        requests = requests.filter(~pl.col("task_id").is_in(invalid_tasks))
+    expected = (
+        requests.with_columns(
+            pl.col("from").min().over("task_id").alias("task_from"),
+            pl.col("to").max().over("task_id").alias("task_to"),
+        )
+        .group_by("task_id", "id", "v")
+        .agg(pl.col("agg_period", "task_from", "task_to").first())
+        .with_columns(
+            (
+                (
+                    pl.col("task_to") - pl.col("task_from") + timedelta(days=1)
+                ).dt.total_seconds()
+                // pl.col("agg_period")
+            ).alias("expected")
+        )
+        # Only the tasks with results in the store were ingested
+        .join(
+            observed.select(pl.col("task").alias("task_id")).unique(),
+            on="task_id",
+            how="semi",
+        )
+    )
+    return (
+        with_variable_names(expected)
+        .join(
+            observed.rename({"task": "task_id"}),
+            on=["task_id", "id", "variable", "agg_period"],
+            how="left",
+        )
+        .group_by("id", "v", "agg_period")
+        .agg(
+            (pl.col("rows").fill_null(0).sum() / pl.col("expected").sum())
+            .clip(0.0, 1.0)
+            .alias("density"),
+            pl.len().alias("tasks"),
+        )
+        .collect()
+        .cast(DENSITY_SCHEMA)
+    )
+
+
+class RowEstimator:
+    """
+    Estimates the lines returned by a request from the densities learned by `learn_densities`.
+
+    The weight of a series is the number of stations it counts as when sizing a request: its density increased by the
+    safety margin, between `min_density` and 1. Series that were never ingested count as one station, as in
+    `tot_elements`.
+
+    Args:
+        densities (pl.DataFrame): The learned densities.
+        margin (float, optional): The relative safety margin added to the densities. Defaults to 0.1.
+        min_density (float, optional): The lowest density used, so that stations that returned no data are not packed
+            without limit. Defaults to 0.1.
+    """
+
+    def __init__(
+        self, densities: pl.DataFrame, margin: float = 0.1, min_density: float = 0.1
+    ):
+        self.densities = densities
+        self.margin = margin
+        self.min_density = min_density
+
+    @classmethod
+    def learn(
+        cls,
+        data_path: str | Path,
+        ledger: TaskLedger,
+        invalid_tasks: Optional[list[str]] = None,
+        **kwargs,
+    ):
+        return cls(learn_densities(data_path, ledger, invalid_tasks), **kwargs)
+
+    def weights(self, queue: pl.DataFrame) -> pl.DataFrame:
+        """
+        Adds the "weight" column used by the planner to the queue elements.
+        """
+        return (
+            queue.with_row_index("_position")
+            .join(
+                self.densities.select("id", "v", "agg_period", "density"),
+                on=["id", "v", "agg_period"],
+                how="left",
+            )
+            .sort("_position")
+            .with_columns(
+                (pl.col("density").clip(self.min_density, 1.0) * (1 + self.margin))
+                .clip(upper_bound=1.0)
+                .fill_null(1.0)
+                .alias("weight")
+            )
+            .drop("_position", "density")
+        )
@@ -0,0 +1,273 @@
+import multiprocessing
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Optional
+
+import polars as pl
+
+from .manifest import (
+    StationDigests,
+    file_hash,
+    payload_digest,
+    read_manifest,
+    select_sources,
+    write_manifest,
+)
+from .metas import list_available_stations
+from .read import (
+    LINE_LIMIT,
+    read_dext3r_archives,
+    read_payloads,
+    read_request_periods,
+    short_series,
+    task_from_name,
+    task_problem,
+)
+from .stations import StationResolver
+from .store import task_partitions, write_measurements, write_task_metas
+
+# Payloads and requested periods, loaded once by each worker process
+_worker_inputs: dict[str, Any] = {}
+
+
+def _init_worker(payloads_path: Path):
+    _worker_inputs["payloads"] = read_payloads(payloads_path)
+    _worker_inputs["periods"] = read_request_periods(payloads_path)
+
+
+def _read_source(
+    source: Path,
+) -> tuple[str, list[tuple[str, pl.DataFrame, pl.DataFrame]]]:
+    # The stations are matched with their ids by the main process, for all the buffered tasks at once
+    return file_hash(source), list(
+        read_dext3r_archives(
+            [source], _worker_inputs["payloads"], None, _worker_inputs["periods"]
+        )
+    )
+
+
+def ingest_archives(
+    sources: list[str | Path],
+    output_path: str | Path,
+    base: str | Path,
+    payloads_path: str | Path,
+    workers: Optional[int] = None,
+    max_pending: Optional[int] = None,
+    flush_rows: int = 2_000_000,
+    manifest_path: Optional[str | Path] = None,
+    force: bool = False,
+    line_limit: int = LINE_LIMIT,
+) -> dict[str, Any]:
+    """
+    Reads Dext3r results with a pool of processes and merges their data into the measurement store at `output_path`
+    (see `write_measurements`).
+
+    Each worker loads the payloads once. At most `max_pending` results are waiting to be
+    written at any time, so memory stays bounded when the workers are faster than the writer. The data is merged into
+    the store every `flush_rows` rows, so that each partition is rewritten a few times only. The station ids of the
+    buffered tasks are resolved right before, with a single join (see `StationResolver`). Errors are collected per
+    source instead of stopping the ingestion. The station metadata of the tasks is merged into the store as well (see
+    `write_task_metas`).
+
+    With a manifest, only new or changed sources are read: see `select_sources`. When a task is read again, its
+    previous rows are replaced in the store with the next merge, and the manifest is rewritten once per merge.
+
+    Truncated and partial results are detected (see `task_problem`): their tables are ingested, and they are reported so
+    that their missing periods can be requested again. Their manifest status is "partial". The short tables of each
+    task are recorded in the manifest: a shortfall already found by a task requesting the same station and variable
+    over a period containing the new one, e.g. a gap at the end of the station data, is not reported again.
+
+    Args:
+        sources (list[str | Path]): The ZIP archives or CSV result files.
+        output_path (str | Path): The root directory of the measurement store.
+        base (str | Path): The directory containing station_infos.json.
+        payloads_path (str | Path): The payloads file (payloads.json or the ledger payloads.jsonl).
+        workers (int, optional): The number of processes. Defaults to the number of CPUs.
+        max_pending (int, optional): The maximum number of sources being processed or waiting to be written. Defaults to twice the number of workers.
+        flush_rows (int, optional): The number of buffered rows that triggers a merge into the store. Defaults to 2,000,000.
+        manifest_path (str | Path, optional): The ingestion manifest. Defaults to None, reading every source.
+        force (bool, optional): Whether to read every source even if the manifest says it is unchanged. Defaults to False.
+        line_limit (int, optional): The line limit of the requests, reached by truncated results. Defaults to `LINE_LIMIT`.
+
+    Returns:
+        dict[str, Any]: "metas", the station metadata of the tasks read, "tasks" and "rows", the number of tasks and
+            data rows written, "skipped", the tasks left unchanged, "failures", the (source, error) pairs of the
+            sources that could not be read, and "partial", the (task, problem) pairs of the truncated or partial results.
+    """
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    workers = workers or multiprocessing.cpu_count()
+    max_pending = max_pending or 2 * workers
+    sources = [Path(s) for s in sources]
+    metas = []
+    failures = []
+    partial = []
+    # Tasks read and not written yet, with their station names
+    buffer_metas = []
+    buffer = []
+    # Manifest entries of the buffered tasks
+    buffer_entries = {}
+    # Partition files of the previous rows of the buffered tasks read again
+    replaced: dict[str, list[str]] = {}
+    n_tasks = 0
+    n_rows = 0
+    skipped = []
+    manifest = {}
+    payloads = read_payloads(payloads_path)
+    periods = read_request_periods(payloads_path)
+    stations = list_available_stations(Path(base))
+    resolver = StationResolver(stations)
+    station_digests = StationDigests(stations)
+    if manifest_path is not None:
+        manifest = read_manifest(manifest_path)
+        if not force:
+            sources, skipped = select_sources(
+                sources, manifest, payloads, station_digests
+            )
+    # The tasks and requested periods of the short tables recorded, by normalized station name and variable name
+    shortfalls: dict[tuple[str, str], list[tuple]] = {}
+
+    def add_shortfalls(task: str, series: list[tuple[str, str]]):
+        for key in series:
+            if key in periods.get(task, {}):
+                shortfalls.setdefault(key, []).append((task, *periods[task][key]))
+
+    def known_shortfalls(task: str, series: list[tuple[str, str]]) -> set:
+        requested = periods.get(task, {})
+        return {
+            key
+            for key in series
+            if key in requested
+            and any(
+                other != task
+                and start <= requested[key][0]
+                and requested[key][1] <= end
+                for other, start, end in shortfalls.get(key, [])
+            )
+        }
+
+    for task, entry in manifest.items():
+        add_shortfalls(
+            task, [(s["name"], s["variable"]) for s in entry.get("short_tables") or []]
+        )
+
+    def record(source: Path, task: str, hash: str, **outcome) -> dict[str, Any]:
+        try:
+            stat = source.stat()
+        except OSError:
+            # E.g. a source removed before being read, recorded as failed
+            stat = None
+        payload = payloads.get(task)
+        return {
+            "task": task,
+            "source": str(source),
+            "size": stat.st_size if stat is not None else None,
+            "mtime": stat.st_mtime if stat is not None else None,
+            "hash": hash,
+            "payload_digest": payload_digest(payload),
+            "stations_digest": station_digests(payload),
+            "partitions": [],
+            "rows": 0,
+            "error": None,
+            "short_tables": [],
+        } | outcome
+
+    def flush():
+        nonlocal n_rows
+        if buffer:
+            meta, data = resolver.resolve_tasks(
+                pl.concat(buffer_metas, how="diagonal_relaxed"),
+                pl.concat(buffer, how="vertical"),
+                payloads,
+            )
+            # The previous rows of the tasks read again are replaced as the partitions are rewritten, each partition
+            # file staying consistent if the ingestion stops
+            write_measurements(
+                output_path,
+                data,
+                list(replaced),
+                sorted({file for files in replaced.values() for file in files}),
+            )
+            if not meta.is_empty():
+                write_task_metas(output_path, meta)
+                metas.append(meta)
+            n_rows += len(data)
+            for task, rows in data.group_by("task").len().iter_rows():
+                status = "partial" if buffer_entries[task]["error"] else "ok"
+                buffer_entries[task] |= {"rows": rows, "status": status}
+            buffer_metas.clear()
+            buffer.clear()
+            replaced.clear()
+        if manifest_path is not None:
+            manifest.update(buffer_entries)
+            write_manifest(manifest_path, manifest)
+        buffer_entries.clear()
+
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(Path(payloads_path),),
+    ) as pool:
+        pending: dict[Future, Path] = {}
+        remaining = iter(sources)
+        while True:
+            for source in remaining:
+                pending[pool.submit(_read_source, source)] = source
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source = pending.pop(future)
+                try:
+                    hash, results = future.result()
+                except Exception as e:
+                    error = "".join(traceback.format_exception_only(e)).strip()
+                    failures.append((str(source), error))
+                    task = task_from_name(source.name)
+                    buffer_entries[task] = record(
+                        source, task, None, status="failed", error=error
+                    )
+                    continue
+                for task, meta, data in results:
+                    if task in manifest:
+                        # The previous rows of the task could be wrong, e.g. joined with outdated station ids
+                        replaced[task] = manifest.pop(task)["partitions"]
+                    short = short_series(meta)
+                    problem = task_problem(
+                        meta, line_limit, known_shortfalls(task, short)
+                    )
+                    if problem is not None:
+                        partial.append((task, problem))
+                    add_shortfalls(task, short)
+                    buffer.append(data)
+                    buffer_metas.append(meta)
+                    n_tasks += 1
+                    # The rows and the status are updated once the stations are resolved
+                    buffer_entries[task] = record(
+                        source,
+                        task,
+                        hash,
+                        partitions=[str(p) for p in task_partitions(output_path, data)],
+                        status="partial" if problem is not None else "empty",
+                        error=problem,
+                        short_tables=[
+                            {"name": name, "variable": variable}
+                            for name, variable in short
+                        ],
+                    )
+            if sum(len(data) for data in buffer) >= flush_rows:
+                flush()
+        flush()
+
+    return {
+        "metas": pl.concat(metas, how="diagonal_relaxed") if metas else pl.DataFrame(),
+        "tasks": n_tasks,
+        "rows": n_rows,
+        "skipped": skipped,
+        "failures": failures,
+        "partial": partial,
+    }
@@ -0,0 +1,249 @@
+import json
+import os
+from collections.abc import Mapping
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Iterator
+
+import polars as pl
+
+from .requests import dformat
+
+REQUEST_SCHEMA = {
+    "task_id": pl.Utf8(),
+    "name": pl.Utf8(),
+    "id": pl.Utf8(),
+    "v": pl.Utf8(),
+    "from": pl.Date(),
+    "to": pl.Date(),
+    "count": pl.Int32(),
+    "timeline_section": pl.Int32(),
+    "agg_period": pl.Int32(),
+}
+PAYLOAD_SCHEMA = {
+    "task_id": pl.Utf8(),
+    "email": pl.Utf8(),
+    "begin_datetime": pl.Utf8(),
+    "end_datetime": pl.Utf8(),
+    "variable": pl.List(pl.Utf8()),
+    "station": pl.List(pl.Utf8()),
+    "fmt": pl.Utf8(),
+    "request_time": pl.Utf8(),
+}
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value)}")
+
+
+def _repair(path: Path):
+    # Drops a partial line left by a crash in the middle of an append
+    if not path.exists():
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        chunk = 4096
+        end = size
+        while end > 0:
+            start = max(0, end - chunk)
+            f.seek(start)
+            last_newline = f.read(end - start).rfind(b"\n")
+            if last_newline >= 0:
+                f.truncate(start + last_newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def _payload_record(task_id: str, payload: dict[str, Any]) -> dict[str, Any]:
+    record = {"task_id": task_id} | payload
+    for key in ("variable", "station"):
+        if isinstance(record.get(key), str):
+            record[key] = [record[key]]
+    return record
+
+
+def _write_lines(path: Path, records: list[dict[str, Any]], mode: str = "ab"):
+    data = "".join(
+        json.dumps(r, default=_json_default, ensure_ascii=False) + "\n" for r in records
+    ).encode()
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _append_lines(path: Path, records: list[dict[str, Any]]):
+    _write_lines(path, records, "ab")
+
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_suffix(path.suffix + ".tmp")
+
+
+def _replace(path: Path, frame: pl.DataFrame):
+    # Atomic rewrite: the new content is synced to a temporary file that replaces the old one
+    tmp_path = _tmp_path(path)
+    frame.write_ndjson(tmp_path)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _sync_directory(path)
+
+
+def _sync_directory(path: Path):
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(path.parent, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class Payloads(Mapping):
+    """
+    Read-only mapping from task id to payload, backed by a polars DataFrame. Payload dictionaries are built only when
+    accessed.
+    """
+
+    def __init__(self, frame: pl.DataFrame):
+        self.frame = frame
+        self.index = {task: i for i, task in enumerate(frame["task_id"].to_list())}
+
+    def __getitem__(self, task_id: str) -> dict[str, Any]:
+        row = self.frame.row(self.index[task_id], named=True)
+        del row["task_id"]
+        return row
+
+    def __contains__(self, task_id) -> bool:
+        return task_id in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+class TaskLedger:
+    """
+    Append-only record of the tasks sent to Dext3r, made of two JSON lines files: one line per request queue element
+    (with its task id) and one line per task payload. Appends are synced to disk, and a partial line left by a crash is
+    dropped when the ledger is opened.
+
+    Args:
+        requests_path (str | Path): The path of the queue elements file.
+        payloads_path (str | Path): The path of the payloads file.
+    """
+
+    def __init__(self, requests_path: str | Path, payloads_path: str | Path):
+        self.requests_path = Path(requests_path)
+        self.payloads_path = Path(payloads_path)
+        _repair(self.requests_path)
+        _repair(self.payloads_path)
+
+    def append(
+        self, task_id: str, stations: list[dict[str, Any]], payload: dict[str, Any]
+    ):
+        """
+        Records a task. The payload is written first, so that a crash never leaves queue elements without payload.
+
+        Args:
+            task_id (str): The task id returned by Dext3r.
+            stations (list[dict[str, Any]]): The queue elements requested by the task.
+            payload (dict[str, Any]): The payload of the request.
+        """
+        self.append_payload(task_id, payload)
+        self.append_requests(task_id, stations)
+
+    def append_payload(self, task_id: str, payload: dict[str, Any]):
+        record = _payload_record(task_id, payload)
+        record["request_time"] = datetime.now().strftime(dformat)
+        _append_lines(self.payloads_path, [record])
+
+    def append_requests(self, task_id: str, stations: list[dict[str, Any]]):
+        _append_lines(
+            self.requests_path,
+            [
+                {"task_id": task_id}
+                | {key: s[key] for key in REQUEST_SCHEMA if key != "task_id"}
+                for s in stations
+            ],
+        )
+
+    def scan_requests(self) -> pl.LazyFrame:
+        if not self.requests_path.exists() or self.requests_path.stat().st_size == 0:
+            return pl.LazyFrame(schema=REQUEST_SCHEMA)
+        return pl.scan_ndjson(self.requests_path, schema=REQUEST_SCHEMA)
+
+    def scan_payloads(self) -> pl.LazyFrame:
+        if not self.payloads_path.exists() or self.payloads_path.stat().st_size == 0:
+            return pl.LazyFrame(schema=PAYLOAD_SCHEMA)
+        return pl.scan_ndjson(self.payloads_path, schema=PAYLOAD_SCHEMA)
+
+    def read_payloads(self) -> Payloads:
+        return Payloads(
+            self.scan_payloads()
+            .unique("task_id", keep="last", maintain_order=True)
+            .collect()
+        )
+
+    def compact(self) -> dict[str, int]:
+        """
+        Rewrites the ledger atomically, dropping the records that are exact duplicates of another one, and the payloads
+        replaced by a later payload of the same task.
+
+        Returns:
+            dict[str, int]: The records dropped from the "requests" and the "payloads" files.
+        """
+        requests = self.scan_requests().collect()
+        payloads = self.scan_payloads().collect()
+        unique_requests = requests.unique(keep="last", maintain_order=True)
+        unique_payloads = payloads.unique("task_id", keep="last", maintain_order=True)
+        _replace(self.requests_path, unique_requests)
+        _replace(self.payloads_path, unique_payloads)
+        return {
+            "requests": len(requests) - len(unique_requests),
+            "payloads": len(payloads) - len(unique_payloads),
+        }
+
+    def import_legacy(self, requests_csv: str | Path, payloads_json: str | Path):
+        """
+        Imports the records of the former requests.csv and payloads.json files, if the ledger is still empty.
+
+        Both files are written to temporary files first, then the requests file and last the payloads file are moved in
+        place. The ledger counts as imported only when its payloads file exists, so an import interrupted in between is
+        done again on the next run.
+        """
+        requests_csv, payloads_json = Path(requests_csv), Path(payloads_json)
+        if self.payloads_path.exists():
+            return
+        if not (requests_csv.exists() or payloads_json.exists()):
+            return
+        payloads = {}
+        if payloads_json.exists():
+            with open(payloads_json, "rt") as f:
+                payloads = json.load(f)
+        requests = []
+        if requests_csv.exists():
+            requests = (
+                pl.read_csv(requests_csv, schema_overrides=REQUEST_SCHEMA)
+                .select(list(REQUEST_SCHEMA))
+                .to_dicts()
+            )
+        _write_lines(_tmp_path(self.requests_path), requests, "wb")
+        _write_lines(
+            _tmp_path(self.payloads_path),
+            [_payload_record(task_id, p) for task_id, p in payloads.items()],
+            "wb",
+        )
+        os.replace(_tmp_path(self.requests_path), self.requests_path)
+        os.replace(_tmp_path(self.payloads_path), self.payloads_path)
+        _sync_directory(self.payloads_path)
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Mapping
+
+import polars as pl
+
+from .read import task_from_name
+
+MANIFEST_SCHEMA = {
+    "task": pl.Utf8(),
+    "source": pl.Utf8(),
+    "size": pl.Int64(),
+    "mtime": pl.Float64(),
+    "hash": pl.Utf8(),
+    "payload_digest": pl.Utf8(),
+    "stations_digest": pl.Utf8(),
+    "partitions": pl.List(pl.Utf8()),
+    "rows": pl.Int64(),
+    "status": pl.Utf8(),
+    "error": pl.Utf8(),
+    # The tables shorter than the requested period, by normalized station name and variable name
+    "short_tables": pl.List(pl.Struct({"name": pl.Utf8(), "variable": pl.Utf8()})),
+}
+
+
+def file_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def payload_digest(payload: Mapping[str, Any] | None) -> str:
+    if payload is None:
+        return ""
+    # The request time does not change how a task is read
+    content = {k: v for k, v in dict(payload).items() if k != "request_time"}
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class StationDigests:
+    """
+    Digests of the station metadata that the reading of a task depends on: the stations of its payload or, without
+    payload, all of them.
+    """
+
+    def __init__(self, stations_metadata: pl.DataFrame):
+        ids = stations_metadata["id"].cast(pl.Utf8()).to_list()
+        rows = stations_metadata.select(
+            pl.concat_str(pl.all().cast(pl.Utf8()).fill_null(""), separator="\x1f")
+        ).to_series()
+        self.rows = dict(zip(ids, rows.to_list()))
+        self.all = self._digest(sorted(self.rows))
+
+    def _digest(self, ids) -> str:
+        digest = hashlib.sha1()
+        for i in ids:
+            digest.update(self.rows.get(i, "").encode())
+            digest.update(b"\x1e")
+        return digest.hexdigest()
+
+    def __call__(self, payload: Mapping[str, Any] | None) -> str:
+        if payload is None:
+            return self.all
+        return self._digest(sorted(str(i) for i in payload["station"]))
+
+
+def read_manifest(path: Path) -> dict[str, dict[str, Any]]:
+    """
+    Reads the ingestion manifest as a dictionary from task id to entry.
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    return {entry["task"]: entry for entry in pl.read_parquet(path).to_dicts()}
+
+
+def write_manifest(path: Path, entries: dict[str, dict[str, Any]]):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".parquet.tmp")
+    pl.DataFrame(list(entries.values()), schema=MANIFEST_SCHEMA).write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def select_sources(
+    sources: list[Path],
+    manifest: dict[str, dict[str, Any]],
+    payloads: Mapping[str, Any],
+    station_digests: StationDigests,
+) -> tuple[list[Path], list[str]]:
+    """
+    Compares the sources with the manifest.
+
+    A source is skipped if its task was ingested from an identical file (same size and modification time, or same
+    content hash) with the same payload and station metadata. Sources whose file is unchanged but whose hash had to be
+    computed have their manifest entry refreshed.
+
+    Returns:
+        tuple[list[Path], list[str]]: The sources to ingest and the tasks that were skipped.
+    """
+    to_ingest = []
+    skipped = []
+    for source in sources:
+        task = task_from_name(source.name)
+        entry = manifest.get(task)
+        if entry is None or entry["source"] != str(source):
+            to_ingest.append(source)
+            continue
+        payload = payloads.get(task)
+        same_payload = entry["payload_digest"] == payload_digest(payload)
+        same_stations = entry["stations_digest"] == station_digests(payload)
+        if not (same_payload and same_stations):
+            to_ingest.append(source)
+            continue
+        stat = source.stat()
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            skipped.append(task)
+        elif entry["size"] == stat.st_size and entry["hash"] == file_hash(source):
+            entry["mtime"] = stat.st_mtime
+            skipped.append(task)
+        else:
+            to_ingest.append(source)
+    return to_ingest, skipped
@@ -1,56 +1,113 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 import polars as pl
 from pathlib import Path
-import requests
+
+from .transport import Transport, default_transport
 
 base = Path(__file__).parent.parent
 
 
-def download_available_stations(base: Path):
+def _tmp_path(path: Path) -> Path:
+    return path.with_suffix(path.suffix + ".tmp")
+
+
+def _write_text_atomic(path: Path, text: str):
+    # Readers, e.g. another process sharing the workspace, never see a partially written file
+    tmp_path = _tmp_path(path)
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+def _conditional_download(
+    base: Path,
+    path: str,
+    file_name: str,
+    transport: Optional[Transport],
+    validators: Optional[dict[str, str]],
+) -> Optional[dict[str, str]]:
+    # Downloads path to base/file_name unless the remote reports it as not modified since the given validators.
+    # Returns the validators of the new content, or None if it was not modified.
+    transport = transport or default_transport()
+    headers = {}
+    if validators and (base / file_name).exists():
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    response = transport.get(path, headers=headers)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    _write_text_atomic(base / file_name, response.text)
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def download_available_stations(
+    base: Path,
+    transport: Optional[Transport] = None,
+    validators: Optional[dict[str, str]] = None,
+) -> Optional[dict[str, str]]:
     """
     Downloads the available station information and saves it to station_infos.json.
 
     Args:
         base (Path): The base path to the data directory.
+        transport (Transport, optional): The transport to use. Defaults to the shared production one.
+        validators (dict[str, str], optional): The "etag" and "last_modified" headers of the last download. If given, the file is downloaded only if it changed since then. Defaults to None.
 
     Returns:
-        None
+        Optional[dict[str, str]]: The validators of the downloaded file, or None if it was not modified.
     """
-    station_infos = requests.get("https://simc.arpae.it/meteozen/rt_data/stations").text
-    (base / "station_infos.json").write_text(station_infos)
+    return _conditional_download(
+        base, "rt_data/stations", "station_infos.json", transport, validators
+    )
 
 
-def download_available_series(base: Path):
+def download_available_series(
+    base: Path,
+    transport: Optional[Transport] = None,
+    validators: Optional[dict[str, str]] = None,
+) -> Optional[dict[str, str]]:
     """
     Requests the available Dext3r series and saves it to to series_infos.json.
 
     Args:
         base (Path): The base path to the data directory.
+        transport (Transport, optional): The transport to use. Defaults to the shared production one.
+        validators (dict[str, str], optional): The "etag" and "last_modified" headers of the last download. If given, the file is downloaded only if it changed since then. Defaults to None.
 
     Returns:
-        None
+        Optional[dict[str, str]]: The validators of the downloaded file, or None if it was not modified.
     """
-    series_infos = requests.get(
-        "https://simc.arpae.it/meteozen/rt_data/archivesummary"
-    ).text
-    (base / "series_infos.json").write_text(series_infos)
+    return _conditional_download(
+        base, "rt_data/archivesummary", "series_infos.json", transport, validators
+    )
 
 
-def list_available_series(base: Path, force_request=False) -> pl.DataFrame:
+def list_available_series(
+    base: Path, force_request=False, transport: Optional[Transport] = None
+) -> pl.DataFrame:
     """
     Retrieves the available series information.
 
     Args:
         base (Path): The base path to the data directory.
         force_request (bool, optional): If True, forces the download of the available series information even if it already exists. Defaults to False.
+        transport (Transport, optional): The transport to use for downloading. Defaults to the shared production one.
 
     Returns:
         polars.DataFrame: A DataFrame containing the available series information.
     """
     data_path = base / "series_infos.json"
     if (not data_path.exists()) or force_request:
-        download_available_series(base)
+        download_available_series(base, transport)
     series_info = (
         pl.read_json(data_path)
         .rename({"variable": "v"})
@@ -78,10 +135,12 @@ def list_available_series(base: Path, force_request=False) -> pl.DataFrame:
     return series_info
 
 
-def list_available_stations(base: Path, force_request=False) -> pl.DataFrame:
+def list_available_stations(
+    base: Path, force_request=False, transport: Optional[Transport] = None
+) -> pl.DataFrame:
     data_path = Path(base / "station_infos.json")
     if (not data_path.exists()) or force_request:
-        download_available_stations(base)
+        download_available_stations(base, transport)
     return pl.read_json(data_path)
 
 
@@ -99,10 +158,99 @@ def load_series_meta(variable, path, all, force_request=False):
     return stations.join(part, left_on="id", right_on="station", how="inner")
 
 
-def list_available_meta(base: Path, force_request=False):
-    return list_available_stations(base, force_request).join(
-        list_available_series(base, force_request),
+def _join_meta(base: Path) -> pl.DataFrame:
+    return list_available_stations(base).join(
+        list_available_series(base),
         left_on="id",
         right_on="station",
         how="inner",
     )
+
+
+# Parsed metadata by workspace: (fetch time, table)
+_meta_memo: dict[Path, tuple[str, pl.DataFrame]] = {}
+
+
+def _read_meta_info(base: Path) -> dict:
+    info_path = base / "available_meta.json"
+    if info_path.exists():
+        return json.loads(info_path.read_text())
+    # Workspaces created before the cache: their files count as fetched when they were last written
+    files = [base / "station_infos.json", base / "series_infos.json"]
+    if all(f.exists() for f in files):
+        mtime = min(f.stat().st_mtime for f in files)
+        return {"fetched_at": datetime.fromtimestamp(mtime, timezone.utc).isoformat()}
+    return {}
+
+
+def _cached_meta(base: Path, info: dict) -> pl.DataFrame:
+    memo = _meta_memo.get(base.resolve())
+    if memo is None or memo[0] != info["fetched_at"]:
+        memo = (info["fetched_at"], pl.read_parquet(base / "available_meta.parquet"))
+        _meta_memo[base.resolve()] = memo
+    return memo[1]
+
+
+def _store_meta(base: Path, info: dict) -> pl.DataFrame:
+    meta = _join_meta(base)
+    # The table is replaced before its info, which tells that it is up to date
+    tmp_path = _tmp_path(base / "available_meta.parquet")
+    meta.write_parquet(tmp_path)
+    os.replace(tmp_path, base / "available_meta.parquet")
+    _write_text_atomic(base / "available_meta.json", json.dumps(info))
+    _meta_memo[base.resolve()] = (info["fetched_at"], meta)
+    return meta
+
+
+def list_available_meta(
+    base: Path,
+    force_request=False,
+    transport: Optional[Transport] = None,
+    ttl: Optional[timedelta] = timedelta(days=1),
+) -> pl.DataFrame:
+    """
+    Retrieves the available series joined with their station information.
+
+    The joined table is cached in available_meta.parquet, with its fetch time and the ETag/Last-Modified headers of the
+    remote files in available_meta.json, and memoized in the process. Once the cache is older than `ttl`, the remote
+    files are requested again, conditionally if the remote sent validators: if they did not change, the cache is kept.
+
+    Args:
+        base (Path): The base path to the data directory.
+        force_request (bool, optional): If True, downloads the information again, unconditionally. Defaults to False.
+        transport (Transport, optional): The transport to use for downloading. Defaults to the shared production one.
+        ttl (timedelta, optional): How long the cached information is used before checking for updates. None never expires it. Defaults to one day.
+
+    Returns:
+        pl.DataFrame: The series information joined with the station information.
+    """
+    base = Path(base)
+    info = _read_meta_info(base)
+    now = datetime.now(timezone.utc)
+    fresh = (
+        not force_request
+        and "fetched_at" in info
+        and (ttl is None or now - datetime.fromisoformat(info["fetched_at"]) < ttl)
+    )
+    if fresh:
+        if (base / "available_meta.parquet").exists():
+            return _cached_meta(base, info)
+        return _store_meta(base, info)
+
+    validators = {} if force_request else info
+    stations = download_available_stations(base, transport, validators.get("stations"))
+    series = download_available_series(base, transport, validators.get("series"))
+    info = {
+        "fetched_at": now.isoformat(),
+        "stations": stations or info.get("stations"),
+        "series": series or info.get("series"),
+    }
+    if stations is None and series is None:
+        # Not modified: the cache is still valid
+        _write_text_atomic(base / "available_meta.json", json.dumps(info))
+        memo = _meta_memo.get(base.resolve())
+        if memo is not None:
+            _meta_memo[base.resolve()] = (info["fetched_at"], memo[1])
+        if (base / "available_meta.parquet").exists():
+            return _cached_meta(base, info)
+    return _store_meta(base, info)
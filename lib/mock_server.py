@@ -0,0 +1,386 @@
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import uuid
+import zipfile
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep, monotonic
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlparse
+
+from .requests import dformat
+from .spatial import COORDINATE_SCALE
+
+
+def payload_lines(payload: dict[str, list[str]]) -> int:
+    """
+    Computes the number of lines of a data request, the same way the line limit is checked by the mock server.
+
+    Args:
+        payload (dict[str, list[str]]): The parsed query string of the request.
+
+    Returns:
+        int: The number of result lines of the request.
+    """
+    begin = datetime.strptime(payload["begin_datetime"][0], dformat)
+    end = datetime.strptime(payload["end_datetime"][0], dformat)
+    lines = 0
+    for variable in payload["variable"]:
+        agg_period = int(re.match(r"\d+,\d+,(\d+)/", variable).group(1))
+        lines += int((end - begin).total_seconds()) // agg_period
+    return lines * len(payload["station"])
+
+
+META_HEADER = [
+    "Nome della stazione",
+    "Rete di misura",
+    "Comune",
+    "Provincia",
+    "Regione",
+    "Nazione",
+    "Altezza (Metri sul livello del mare)",
+    "Longitudine (Gradi Centesimali)",
+    "Latitudine (Gradi Centesimali)",
+    "Bacino",
+]
+
+
+def variable_header(variable: str) -> str:
+    if variable.endswith("B13011"):
+        return "Precipitazione cumulata (KG/M**2)"
+    if variable.endswith("B12101"):
+        kind = "minima" if variable.startswith("3,") else "massima"
+        return f"Temperatura {kind} dell'aria (C)"
+    return f"Variabile {variable}"
+
+
+def dext3r_csv(
+    payload: dict[str, list[str]],
+    stations: list[dict[str, Any]],
+    rng: Optional[random.Random] = None,
+    ragged_rate: float = 0.0,
+    empty_rate: float = 0.0,
+    truncate_lines: Optional[int] = None,
+) -> str:
+    """
+    Builds a result file in the Dext3r CSV format for a data request: a title line, one table per station and
+    variable, the station metadata table and a closing note, separated by blank lines.
+
+    Args:
+        payload (dict[str, list[str]]): The parsed query string of the request.
+        stations (list[dict[str, Any]]): The content of station_infos.json.
+        rng (random.Random, optional): The source of the values. Defaults to a new generator.
+        ragged_rate (float, optional): The probability that a data line has a trailing extra field. Defaults to 0.
+        empty_rate (float, optional): The probability that a table has no data lines. Defaults to 0.
+        truncate_lines (int, optional): The data lines after which the tables are cut. Defaults to None.
+
+    Returns:
+        str: The content of the result file.
+    """
+    rng = rng or random.Random()
+    begin = datetime.strptime(payload["begin_datetime"][0], dformat).replace(
+        tzinfo=timezone.utc
+    )
+    end = datetime.strptime(payload["end_datetime"][0], dformat).replace(
+        tzinfo=timezone.utc
+    )
+    by_id = {str(s["id"]): s for s in stations}
+    requested = [by_id[i] for i in payload["station"] if i in by_id]
+    tables = ["Dext3r - Arpae Emilia-Romagna"]
+    written = 0
+    for station in requested:
+        for variable in payload["variable"]:
+            step = timedelta(
+                seconds=int(re.match(r"\d+,\d+,(\d+)/", variable).group(1))
+            )
+            rows = [station["name"], f"Inizio,Fine,{variable_header(variable)}"]
+            start = begin
+            if empty_rate > 0 and rng.random() < empty_rate:
+                start = end
+            while start < end:
+                if truncate_lines is not None and written >= truncate_lines:
+                    break
+                written += 1
+                value = round(rng.uniform(-5, 35), 1) if rng.random() > 0.02 else ""
+                line = f"{start:%Y-%m-%d %H:%M:%S}+00:00,{start + step:%Y-%m-%d %H:%M:%S}+00:00,{value}"
+                if ragged_rate > 0 and rng.random() < ragged_rate:
+                    line += ","
+                rows.append(line)
+                start += step
+            tables.append("\n".join(rows))
+    meta = [",".join(META_HEADER)]
+    for station in requested:
+        meta.append(
+            ",".join(
+                [
+                    station["name"],
+                    station.get("network", ""),
+                    "",
+                    "",
+                    "Emilia-Romagna",
+                    "Italia",
+                    str(station.get("height", "")),
+                    str(station.get("lon", 0) / COORDINATE_SCALE),
+                    str(station.get("lat", 0) / COORDINATE_SCALE),
+                    "",
+                ]
+            )
+        )
+    tables.append("\n".join(meta))
+    tables.append("Dati forniti da Arpae Emilia-Romagna")
+    return "\n\n".join(tables) + "\n"
+
+
+class MockDext3r:
+    """
+    Local stand-in for the Dext3r service, to exercise the downloader offline.
+
+    It serves `/rt_data/stations`, `/rt_data/archivesummary` and `/debra/api/data` (under the same root as the production
+    service). Data requests are answered with a new task id, after checking the line limit. The status and the result
+    archive of the tasks are served at the paths used by `lib.retrieve`. Use it as a context manager and pass
+    `Transport(server.base_url)` to the downloader.
+
+    Args:
+        stations (list[dict[str, Any]]): The content of station_infos.json.
+        series (list[dict[str, Any]]): The content of series_infos.json.
+        latency (float | tuple[float, float], optional): The response latency in seconds, or its uniform range. Defaults to 0.
+        error_rates (dict[int, float], optional): The probability of answering a data request with each error status code, e.g. {429: 0.1, 503: 0.05}. Defaults to no errors.
+        max_lines (int, optional): The line limit of data requests. Defaults to 25000, as the production service.
+        seed (int, optional): The seed of the error injection. Defaults to None.
+        completion_delay (float, optional): The seconds after which a task is completed. Defaults to 0.
+        failure_rate (float, optional): The probability that a task fails. Defaults to 0.
+        port (int, optional): The port to listen on. Defaults to a free one.
+        truncate_lines (int, optional): The data lines after which the result files are cut, as the production service
+            does past its line limit. Defaults to None.
+        quota (int, optional): The data requests accepted from each email address; the next ones are refused with 403.
+            Defaults to None (no quota).
+    """
+
+    def __init__(
+        self,
+        stations: list[dict[str, Any]],
+        series: list[dict[str, Any]],
+        latency: float | tuple[float, float] = 0.0,
+        error_rates: Optional[dict[int, float]] = None,
+        max_lines: int = 25000,
+        seed: Optional[int] = None,
+        completion_delay: float = 0.0,
+        failure_rate: float = 0.0,
+        port: int = 0,
+        quota: Optional[int] = None,
+        truncate_lines: Optional[int] = None,
+    ):
+        self.stations = stations
+        self.series = series
+        self.latency = latency
+        self.error_rates = error_rates or {}
+        self.max_lines = max_lines
+        self.random = random.Random(seed)
+        self.completion_delay = completion_delay
+        self.failure_rate = failure_rate
+        self.quota = quota
+        self.truncate_lines = truncate_lines
+        # Accepted data requests by email address
+        self.usage: dict[str, int] = {}
+        self.lock = threading.Lock()
+        # Accepted data requests by task id
+        self.tasks: dict[str, dict[str, list[str]]] = {}
+        # Submission time and failure of the tasks
+        self.task_states: dict[str, tuple[float, bool]] = {}
+        self.archives: dict[str, bytes] = {}
+        # (path, status code) of every request received
+        self.log: list[tuple[str, int]] = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.thread = None
+
+    @classmethod
+    def from_workspace(cls, base: Path, **kwargs):
+        """
+        Serves the metadata stored in a workspace (station_infos.json and series_infos.json).
+        """
+        base = Path(base)
+        return cls(
+            json.loads((base / "station_infos.json").read_text()),
+            json.loads((base / "series_infos.json").read_text()),
+            **kwargs,
+        )
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/meteozen"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _delay(self):
+        if isinstance(self.latency, tuple):
+            with self.lock:
+                delay = self.random.uniform(*self.latency)
+        else:
+            delay = self.latency
+        if delay > 0:
+            sleep(delay)
+
+    def _injected_error(self) -> Optional[int]:
+        with self.lock:
+            draw = self.random.random()
+        for status, rate in self.error_rates.items():
+            if draw < rate:
+                return status
+            draw -= rate
+        return None
+
+    def handle(self, path: str, query: dict[str, list[str]]) -> tuple[int, Any]:
+        """
+        Answers a request, returning the status code and the JSON content.
+        """
+        path = path.removeprefix("/meteozen")
+        if path == "/rt_data/stations":
+            return 200, self.stations
+        if path == "/rt_data/archivesummary":
+            return 200, self.series
+        if path == "/debra/api/data":
+            status = self._injected_error()
+            if status is not None:
+                return status, {"detail": f"Injected error {status}"}
+            try:
+                lines = payload_lines(query)
+            except (KeyError, ValueError, AttributeError) as e:
+                return 422, {"detail": f"Invalid request: {e}"}
+            if lines > self.max_lines:
+                return 400, {
+                    "detail": f"Too many lines requested: {lines} > {self.max_lines}"
+                }
+            email = query.get("email", [""])[0]
+            task = str(uuid.uuid4())
+            with self.lock:
+                if self.quota is not None and self.usage.get(email, 0) >= self.quota:
+                    return 403, {"detail": "Quota exceeded"}
+                self.usage[email] = self.usage.get(email, 0) + 1
+                self.tasks[task] = query
+                failed = self.random.random() < self.failure_rate
+                self.task_states[task] = (monotonic(), failed)
+            return 200, {"task": task}
+        match = re.fullmatch(r"/debra/api/tasks/([^/]+)", path)
+        if match:
+            status = self.task_status(match.group(1))
+            if status is None:
+                return 404, {"detail": "Unknown task"}
+            return 200, {"task": match.group(1), "status": status}
+        return 404, {"detail": "Not found"}
+
+    def task_status(self, task: str) -> Optional[str]:
+        if task not in self.task_states:
+            return None
+        submitted, failed = self.task_states[task]
+        if monotonic() - submitted < self.completion_delay:
+            return "pending"
+        return "failed" if failed else "completed"
+
+    def archive(self, task: str) -> bytes:
+        """
+        Returns the result archive of a task, built on first access.
+        """
+        with self.lock:
+            if task not in self.archives:
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+                    z.writestr(
+                        f"dexter-{task}.csv",
+                        dext3r_csv(
+                            self.tasks[task],
+                            self.stations,
+                            self.random,
+                            truncate_lines=self.truncate_lines,
+                        ),
+                    )
+                self.archives[task] = buffer.getvalue()
+            return self.archives[task]
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                mock._delay()
+                match = re.fullmatch(
+                    r"(?:/meteozen)?/debra/api/tasks/([^/]+)/archive", url.path
+                )
+                if match:
+                    return self._send_archive(match.group(1), url.path)
+                status, content = mock.handle(url.path, parse_qs(url.query))
+                with mock.lock:
+                    mock.log.append((url.path, status))
+                body = json.dumps(content).encode()
+                # The metadata is versioned with an ETag, to exercise conditional requests
+                etag = None
+                if url.path.endswith(("/rt_data/stations", "/rt_data/archivesummary")):
+                    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        status, body = 304, b""
+                        with mock.lock:
+                            mock.log[-1] = (url.path, status)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_archive(self, task, path):
+                if mock.task_status(task) != "completed":
+                    status = 404
+                    body = b'{"detail": "Archive not available"}'
+                    content_type = "application/json"
+                else:
+                    body = mock.archive(task)
+                    status = 200
+                    content_type = "application/zip"
+                    # Supports resuming partial downloads
+                    match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+                    if match and int(match.group(1)) >= len(body):
+                        status = 416
+                        content_range = f"bytes */{len(body)}"
+                        body = b""
+                    elif match:
+                        status = 206
+                        content_range = (
+                            f"bytes {match.group(1)}-{len(body) - 1}/{len(body)}"
+                        )
+                        body = body[int(match.group(1)) :]
+                with mock.lock:
+                    mock.log.append((path, status))
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                if status in (206, 416):
+                    self.send_header("Content-Range", content_range)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
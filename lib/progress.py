@@ -0,0 +1,82 @@
+import sys
+from time import monotonic
+
+BACKENDS = ["auto", "notebook", "terminal", "log", "none"]
+
+
+class LogProgress:
+    """
+    Progress reporting for jobs without a terminal, e.g. writing to a log file: a line with the progress and the last
+    status is printed at most every `interval` seconds, and once at the end.
+
+    Args:
+        total (int): The total amount of work.
+        interval (float, optional): The minimum seconds between two lines. Defaults to 60.
+        quiet (bool, optional): Whether to print nothing. Defaults to False.
+    """
+
+    def __init__(self, total: int, interval: float = 60, quiet: bool = False):
+        self.total = total
+        self.n = 0
+        self.interval = interval
+        self.quiet = quiet
+        self.postfix = ""
+        self.started = monotonic()
+        self.last_print = self.started
+
+    def _print(self):
+        if self.quiet:
+            return
+        elapsed = monotonic() - self.started
+        share = self.n / self.total if self.total else 1.0
+        print(
+            f"{self.n}/{self.total} ({share:.1%}) in {elapsed:.0f}s. {self.postfix}",
+            flush=True,
+        )
+        self.last_print = monotonic()
+
+    def update(self, n: int = 1):
+        self.n += n
+        if monotonic() - self.last_print >= self.interval:
+            self._print()
+
+    def set_postfix_str(self, postfix: str):
+        self.postfix = postfix
+
+    def close(self):
+        self._print()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def progress_bar(total: int, backend: str = "auto"):
+    """
+    Creates a progress bar with the `update` and `set_postfix_str` methods of tqdm.
+
+    Args:
+        total (int): The total amount of work.
+        backend (str, optional): "notebook" for the Jupyter widget, "terminal" for the text bar, "log" for periodic
+            lines (see `LogProgress`), "none" to report nothing, "auto" for the widget in Jupyter, the text bar in a
+            terminal and periodic lines otherwise. Defaults to "auto".
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown progress backend {backend}")
+    if backend == "auto":
+        if "ipykernel" in sys.modules:
+            backend = "notebook"
+        else:
+            backend = "terminal" if sys.stderr.isatty() else "log"
+    # tqdm is imported only when needed, the notebook version needs ipywidgets
+    if backend == "notebook":
+        from tqdm.notebook import tqdm
+
+        return tqdm(total=total)
+    if backend == "terminal":
+        from tqdm import tqdm
+
+        return tqdm(total=total)
+    return LogProgress(total, quiet=backend == "none")
@@ -1,12 +1,52 @@
 from pathlib import Path
 import polars as pl
 import re
+import os
+import mmap
 import json
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import IO, Collection, Iterator, Optional
+from zipfile import ZipFile
 
 from .requests import dformat
+from .ledger import TaskLedger
+from .stack import normalize_name
+from .spatial import integer_coordinate
+from .stations import StationResolver
+from .variables import header_variable, with_variable_names
 
 base = Path(__file__).parent.parent
+# The line limit of the Dext3r data requests: longer results are cut
+LINE_LIMIT = 25000
+# The station metadata table of a result file, and the names of its columns once read
+META_SCHEMA = {
+    "Nome della stazione": pl.Utf8(),
+    "Rete di misura": pl.Utf8(),
+    "Comune": pl.Utf8(),
+    "Provincia": pl.Utf8(),
+    "Regione": pl.Utf8(),
+    "Nazione": pl.Utf8(),
+    "Altezza (Metri sul livello del mare)": pl.Float64(),
+    "Longitudine (Gradi Centesimali)": pl.Float64(),
+    "Latitudine (Gradi Centesimali)": pl.Float64(),
+    "Bacino": pl.Utf8(),
+}
+META_COLUMNS = {
+    "Nome della stazione": "name",
+    "Rete di misura": "network",
+    "Altezza (Metri sul livello del mare)": "elevation",
+    "Longitudine (Gradi Centesimali)": "lon",
+    "Latitudine (Gradi Centesimali)": "lat",
+}
+DATA_SCHEMA = {
+    "start": pl.Datetime(time_unit="us", time_zone="UTC"),
+    "stop": pl.Datetime(time_unit="us", time_zone="UTC"),
+    "value": pl.Float64(),
+    "variable": pl.Utf8(),
+    "name": pl.Utf8(),
+    "task": pl.Utf8(),
+}
 
 
 def read_invalid_tasks(path=base / "data" / "completed_tasks.txt"):
@@ -53,26 +93,78 @@ def read_existing_requests(path=base / "data" / "requests.json"):
 
 def read_payloads(path=base / "data" / "payloads.json"):
     path = Path(path)
+    if path.suffix == ".jsonl":
+        # Task ledger: payloads are kept in a DataFrame and turned into dictionaries on access
+        return TaskLedger(path.with_name("requests.jsonl"), path).read_payloads()
     with open(path, "r") as f:
         return json.load(f)
 
 
-def _next_table(lines, start):
-    while lines[start] == "":
-        start += 1
-    # start now points to the first line of the table
-    counter = 0
-    while start + counter < len(lines) and lines[start + counter] != "":
-        counter += 1
-    # counter now contains the number of lines of the table, including the header
-    return start, counter
+def read_request_periods(
+    path=base / "data" / "payloads.json",
+) -> dict[str, dict[tuple[str, str], tuple[date, date]]]:
+    """
+    Reads the period requested for each station and variable of the tasks, from the ledger of the payloads file. The
+    payload of a task spans the periods of all its stations, which can be shorter.
 
+    Args:
+        path (str | Path): The payloads file. The former payloads.json has no ledger, so no periods.
 
-def table_specs(lines):
+    Returns:
+        dict[str, dict[tuple[str, str], tuple[date, date]]]: By task, the first and last requested day of each station,
+            by normalized station name and variable name.
+    """
+    path = Path(path)
+    if path.suffix != ".jsonl":
+        return {}
+    requests = (
+        with_variable_names(
+            TaskLedger(path.with_name("requests.jsonl"), path).scan_requests()
+        )
+        .group_by(
+            "task_id",
+            pl.col("name").str.to_lowercase().str.strip_chars(),
+            "variable",
+        )
+        .agg(pl.col("from").min(), pl.col("to").max())
+        .collect()
+    )
+    periods: dict[str, dict[tuple[str, str], tuple[date, date]]] = {}
+    for task, name, variable, start, end in requests.iter_rows():
+        periods.setdefault(task, {})[(name, variable)] = (start, end)
+    return periods
+
+
+def table_specs(buffer) -> list[tuple[int, int]]:
+    """
+    Finds the tables of a Dext3r result file in a single pass over its content.
+
+    Args:
+        buffer (bytes | mmap.mmap): The content of the file.
+
+    Returns:
+        list[tuple[int, int]]: The start and end byte offsets of each table, after the title line. The end includes the
+            line terminator of the last table line.
+    """
+    first_newline = buffer.find(b"\n")
+    if first_newline < 0:
+        return []
+    newline = b"\n"
+    if first_newline > 0 and buffer[first_newline - 1 : first_newline] == b"\r":
+        newline = b"\r\n"
+    separator = newline + newline
+    size = len(buffer)
     tabs = []
-    tabs.append(_next_table(lines, 1))
-    while tabs[-1][0] + tabs[-1][1] + 1 < len(lines):
-        tabs.append(_next_table(lines, tabs[-1][0] + tabs[-1][1] + 1))
+    start = first_newline + 1
+    while start < size:
+        while buffer[start : start + len(newline)] == newline:
+            start += len(newline)
+        if start >= size:
+            break
+        end = buffer.find(separator, start)
+        end = size if end < 0 else end + len(newline)
+        tabs.append((start, end))
+        start = end
     return tabs
 
 
@@ -85,53 +177,97 @@ def check_dext3r_meta(dext3r_meta, task):
     return True
 
 
-def check_task_period(task, table, payloads):
-    if task not in payloads:
+def table_period_gaps(task, table, payloads, periods=None) -> tuple[bool, bool]:
+    """
+    Compares a data table with the period requested for its station, or without it with the payload period.
+
+    Returns:
+        tuple[bool, bool]: Whether the table starts after the beginning of the period, and whether it stops before its
+            end.
+    """
+    period = (
+        (periods or {})
+        .get(task, {})
+        .get((normalize_name(table["name"][0]), table["variable"][0]))
+    )
+    if period is not None:
+        # Like the payload, see `slice_payload`: from one hour before the first day to the end of the last one
+        payload_begin = period[0] - timedelta(days=1)
+        payload_end = period[1] + timedelta(days=1)
+    elif task not in payloads:
         print(f"Could not compare payload times for task {task}.")
-        return True
-    payload_begin = datetime.strptime(payloads[task]["begin_datetime"], dformat).date()
-    payload_end = datetime.strptime(payloads[task]["end_datetime"], dformat).date()
+        return False, False
+    else:
+        payload_begin = datetime.strptime(
+            payloads[task]["begin_datetime"], dformat
+        ).date()
+        payload_end = datetime.strptime(payloads[task]["end_datetime"], dformat).date()
     try:
-        if (
-            table["start"].min().date() > payload_begin
-            or table["stop"].max().date() < payload_end
-        ):
-            return False
+        return (
+            table["start"].min().date() > payload_begin,
+            table["stop"].max().date() < payload_end,
+        )
     except Exception as e:
         print(f"Could not compare payload times for task {task}.")
         print(e)
-    return True
-
-
-def check_task_result(task, meta, payload):
-    pass
+    return False, False
+
+
+def check_task_period(task, table, payloads, periods=None):
+    # A table must span the period requested for its station, or without it the payload period
+    return not any(table_period_gaps(task, table, payloads, periods))
+
+
+def task_problem(
+    meta: pl.DataFrame,
+    line_limit: int = LINE_LIMIT,
+    known_shortfalls: Collection[tuple[str, str]] = (),
+) -> Optional[str]:
+    """
+    Tells whether a result file is incomplete, from the statistics of its stations (see `read_dext3r_tables`): it is
+    empty if it has no station metadata table (e.g. an empty file or an archive without CSV files), truncated if its
+    data lines reach the line limit, and partial if some of its tables do not span the period requested for their
+    station. The shortfalls already known, e.g. found by a previous request of the same station, are not problems.
+
+    Args:
+        meta (pl.DataFrame): The station metadata of the file, as read by `read_dext3r_tables` without stations.
+        line_limit (int, optional): The line limit of the requests. Defaults to `LINE_LIMIT`.
+        known_shortfalls (Collection[tuple[str, str]], optional): The short tables to ignore, by normalized station
+            name and variable name. Defaults to none.
+
+    Returns:
+        str | None: The description of the problem, or None if the file is complete.
+    """
+    if "lines" not in meta.columns:
+        return None
+    if meta.is_empty():
+        return "empty: no station tables"
+    lines = meta["lines"].sum()
+    if lines >= line_limit:
+        return f"truncated: {lines} lines"
+    short = [series for series in short_series(meta) if series not in known_shortfalls]
+    if short:
+        return f"partial: {len(short)} tables shorter than the requested period"
+    return None
+
+
+def short_series(meta: pl.DataFrame) -> list[tuple[str, str]]:
+    """
+    Lists the short tables of a result file, from its station metadata (see `read_dext3r_tables`).
+
+    Returns:
+        list[tuple[str, str]]: The normalized station name and the variable name of each short table.
+    """
+    return [
+        (normalize_name(name), variable)
+        for name, variables in meta.select("name", "short_variables").iter_rows()
+        for variable in variables
+    ]
 
 
-def read_dext3r_meta(path, spec):
-    return pl.read_csv(
-        path,
-        skip_rows=spec[0],
-        n_rows=spec[1] - 1,
-        schema={
-            "Nome della stazione": pl.Utf8(),
-            "Rete di misura": pl.Utf8(),
-            "Comune": pl.Utf8(),
-            "Provincia": pl.Utf8(),
-            "Regione": pl.Utf8(),
-            "Nazione": pl.Utf8(),
-            "Altezza (Metri sul livello del mare)": pl.Float64(),
-            "Longitudine (Gradi Centesimali)": pl.Float64(),
-            "Latitudine (Gradi Centesimali)": pl.Float64(),
-            "Bacino": pl.Utf8(),
-        },
-    ).rename(
-        {
-            "Nome della stazione": "name",
-            "Rete di misura": "network",
-            "Altezza (Metri sul livello del mare)": "elevation",
-            "Longitudine (Gradi Centesimali)": "lon",
-            "Latitudine (Gradi Centesimali)": "lat",
-        }
+def read_dext3r_meta(buffer, spec):
+    return pl.read_csv(buffer[spec[0] : spec[1]], schema=META_SCHEMA).rename(
+        META_COLUMNS
     )
 
 
@@ -175,8 +311,8 @@ def join_station_id(
         )
         .join(
             task_metadata.with_columns(
-                (pl.col("lon") * 10e5).floor().cast(pl.Int64()).alias("int_lon"),
-                (pl.col("lat") * 10e5).floor().cast(pl.Int64()).alias("int_lat"),
+                integer_coordinate("lon").alias("int_lon"),
+                integer_coordinate("lat").alias("int_lat"),
                 pl.col("elevation").cast(pl.Int32()).alias("int_elevation"),
             ),
             left_on=["name", "network", "lon", "lat", "int_elevation"],
@@ -188,16 +324,20 @@ def join_station_id(
     return pl.concat([unique_matches, stricter_meta], how="vertical")
 
 
-def read_dext3r_data(path, lines, spec, task):
-    name = lines[spec[0]]
-    variable = re.findall(r"((?:minima)|(?:massima))", lines[spec[0] + 1])[0]
-    variable = "T_MIN" if variable == "minima" else "T_MAX"
+def _table_header(buffer, spec) -> tuple[str, str, int]:
+    # The first line of the table is the station name, the second the header
+    name_end = buffer.find(b"\n", spec[0], spec[1]) + 1
+    header_end = buffer.find(b"\n", name_end, spec[1]) + 1 or spec[1]
+    name = buffer[spec[0] : name_end].decode().strip()
+    return name, header_variable(buffer[name_end:header_end].decode()), name_end
+
+
+def read_dext3r_data(buffer, spec, task):
+    name, variable, name_end = _table_header(buffer, spec)
     return (
         pl.read_csv(
-            path,
+            buffer[name_end : spec[1]],
             new_columns=["start", "stop", "value"],
-            skip_rows=spec[0] + 1,
-            n_rows=spec[1] - 2,
             truncate_ragged_lines=True,
             schema={"start": pl.Utf8(), "stop": pl.Utf8(), "value": pl.Utf8()},
         )
@@ -212,52 +352,195 @@ def read_dext3r_data(path, lines, spec, task):
     )
 
 
-def read_dext3r_tables(path, payloads, stations_metadata):
-    path = Path(path)
-    with open(path, "r") as f:
-        data = f.read()
-    lines = data.splitlines()
-    specs = table_specs(lines)
+task_regex = re.compile(r"[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}")
+
+
+def task_from_name(name: str) -> str:
+    """
+    Extracts the task id from the name of a result file or archive member, e.g. `dexter-<task>.csv`.
+    """
+    found = task_regex.search(Path(name).name)
+    return found.group(0) if found else Path(name).stem[7:]
+
 
-    task = path.stem[7:]
+@contextmanager
+def _open_source(source) -> Iterator[tuple[bytes | mmap.mmap, str]]:
+    # The content and the task of a result file path (memory-mapped), a binary file object (e.g. an open archive member)
+    # or a buffer
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # The content does not tell its task
+        yield bytes(source), None
+    elif isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b"", task_from_name(str(source))
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    yield buffer, task_from_name(str(source))
+    else:
+        yield source.read(), task_from_name(getattr(source, "name", ""))
 
-    specs.pop(-1)
+
+def read_dext3r_tables(
+    source: str | Path | IO[bytes] | bytes,
+    payloads,
+    stations_metadata,
+    task=None,
+    periods=None,
+):
+    """
+    Reads a Dext3r result file, matching its stations with the station ids. The file is read once: its tables are
+    located with a single scan of the (memory-mapped) content and each one is parsed from its own byte range. The
+    CSV parser needs bytes, so each range is copied once out of the content: the file is never copied whole, but the
+    tables are not parsed in place.
+
+    Args:
+        source (str | Path | IO[bytes] | bytes): The result file. It can be a CSV path, a ZIP archive path (all its CSV
+            members are read), an open binary file such as a ZIP member, or the file content.
+        payloads (dict): The payloads of the tasks.
+        stations_metadata (pl.DataFrame | StationResolver | None): The station information, as returned by
+            `list_available_stations`, or a resolver built from it. If None, the stations are not matched: the
+            metadata is the one in the file, and the data keeps the station names (see `StationResolver.resolve_tasks`).
+        task (str, optional): The task id. Defaults to the one in the file or member name. It is required to read the
+            file content.
+        periods (dict, optional): The periods requested for the stations of the tasks, as returned by
+            `read_request_periods`. Defaults to None, comparing the tables with the payload period.
+
+    Returns:
+        tuple[pl.DataFrame, pl.DataFrame]: The metadata of the stations in the file and the data of all its tables.
+            Without stations, the metadata also has the data lines of each station and the variables of its tables
+            that do not span the requested period (see `task_problem`), whose data is kept. The empty tables following
+            a table that stops early are counted as short, since the result may have been cut there. A file without
+            tables gives an empty metadata and data.
+
+    Raises:
+        ValueError: If the task id is not given and cannot be found in the file name.
+    """
+    if isinstance(stations_metadata, pl.DataFrame):
+        stations_metadata = StationResolver(stations_metadata)
+    if isinstance(source, (str, Path)) and Path(source).suffix == ".zip":
+        results = list(
+            read_dext3r_archive(source, payloads, stations_metadata, periods)
+        )
+        return (
+            pl.concat([meta for _, meta, _ in results], how="vertical"),
+            pl.concat([data for _, _, data in results], how="vertical"),
+        )
+    with _open_source(source) as (buffer, source_task):
+        task = task or source_task
+        if not task:
+            raise ValueError(
+                "The task of the result is unknown: pass its id with the content"
+            )
+        specs = table_specs(buffer)
+        if len(specs) >= 2:
+            specs.pop(-1)
+
+            meta = read_dext3r_meta(buffer, specs.pop(-1))
+            tables = [read_dext3r_data(buffer, spec, task) for spec in specs]
+            series = [_table_header(buffer, spec)[:2] for spec in specs]
+        else:
+            # A file without the station metadata table, e.g. empty, has no stations
+            meta = pl.DataFrame(schema=META_SCHEMA).rename(META_COLUMNS)
+            tables = []
+            series = []
 
     # Reading metadata
-    meta_spec = specs.pop(-1)
-    meta = read_dext3r_meta(path, meta_spec)
     check_dext3r_meta(meta, task)
-    meta = join_station_id(meta, stations_metadata, payloads, task).with_columns(
-        pl.lit(task).alias("task")
-    )
+    meta = meta.with_columns(pl.lit(task).alias("task"))
 
     # Reading data
     data_tables = []
-    for table_spec in specs:
-        ddata = read_dext3r_data(path, lines, table_spec, task)
-        if not check_task_period(task, ddata, payloads):
-            print(f"Warning: mismatch in {task} data period.")
+    # Data lines, and variables of the tables shorter than the requested period, by station name
+    lines: dict[str, int] = {}
+    short_variables: dict[str, list[str]] = {}
+    # Whether the previous table stops before the end of its period, where the result may have been cut
+    cut = False
+    for (name, variable), ddata in zip(series, tables):
+        if ddata.is_empty():
+            # Stations without data in the requested period, unless the result was cut before their table
+            if cut:
+                short_variables.setdefault(name, []).append(variable)
             continue
+        lines[name] = lines.get(name, 0) + len(ddata)
+        late_start, cut = table_period_gaps(task, ddata, payloads, periods)
+        if late_start or cut:
+            # The data of a short table is kept, its missing days are requested again
+            print(f"Warning: mismatch in {task} data period.")
+            short_variables.setdefault(name, []).append(variable)
         data_tables.append(ddata)
+    meta = meta.with_columns(
+        pl.col("name")
+        .replace_strict(lines, default=0, return_dtype=pl.Int64())
+        .alias("lines"),
+        pl.Series(
+            "short_variables",
+            [short_variables.get(name, []) for name in meta["name"]],
+            dtype=pl.List(pl.Utf8()),
+        ),
+    )
     if data_tables:
-        data_tables = (
-            pl.concat(data_tables, how="vertical")
-            .join(meta.select("id", "name"), on="name", how="inner")
-            .select("start", "stop", "value", "variable", "id", "task")
+        data_tables = pl.concat(data_tables, how="vertical").select(
+            "start", "stop", "value", "variable", "name", "task"
         )
     else:
-        data_tables = pl.DataFrame(
-            schema={
-                "start": pl.Datetime(time_unit="us", time_zone="UTC"),
-                "stop": pl.Datetime(time_unit="us", time_zone="UTC"),
-                "value": pl.Float64(),
-                "variable": pl.Utf8(),
-                "id": pl.Utf8(),
-                "task": pl.Utf8(),
-            }
-        )
-
-    return meta, data_tables
+        data_tables = pl.DataFrame(schema=DATA_SCHEMA)
+
+    if stations_metadata is None:
+        return meta, data_tables
+    if not isinstance(stations_metadata, StationResolver):
+        stations_metadata = StationResolver(stations_metadata)
+    return stations_metadata.resolve_tasks(meta, data_tables, payloads)
+
+
+def read_dext3r_archive(
+    path: str | Path, payloads, stations_metadata, periods=None
+) -> Iterator[tuple[str, pl.DataFrame, pl.DataFrame]]:
+    """
+    Reads the result files contained in a Dext3r ZIP archive, without extracting them.
+
+    Yields:
+        tuple[str, pl.DataFrame, pl.DataFrame]: The task id, the station metadata and the data of each CSV member. An
+            archive without CSV members is read as an empty result file of the task in the archive name.
+    """
+    if isinstance(stations_metadata, pl.DataFrame):
+        stations_metadata = StationResolver(stations_metadata)
+    with ZipFile(path) as archive:
+        members = [m for m in archive.namelist() if m.lower().endswith(".csv")]
+        if not members:
+            task = task_from_name(str(path))
+            yield task, *read_dext3r_tables(
+                b"", payloads, stations_metadata, task, periods
+            )
+            return
+        for member in members:
+            task = task_from_name(member)
+            with archive.open(member) as f:
+                meta, data = read_dext3r_tables(
+                    f, payloads, stations_metadata, task, periods
+                )
+            yield task, meta, data
+
+
+def read_dext3r_archives(
+    paths: list[str | Path], payloads, stations_metadata, periods=None
+) -> Iterator[tuple[str, pl.DataFrame, pl.DataFrame]]:
+    """
+    Reads many Dext3r results, either ZIP archives or CSV files.
+
+    Yields:
+        tuple[str, pl.DataFrame, pl.DataFrame]: The task id, the station metadata and the data of each result file.
+    """
+    if isinstance(stations_metadata, pl.DataFrame):
+        stations_metadata = StationResolver(stations_metadata)
+    for path in paths:
+        if Path(path).suffix == ".zip":
+            yield from read_dext3r_archive(path, payloads, stations_metadata, periods)
+        else:
+            meta, data = read_dext3r_tables(
+                path, payloads, stations_metadata, periods=periods
+            )
+            yield task_from_name(str(path)), meta, data
 
 
 def assoc_station_id(dext3r_table, requests, global_meta):
@@ -1,7 +1,10 @@
 from datetime import datetime, timedelta
-import requests
+from typing import Optional
+
 import polars as pl
 
+from .transport import Transport, default_transport
+
 dformat = r"%Y-%m-%dT%H:%M:%SZ"
 tdict = {"T_MAX": "2", "T_MIN": "3"}
 
@@ -16,7 +19,7 @@ def slice_payload(slice, email):
     variables = list(set(s["v"] for s in slice))
     if len(variables) == 1:
         variables = variables[0]
-    stations = [s["id"] for s in slice]
+    stations = list(dict.fromkeys(s["id"] for s in slice))
     return {
         "email": email,
         "begin_datetime": start_datetime.strftime(dformat),
@@ -27,9 +30,25 @@ def slice_payload(slice, email):
     }
 
 
-def request_slice(slice, email):
+def request_slice(slice, email, transport: Optional[Transport] = None):
     payload = slice_payload(slice, email)
+    transport = transport or default_transport()
     return (
-        requests.get("https://simc.arpae.it/meteozen/debra/api/data", payload),
+        transport.get("debra/api/data", payload),
         payload,
     )
+
+
+def response_detail(response):
+    try:
+        content = response.json()
+    except ValueError:
+        # E.g. an HTML error page of a proxy
+        return response.text or None
+    if not isinstance(content, dict):
+        return str(content)
+    if "detail" in content:
+        return content["detail"]
+    elif "details" in content:
+        return content["details"]
+    return None
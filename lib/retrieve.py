@@ -0,0 +1,206 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Optional
+
+import requests
+
+from .ledger import TaskLedger
+from .transport import Transport, default_transport
+
+# Task status and result archive endpoints, relative to the transport base URL
+STATUS_PATH = "debra/api/tasks/{task}"
+ARCHIVE_PATH = "debra/api/tasks/{task}/archive"
+# Answers telling that a task does not exist (any more): checking it again would not help
+DEFINITIVE_STATUS_CODES = {404, 410}
+
+
+def archive_path(directory: Path, task: str) -> Path:
+    return Path(directory) / f"dexter-{task}.zip"
+
+
+def task_status(task: str, transport: Optional[Transport] = None) -> str:
+    """
+    Asks Dext3r the status of a task.
+
+    Returns:
+        str: "completed", "failed" or any other status while the task is being processed.
+    """
+    transport = transport or default_transport()
+    response = transport.get(STATUS_PATH.format(task=task))
+    response.raise_for_status()
+    return response.json()["status"].lower()
+
+
+def download_archive(
+    task: str,
+    directory: Path,
+    transport: Optional[Transport] = None,
+    chunk_size: int = 1 << 20,
+) -> Path:
+    """
+    Streams the result archive of a task to `directory/dexter-<task>.zip`. The archive is written to a `.part` file
+    first: if a previous download was interrupted, it is resumed from where it stopped. A `.part` file that the server
+    finds complete (416 Range Not Satisfiable at its size) is the archive.
+
+    Args:
+        task (str): The task id.
+        directory (Path): The directory of the archives.
+        transport (Transport, optional): The transport to use. Defaults to the shared production one.
+        chunk_size (int, optional): The size of the chunks written to disk. Defaults to 1 MiB.
+
+    Returns:
+        Path: The path of the archive.
+    """
+    transport = transport or default_transport()
+    destination = archive_path(directory, task)
+    if destination.exists():
+        return destination
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    partial = destination.with_suffix(".zip.part")
+    offset = partial.stat().st_size if partial.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with transport.get(
+        ARCHIVE_PATH.format(task=task), headers=headers, stream=True
+    ) as response:
+        if offset and response.status_code == 416:
+            # The previous download stopped after the last chunk, before the rename
+            size = response.headers.get("Content-Range", "").rpartition("/")[2]
+            if not size.isdigit() or int(size) == offset:
+                partial.replace(destination)
+                return destination
+            # The file is not a prefix of the archive: it is downloaded again by the next call
+            partial.unlink()
+        response.raise_for_status()
+        # The server may ignore the range and send the whole archive
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(partial, mode) as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+    partial.replace(destination)
+    return destination
+
+
+def mark_invalid(tasks: list[str], invalid_tasks_path: Path):
+    """
+    Appends tasks to the invalid tasks file, so that their queue elements are requested again when resuming.
+    """
+    if tasks:
+        with open(invalid_tasks_path, "at") as f:
+            f.writelines(task + "\n" for task in tasks)
+
+
+def pending_tasks(
+    ledger: TaskLedger, directory: Path, invalid_tasks: list[str]
+) -> list[str]:
+    """
+    Lists the tasks of the ledger whose archive was not downloaded yet and that were not flagged as invalid.
+    """
+    invalid_tasks = set(invalid_tasks)
+    tasks = ledger.scan_payloads().select("task_id").unique(maintain_order=True)
+    return [
+        task
+        for task in tasks.collect()["task_id"].to_list()
+        if task not in invalid_tasks and not archive_path(directory, task).exists()
+    ]
+
+
+def retrieve_tasks(
+    tasks: list[str],
+    directory: Path,
+    invalid_tasks_path: Path,
+    transport: Optional[Transport] = None,
+    max_workers: int = 4,
+    poll_interval: float = 60,
+    max_interval: float = 900,
+    timeout: Optional[float] = None,
+    max_errors: int = 5,
+) -> dict[str, str]:
+    """
+    Polls the tasks until they are completed, downloading their archives, or failed, flagging them as invalid.
+
+    The status of at most `max_workers` tasks is requested at the same time. The polling interval of each task starts
+    at `poll_interval` and doubles at every check, up to `max_interval`. Only a definitive answer of the server makes a
+    task invalid: its "failed" status, or a status code telling that the task does not exist (see
+    `DEFINITIVE_STATUS_CODES`). Other errors, e.g. connection errors, server errors, malformed answers or a full disk,
+    are transient: the task is checked again later, and after `max_errors` errors in a row it is reported and left for
+    a later call.
+
+    Args:
+        tasks (list[str]): The task ids.
+        directory (Path): The directory of the archives.
+        invalid_tasks_path (Path): The invalid tasks file.
+        transport (Transport, optional): The transport to use. Defaults to the shared production one.
+        max_workers (int, optional): The maximum number of concurrent requests. Defaults to 4.
+        poll_interval (float, optional): The initial polling interval in seconds. Defaults to 60.
+        max_interval (float, optional): The maximum polling interval in seconds. Defaults to 900.
+        timeout (float, optional): The seconds after which the tasks still pending are left for a later call. Defaults to None (no timeout).
+        max_errors (int, optional): The consecutive transient errors after which a task is left for a later call.
+            Defaults to 5.
+
+    Returns:
+        dict[str, str]: The outcome of each task: "downloaded", "failed", "failed: <server answer>", "pending" or
+            "error: <message>", for the tasks left after transient errors.
+    """
+    transport = transport or default_transport()
+    outcomes = {task: "pending" for task in tasks}
+    next_check = {task: monotonic() for task in tasks}
+    intervals = {task: poll_interval for task in tasks}
+    errors = {task: 0 for task in tasks}
+    started = monotonic()
+
+    def check(task):
+        try:
+            status = task_status(task, transport)
+            if status == "completed":
+                download_archive(task, directory, transport)
+                return task, "downloaded"
+            if status == "failed":
+                return task, "failed"
+            return task, "pending"
+        except requests.HTTPError as e:
+            if (
+                e.response is not None
+                and e.response.status_code in DEFINITIVE_STATUS_CODES
+            ):
+                return task, f"failed: {e}"
+            return task, f"error: {e}"
+        except (requests.RequestException, ValueError, KeyError, OSError) as e:
+            # A malformed status answer or an archive that could not be written is an error too
+            return task, f"error: {e}"
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        while next_check:
+            now = monotonic()
+            if timeout is not None and now - started > timeout:
+                break
+            due = [task for task, t in next_check.items() if t <= now]
+            if not due:
+                wait = min(next_check.values()) - now
+                if timeout is not None:
+                    wait = min(wait, started + timeout - now)
+                sleep(max(0, wait))
+                continue
+            failed = []
+            for task, outcome in pool.map(check, due):
+                outcomes[task] = outcome
+                if outcome.startswith("error"):
+                    errors[task] += 1
+                    if errors[task] >= max_errors:
+                        print(
+                            f"Warning: could not check task {task} {errors[task]} times ({outcome}). "
+                            "It is left for a later call."
+                        )
+                        del next_check[task]
+                        continue
+                else:
+                    errors[task] = 0
+                if outcome == "downloaded" or outcome.startswith("failed"):
+                    del next_check[task]
+                    if outcome != "downloaded":
+                        failed.append(task)
+                else:
+                    next_check[task] = monotonic() + intervals[task]
+                    intervals[task] = min(intervals[task] * 2, max_interval)
+            mark_invalid(failed, invalid_tasks_path)
+    return outcomes
@@ -0,0 +1,201 @@
+import math
+from typing import Optional
+
+import polars as pl
+
+# station_infos.json gives the coordinates in hundred-thousandths of a degree, as in the station ids (e.g.
+# "-/1196964,4467123/..."), while the result files and the mock service give them in degrees
+COORDINATE_SCALE = 1e5
+EARTH_RADIUS_KM = 6371.0088
+# Columns of the station metadata in the result files that describe where a station is
+PLACE_COLUMNS = ["Comune", "Provincia", "Regione", "Nazione", "Bacino"]
+
+
+def integer_coordinate(column: str) -> pl.Expr:
+    """
+    Converts a coordinate in degrees, as in the result files, to the integer one of station_infos.json.
+    """
+    return (pl.col(column) * COORDINATE_SCALE).round().cast(pl.Int64())
+
+
+def haversine_km(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """
+    Returns the great-circle distance between two points given in degrees, in kilometres.
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def in_polygon(lon: float, lat: float, polygon: list[tuple[float, float]]) -> bool:
+    """
+    Whether a point lies inside a polygon, with the even-odd rule. The polygon is a list of (lon, lat) vertices, closed
+    or not.
+    """
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        (xi, yi), (xj, yj) = polygon[i], polygon[j]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class StationIndex:
+    """
+    Grid index over the station coordinates. The stations are bucketed in square cells of `cell_degrees`, so that a
+    query only checks the stations of the cells overlapping its bounding box.
+
+    Args:
+        stations (pl.DataFrame): The station information, as returned by `list_available_stations`.
+        cell_degrees (float, optional): The side of the grid cells in degrees. Defaults to 0.1.
+    """
+
+    def __init__(self, stations: pl.DataFrame, cell_degrees: float = 0.1):
+        stations = stations.drop_nulls(["lon", "lat"])
+        self.cell_degrees = cell_degrees
+        self.ids = stations["id"].cast(pl.Utf8()).to_list()
+        self.lon = (stations["lon"] / COORDINATE_SCALE).to_list()
+        self.lat = (stations["lat"] / COORDINATE_SCALE).to_list()
+        self.cells: dict[tuple[int, int], list[int]] = {}
+        for i, (lon, lat) in enumerate(zip(self.lon, self.lat)):
+            self.cells.setdefault(self._cell(lon, lat), []).append(i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, lon: float, lat: float) -> tuple[int, int]:
+        return math.floor(lon / self.cell_degrees), math.floor(lat / self.cell_degrees)
+
+    def _candidates(self, min_lon, min_lat, max_lon, max_lat) -> list[int]:
+        (x0, y0), (x1, y1) = self._cell(min_lon, min_lat), self._cell(max_lon, max_lat)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # Scanning the occupied cells is cheaper than scanning the box
+            return [
+                i
+                for (x, y), cell in self.cells.items()
+                if x0 <= x <= x1 and y0 <= y <= y1
+                for i in cell
+            ]
+        return [
+            i
+            for x in range(x0, x1 + 1)
+            for y in range(y0, y1 + 1)
+            for i in self.cells.get((x, y), [])
+        ]
+
+    def bbox(
+        self, min_lon: float, min_lat: float, max_lon: float, max_lat: float
+    ) -> list[str]:
+        """
+        Returns the ids of the stations inside a bounding box, in degrees, borders included.
+        """
+        return [
+            self.ids[i]
+            for i in self._candidates(min_lon, min_lat, max_lon, max_lat)
+            if min_lon <= self.lon[i] <= max_lon and min_lat <= self.lat[i] <= max_lat
+        ]
+
+    def radius(self, lon: float, lat: float, km: float) -> list[str]:
+        """
+        Returns the ids of the stations within `km` kilometres of a point, in degrees.
+        """
+        dlat = math.degrees(km / EARTH_RADIUS_KM)
+        # Near the poles the circle spans every longitude
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+        dlon = 180.0 if cos_lat < 1e-9 else min(dlat / cos_lat, 180.0)
+        return [
+            self.ids[i]
+            for i in self._candidates(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+            if haversine_km(lon, lat, self.lon[i], self.lat[i]) <= km
+        ]
+
+    def polygon(self, vertices: list[tuple[float, float]]) -> list[str]:
+        """
+        Returns the ids of the stations inside a polygon of (lon, lat) vertices, in degrees.
+        """
+        lons, lats = [v[0] for v in vertices], [v[1] for v in vertices]
+        return [
+            self.ids[i]
+            for i in self._candidates(min(lons), min(lats), max(lons), max(lats))
+            if in_polygon(self.lon[i], self.lat[i], vertices)
+        ]
+
+
+class StationFilter:
+    """
+    Selects the stations of a region. The given conditions must all hold; without conditions every station is
+    selected.
+
+    The basin and the province of a station are only known from the result files, so they are looked up in the station
+    metadata of the ingested tasks (see `lib.store.read_task_metas`): stations that were never ingested do not match
+    them.
+
+    Args:
+        bbox (tuple[float, float, float, float], optional): The (min_lon, min_lat, max_lon, max_lat) box, in degrees.
+        radius (tuple[float, float, float], optional): The (lon, lat, km) circle.
+        polygon (list[tuple[float, float]], optional): The (lon, lat) vertices of a polygon.
+        basin (str | list[str], optional): The basins ("Bacino"), case insensitive.
+        province (str | list[str], optional): The provinces ("Provincia"), case insensitive.
+        ids (list[str], optional): The station ids.
+    """
+
+    def __init__(
+        self,
+        bbox: Optional[tuple[float, float, float, float]] = None,
+        radius: Optional[tuple[float, float, float]] = None,
+        polygon: Optional[list[tuple[float, float]]] = None,
+        basin: Optional[str | list[str]] = None,
+        province: Optional[str | list[str]] = None,
+        ids: Optional[list[str]] = None,
+    ):
+        self.bbox = bbox
+        self.radius = radius
+        self.polygon = polygon
+        self.basin = [basin] if isinstance(basin, str) else basin
+        self.province = [province] if isinstance(province, str) else province
+        self.ids = ids
+
+    def select(self, index: StationIndex, places: pl.DataFrame) -> Optional[set[str]]:
+        """
+        Returns the ids of the selected stations, or None if the filter has no conditions.
+
+        Args:
+            index (StationIndex): The index of the available stations.
+            places (pl.DataFrame): The station metadata of the ingested tasks, with the id and the place columns.
+        """
+        selections = []
+        if self.ids is not None:
+            selections.append(set(map(str, self.ids)))
+        if self.bbox is not None:
+            selections.append(set(index.bbox(*self.bbox)))
+        if self.radius is not None:
+            selections.append(set(index.radius(*self.radius)))
+        if self.polygon is not None:
+            selections.append(set(index.polygon(self.polygon)))
+        for column, values in (("Bacino", self.basin), ("Provincia", self.province)):
+            if values is None:
+                continue
+            if column not in places.columns:
+                print(
+                    f"Warning: no {column} information in the ingested station metadata. No station matches."
+                )
+                selections.append(set())
+                continue
+            selections.append(
+                set(
+                    places.filter(
+                        pl.col(column)
+                        .str.to_lowercase()
+                        .str.strip_chars()
+                        .is_in([v.lower().strip() for v in values])
+                    )["id"].to_list()
+                )
+            )
+        if not selections:
+            return None
+        return set.intersection(*selections)
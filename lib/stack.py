@@ -1,3 +1,4 @@
+from array import array
 from pathlib import Path
 from typing import Any, Optional
 from datetime import timedelta, date
@@ -5,23 +6,31 @@ from datetime import timedelta, date
 import polars as pl
 
 
+def slice_size(start_date: date, end_date: date, n_stations, aggregation_period):
+    return (
+        int((end_date - start_date + timedelta(days=1)).total_seconds())
+        * n_stations
+        // aggregation_period
+    )
+
+
 def tot_elements(stations: list[dict[str, Any]]):
     if stations:
         start_date: date = min(s["from"] for s in stations)
         end_date: date = max(s["to"] for s in stations)
         aggregation_period = min(s["agg_period"] for s in stations)
-        return (
-            int((end_date - start_date + timedelta(days=1)).total_seconds())
-            * len(stations)
-            // aggregation_period
-        )
+        return slice_size(start_date, end_date, len(stations), aggregation_period)
     else:
         return 0
 
 
+def normalize_name(name: str) -> str:
+    return name.lower().strip()
+
+
 def station_name_in(station, stack: list):
     for s in stack:
-        if station["name"].lower().strip() == s["name"].lower().strip():
+        if normalize_name(station["name"]) == normalize_name(s["name"]):
             return True
     return False
 
@@ -59,3 +68,592 @@ def pop_biggest_slice(sorted_queue, max_size):
         stations.append(sorted_queue.pop(station_to_add))
         station_to_add = find_biggest(stations, sorted_queue, max_size)
     return stations
+
+
+QUEUE_SCHEMA = {
+    "name": pl.Utf8(),
+    "id": pl.Utf8(),
+    "v": pl.Utf8(),
+    "from": pl.Date(),
+    "to": pl.Date(),
+    "count": pl.Int64(),
+    "timeline_section": pl.Int32(),
+    "agg_period": pl.Int32(),
+}
+
+
+def _day_size(start_day: int, end_day: int, n_stations, aggregation_period):
+    # slice_size with the dates as days since the epoch
+    return (end_day - start_day + 1) * 86400 * n_stations // aggregation_period
+
+
+class RequestQueue:
+    """
+    Columnar request queue. The queue elements are kept in a DataFrame, in queue order, and planned in units: the
+    elements of the same station, timeline section, aggregation period and dates form a unit, whose variables are
+    requested together. The fields used for planning are kept in integer arrays, one value per unit: the dates as days
+    since the epoch and the normalized names, the ids and the set of variables as codes. Units are addressed by
+    position and turned into the dictionaries of their elements only when a slice is returned.
+
+    An optional "weight" column gives the number of stations each element counts as when sizing a request, e.g. the
+    density learned by a `RowEstimator`. Elements without weight count as one station. A unit counts as the sum of its
+    variables, so that a request is sized on its stations times its variables.
+
+    Args:
+        frame (pl.DataFrame): The queue elements, sorted as returned by `make_request_queue`.
+    """
+
+    def __init__(self, frame: pl.DataFrame):
+        self.frame = frame
+        elements = frame.select(
+            pl.col("name")
+            .str.to_lowercase()
+            .str.strip_chars()
+            .rank("dense")
+            .cast(pl.Int64()),
+            pl.col("id").rank("dense").cast(pl.Int64()),
+            pl.col("v").rank("dense").cast(pl.Int64()),
+            pl.col("from").cast(pl.Int32()).cast(pl.Int64()),
+            pl.col("to").cast(pl.Int32()).cast(pl.Int64()),
+            pl.col("timeline_section").cast(pl.Int64()),
+            pl.col("agg_period").cast(pl.Int64()),
+            (
+                frame["weight"].cast(pl.Float64())
+                if "weight" in frame.columns
+                else pl.lit(1.0, pl.Float64()).alias("weight")
+            ),
+        ).with_row_index("position")
+        units = (
+            elements.group_by(
+                "id",
+                "timeline_section",
+                "agg_period",
+                "from",
+                "to",
+                maintain_order=True,
+            )
+            .agg(
+                pl.col("name").first(),
+                pl.col("weight").sum(),
+                pl.col("v").sort().alias("variables"),
+                pl.col("position"),
+            )
+            .with_columns(
+                pl.col("variables")
+                .cast(pl.List(pl.Utf8()))
+                .list.join(",")
+                .rank("dense")
+                .cast(pl.Int64())
+                .alias("v"),
+                (
+                    (pl.col("to") - pl.col("from") + 1)
+                    * 86400
+                    * pl.col("variables").list.len()
+                    // pl.col("agg_period")
+                ).alias("count"),
+            )
+            # The units keep the order of the queue, from the biggest
+            .sort("count", "timeline_section", descending=True, maintain_order=True)
+        )
+        self.name, self.id, self.v, self.start, self.end = (
+            array("q", units[c].to_list()) for c in ("name", "id", "v", "from", "to")
+        )
+        self.count, self.section, self.agg_period = (
+            array("q", units[c].to_list())
+            for c in ("count", "timeline_section", "agg_period")
+        )
+        self.weight = array("d", units["weight"].to_list())
+        self.units: list[list[int]] = units["position"].to_list()
+
+    @classmethod
+    def from_dicts(cls, sorted_queue: list[dict[str, Any]]):
+        schema = QUEUE_SCHEMA
+        if sorted_queue and "weight" in sorted_queue[0]:
+            schema = schema | {"weight": pl.Float64()}
+        return cls(
+            pl.DataFrame(
+                [{k: s[k] for k in schema} for s in sorted_queue], schema=schema
+            )
+        )
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, i) -> dict[str, Any]:
+        return self.frame.row(i, named=True)
+
+    def rows(self, units: list[int]) -> list[dict[str, Any]]:
+        """
+        Returns the queue elements of the units at the given positions as dictionaries.
+        """
+        positions = [position for i in units for position in self.units[i]]
+        if not positions:
+            return []
+        return self.frame[positions].to_dicts()
+
+
+def as_request_queue(sorted_queue) -> RequestQueue:
+    if isinstance(sorted_queue, RequestQueue):
+        return sorted_queue
+    return RequestQueue.from_dicts(sorted_queue)
+
+
+class SliceQueue:
+    """
+    Indexed request queue producing the same slices as `pop_biggest_slice`.
+
+    The units of the queue (see `RequestQueue`) are bucketed by (timeline_section, agg_period, variables), so that a
+    slice is built scanning only the compatible units, and the slice keeps a set of normalized station names and
+    running date/aggregation bounds instead of recomputing them for every candidate. With a single variable, each unit
+    is a queue element.
+
+    Args:
+        sorted_queue (RequestQueue | list[dict[str, Any]]): The queue elements, sorted as returned by
+            `make_request_queue`.
+    """
+
+    def __init__(self, sorted_queue):
+        self.queue = as_request_queue(sorted_queue)
+        self.taken = bytearray(len(self.queue.units))
+        self.head = 0
+        self.remaining = len(self.queue.units)
+        self.buckets: dict[tuple, list[int]] = {}
+        q = self.queue
+        # No element counts as fewer stations than this
+        self.min_weight = min(q.weight, default=1.0)
+        for i in range(len(q.units)):
+            key = (q.section[i], q.agg_period[i], q.v[i])
+            self.buckets.setdefault(key, []).append(i)
+
+    def __len__(self):
+        return self.remaining
+
+    def _take(self, i):
+        self.taken[i] = True
+        self.remaining -= 1
+        return i
+
+    def _first_fitting(self, max_size) -> Optional[int]:
+        while self.head < len(self.taken) and self.taken[self.head]:
+            self.head += 1
+        q = self.queue
+        for i in range(self.head, len(self.taken)):
+            if (
+                not self.taken[i]
+                and _day_size(q.start[i], q.end[i], q.weight[i], q.agg_period[i])
+                <= max_size
+            ):
+                return i
+        return None
+
+    def pop_slice_indices(self, max_size) -> list[int]:
+        """
+        Like `pop_biggest_slice`, returning the positions of the units in the queue.
+        """
+        if self.remaining == 0:
+            return []
+        first = self._first_fitting(max_size)
+        if first is None:
+            raise ValueError(f"No queue element fits in {max_size} lines")
+        q = self.queue
+        stations = [self._take(first)]
+        weight = q.weight[first]
+        names = {q.name[first]}
+        start_date, end_date = q.start[first], q.end[first]
+        agg_period = q.agg_period[first]
+
+        key = (q.section[first], agg_period, q.v[first])
+        bucket = self.buckets[key]
+        candidates = iter(bucket)
+        for i in candidates:
+            if i == first:
+                break
+        for i in candidates:
+            if self.taken[i] or q.name[i] in names:
+                continue
+            new_start = min(start_date, q.start[i])
+            new_end = max(end_date, q.end[i])
+            if (
+                _day_size(new_start, new_end, weight + q.weight[i], agg_period)
+                <= max_size
+            ):
+                stations.append(self._take(i))
+                weight += q.weight[i]
+                names.add(q.name[i])
+                start_date, end_date = new_start, new_end
+            elif (
+                _day_size(start_date, end_date, weight + self.min_weight, agg_period)
+                > max_size
+            ):
+                # The slice can only grow, so no other candidate can fit from now on
+                break
+        self.buckets[key] = [i for i in bucket if not self.taken[i]]
+        return stations
+
+    def pop_biggest_slice(self, max_size) -> list[dict[str, Any]]:
+        """
+        Pops the next group of queue elements that can be requested together.
+
+        Args:
+            max_size (int): The maximum number of lines of the request, as computed by `tot_elements`.
+
+        Returns:
+            list[dict[str, Any]]: The queue elements of the slice. Empty if the queue is empty.
+
+        Raises:
+            ValueError: If the queue is not empty but none of its elements fits in `max_size`.
+        """
+        return self.queue.rows(self.pop_slice_indices(max_size))
+
+
+def _series_weights(stations: list[dict[str, Any]]) -> dict[tuple[str, str], float]:
+    return {(s["id"], s["v"]): s.get("weight", 1) for s in stations}
+
+
+def _request_weight(weights: dict[tuple[str, str], float]) -> float:
+    # A request asks every variable of every station: the series that were not queued count as one station
+    ids = dict.fromkeys(i for i, _ in weights)
+    variables = dict.fromkeys(v for _, v in weights)
+    return sum(weights.get((i, v), 1) for i in ids for v in variables)
+
+
+def request_elements(stations: list[dict[str, Any]]):
+    """
+    Like `tot_elements`, but counting each station once, as it is requested once even if it spans several queue
+    elements, weighting the stations by their "weight", if any (see `RequestQueue`), and multiplying them by the
+    variables of the request.
+    """
+    if stations:
+        start_date: date = min(s["from"] for s in stations)
+        end_date: date = max(s["to"] for s in stations)
+        aggregation_period = min(s["agg_period"] for s in stations)
+        n_stations = _request_weight(_series_weights(stations))
+        return slice_size(start_date, end_date, n_stations, aggregation_period)
+    else:
+        return 0
+
+
+def _station_items(queue: RequestQueue, max_size, merge_sections: bool) -> list[dict]:
+    # One item per unit, or per run of adjacent timeline sections of the same series if merge_sections is set
+    series: dict[tuple, list[int]] = {}
+    for i in range(len(queue.units)):
+        series.setdefault((queue.id[i], queue.v[i], queue.agg_period[i]), []).append(i)
+    items = []
+    for (_, v, agg_period), elements in series.items():
+        run = None
+        for i in sorted(elements, key=lambda i: queue.section[i]):
+            if (
+                merge_sections
+                and run is not None
+                and queue.section[i] == run["timeline_section"] + 1
+                and _day_size(
+                    min(run["from"], queue.start[i]),
+                    max(run["to"], queue.end[i]),
+                    max(run["weight"], queue.weight[i]),
+                    agg_period,
+                )
+                <= max_size
+            ):
+                # The run is requested at once, weighing as its heaviest unit
+                run["weight"] = max(run["weight"], queue.weight[i])
+                run["from"] = min(run["from"], queue.start[i])
+                run["to"] = max(run["to"], queue.end[i])
+                run["timeline_section"] = queue.section[i]
+                run["elements"].append(i)
+                continue
+            run = {
+                "name": queue.name[i],
+                "weight": queue.weight[i],
+                "v": v,
+                "agg_period": agg_period,
+                "from": queue.start[i],
+                "to": queue.end[i],
+                "timeline_section": queue.section[i],
+                "elements": [i],
+            }
+            items.append(run)
+    for item in items:
+        item["count"] = _day_size(
+            item["from"], item["to"], item["weight"], item["agg_period"]
+        )
+        if item["count"] > max_size:
+            raise ValueError(f"No queue element fits in {max_size} lines")
+    return items
+
+
+def best_fit_decreasing(sorted_queue, max_size, merge_sections=True):
+    """
+    Packs the queue elements into slices with the best-fit-decreasing heuristic: each element, from the biggest, goes
+    to the compatible slice where it adds the fewest lines in excess of its own.
+
+    Unlike `pop_biggest_slice`, elements from different timeline sections can share a slice, and adjacent timeline
+    sections of the same series can be requested together. The slices respect the same constraints: a single set of
+    variables and aggregation period, no different stations with the same name and at most `max_size` lines as computed by
+    `request_elements`.
+
+    Args:
+        sorted_queue (RequestQueue | list[dict[str, Any]]): The queue elements.
+        max_size (int): The maximum number of lines of a request.
+        merge_sections (bool, optional): Whether to merge adjacent timeline sections of the same series. Defaults to True.
+
+    Returns:
+        list[list[dict[str, Any]]]: The slices, made of the original queue elements.
+    """
+    queue = as_request_queue(sorted_queue)
+    min_weight = min(queue.weight, default=1.0)
+    items = _station_items(queue, max_size, merge_sections)
+    items.sort(key=lambda item: item["count"], reverse=True)
+    open_bins: dict[tuple, list[dict[str, Any]]] = {}
+    bins = []
+    for item in items:
+        key = (item["v"], item["agg_period"])
+        candidates = open_bins.setdefault(key, [])
+        target = None
+        best_waste = None
+        for b in candidates:
+            if item["name"] in b["names"]:
+                continue
+            size = _day_size(
+                min(b["from"], item["from"]),
+                max(b["to"], item["to"]),
+                b["n"] + item["weight"],
+                item["agg_period"],
+            )
+            if size > max_size:
+                continue
+            # Lines requested in excess of the item ones, due to the bin and the item covering different periods
+            waste = size - b["size"] - item["count"]
+            if best_waste is None or waste < best_waste:
+                target, best_waste = b, waste
+                if waste == 0:
+                    break
+        if target is None:
+            target = {
+                "from": item["from"],
+                "to": item["to"],
+                "n": 0,
+                "size": 0,
+                "names": set(),
+                "elements": [],
+            }
+            bins.append(target)
+            candidates.append(target)
+        target["from"] = min(target["from"], item["from"])
+        target["to"] = max(target["to"], item["to"])
+        target["n"] += item["weight"]
+        target["size"] = _day_size(
+            target["from"], target["to"], target["n"], item["agg_period"]
+        )
+        target["names"].add(item["name"])
+        target["elements"].extend(item["elements"])
+        if (
+            _day_size(
+                target["from"],
+                target["to"],
+                target["n"] + min_weight,
+                item["agg_period"],
+            )
+            > max_size
+        ):
+            # Not even a one day element would fit anymore
+            candidates.remove(target)
+    return [queue.rows(b["elements"]) for b in bins]
+
+
+def _slice_bounds(stations: list[dict[str, Any]]) -> dict[str, Any]:
+    return {
+        "from": min(s["from"] for s in stations),
+        "to": max(s["to"] for s in stations),
+        "agg_period": min(s["agg_period"] for s in stations),
+        "v": frozenset(s["v"] for s in stations),
+        "names": {normalize_name(s["name"]): s["id"] for s in stations},
+        "weights": _series_weights(stations),
+        "size": request_elements(stations),
+        "elements": stations,
+    }
+
+
+def _mergeable(a, b, max_size) -> Optional[int]:
+    # Size of the merged slice if a and b can be requested together, None otherwise
+    if a["v"] != b["v"] or a["agg_period"] != b["agg_period"]:
+        return None
+    for name, sid in b["names"].items():
+        if a["names"].get(name, sid) != sid:
+            return None
+    n_stations = _request_weight(a["weights"] | b["weights"])
+    size = slice_size(
+        min(a["from"], b["from"]), max(a["to"], b["to"]), n_stations, a["agg_period"]
+    )
+    return size if size <= max_size else None
+
+
+def merge_slices(slices: list[list[dict[str, Any]]], max_size, max_rounds=10):
+    """
+    Bounded local search reducing the number of slices: repeatedly merges the slices filling at most half of a request
+    into the compatible slice that results in the fullest request. Slices can be merged across timeline sections, and the same station
+    appearing in both slices (e.g. adjacent timeline sections) is requested once.
+
+    Args:
+        slices (list[list[dict[str, Any]]]): The slices to refine, e.g. the greedy ones.
+        max_size (int): The maximum number of lines of a request, as computed by `request_elements`.
+        max_rounds (int, optional): The maximum number of passes over the slices. Defaults to 10.
+
+    Returns:
+        list[list[dict[str, Any]]]: The merged slices.
+    """
+    bounds = [_slice_bounds(s) for s in slices if s]
+    for _ in range(max_rounds):
+        bounds.sort(key=lambda b: b["size"])
+        merged = [False] * len(bounds)
+        changed = False
+        for i, small in enumerate(bounds):
+            if small["size"] > max_size // 2:
+                # Two bigger slices fit together only if they share stations over overlapping periods, which is rare
+                break
+            if merged[i]:
+                continue
+            best, best_size = None, None
+            for j in range(len(bounds) - 1, i, -1):
+                if merged[j]:
+                    continue
+                size = _mergeable(bounds[j], small, max_size)
+                if size is not None and (best_size is None or size > best_size):
+                    best, best_size = j, size
+                    if size == max_size:
+                        break
+            if best is not None:
+                bounds[best] = _slice_bounds(
+                    bounds[best]["elements"] + small["elements"]
+                )
+                merged[i] = True
+                changed = True
+        bounds = [b for b, m in zip(bounds, merged) if not m]
+        if not changed:
+            break
+    return [b["elements"] for b in bounds]
+
+
+def plan_summary(slices: list[list[dict[str, Any]]], max_size) -> dict[str, Any]:
+    """
+    Summarizes a request plan.
+
+    Args:
+        slices (list[list[dict[str, Any]]]): The planned slices.
+        max_size (int): The maximum number of lines of a request used for planning.
+
+    Returns:
+        dict[str, Any]: The number of requests, the estimated number of lines and the fill ratio of the requests.
+    """
+    lines = sum(request_elements(s) for s in slices)
+    return {
+        "requests": len(slices),
+        "lines": lines,
+        "fill_ratio": lines / (len(slices) * max_size) if slices else 0.0,
+    }
+
+
+# The plans compared by each strategy, the first one winning ties
+PLAN_CANDIDATES = {
+    "greedy": ["greedy"],
+    "merge": ["merge"],
+    "bfd": ["bfd_merged", "bfd"],
+    "best": ["merge", "bfd_merged", "bfd"],
+}
+
+
+def _nominal_lines(stations: list[dict[str, Any]]) -> int:
+    # The lines of a request counting every station, whatever its weight, as the service does
+    return request_elements([{**s, "weight": 1} for s in stations])
+
+
+def clamp_slices(
+    slices: list[list[dict[str, Any]]], max_lines: int
+) -> list[list[dict[str, Any]]]:
+    """
+    Splits the slices whose nominal lines, counting the whole requested period of every station, exceed the line limit
+    that the service checks. Weighted slices (see `RequestQueue`) can, as their stations count for fewer lines than
+    they request. The stations of a slice are packed into smaller slices in order, or the periods of a slice with a
+    single station; the elements of a station and period stay together.
+
+    Args:
+        slices (list[list[dict[str, Any]]]): The slices, as returned by `plan_slices`.
+        max_lines (int): The line limit of the service.
+
+    Returns:
+        list[list[dict[str, Any]]]: The slices within the limit, except the ones that cannot be split.
+    """
+    clamped = []
+    for queue_slice in slices:
+        if _nominal_lines(queue_slice) <= max_lines:
+            clamped.append(queue_slice)
+            continue
+        groups: dict[Any, list[dict[str, Any]]] = {}
+        several_stations = len({s["id"] for s in queue_slice}) > 1
+        for s in queue_slice:
+            key = s["id"] if several_stations else (s["from"], s["to"])
+            groups.setdefault(key, []).append(s)
+        if len(groups) == 1:
+            # One station and period, whose variables are requested together
+            clamped.append(queue_slice)
+            continue
+        pieces = [[]]
+        for group in groups.values():
+            if pieces[-1] and _nominal_lines(pieces[-1] + group) > max_lines:
+                pieces.append([])
+            pieces[-1].extend(group)
+        # A station spanning several periods can still be too big on its own
+        clamped.extend(clamp_slices(pieces, max_lines))
+    return clamped
+
+
+def plan_slices(
+    sorted_queue,
+    max_size,
+    strategy: str = "greedy",
+    max_lines: Optional[int] = None,
+):
+    """
+    Splits the whole queue into slices to be requested.
+
+    Args:
+        sorted_queue (RequestQueue | list[dict[str, Any]]): The queue elements, sorted as returned by
+            `make_request_queue`.
+        max_size (int): The maximum number of lines of a request.
+        strategy (str, optional): "greedy" to repeatedly pop the biggest slice as `pop_biggest_slice` does, "merge" to
+            refine the greedy slices with `merge_slices`, "bfd" to pack with `best_fit_decreasing`, keeping the plan
+            with fewer requests between merging adjacent timeline sections or not, "best" to keep the plan with fewer
+            requests between "merge" and "bfd". Defaults to "greedy".
+        max_lines (int, optional): The line limit checked by the service, on the nominal lines of the requests: the
+            slices of weighted elements above it are split (see `clamp_slices`). Defaults to None, not checking it.
+
+    Returns:
+        list[list[dict[str, Any]]]: The slices.
+    """
+    sorted_queue = as_request_queue(sorted_queue)
+    if strategy not in PLAN_CANDIDATES:
+        raise ValueError(f"Unknown planning strategy '{strategy}'")
+    # Each candidate plan is computed once, even if several strategies compare it
+    plans: dict[str, list[list[dict[str, Any]]]] = {}
+
+    def plan(candidate: str) -> list[list[dict[str, Any]]]:
+        if candidate not in plans:
+            if candidate == "greedy":
+                queue = SliceQueue(sorted_queue)
+                slices = []
+                while len(queue) > 0:
+                    slices.append(queue.pop_slice_indices(max_size))
+                plans[candidate] = [sorted_queue.rows(s) for s in slices]
+            elif candidate == "merge":
+                plans[candidate] = merge_slices(plan("greedy"), max_size)
+            else:
+                plans[candidate] = best_fit_decreasing(
+                    sorted_queue, max_size, merge_sections=candidate == "bfd_merged"
+                )
+        return plans[candidate]
+
+    def clamped(candidate: str) -> list[list[dict[str, Any]]]:
+        if max_lines is None:
+            return plan(candidate)
+        return clamp_slices(plan(candidate), max_lines)
+
+    return min((clamped(c) for c in PLAN_CANDIDATES[strategy]), key=len)
@@ -0,0 +1,129 @@
+from typing import Any, Mapping
+
+import polars as pl
+
+from .ledger import Payloads
+from .spatial import PLACE_COLUMNS, integer_coordinate
+
+
+def payload_stations(payloads: Mapping[str, Any], tasks: list[str]) -> pl.DataFrame:
+    """
+    Lists the stations requested by each of the given tasks that has a payload.
+
+    Returns:
+        pl.DataFrame: One (task, id) row per requested station.
+    """
+    schema = {"task": pl.Utf8(), "id": pl.Utf8()}
+    if isinstance(payloads, Payloads):
+        # The ledger payloads are already a table
+        return (
+            payloads.frame.filter(pl.col("task_id").is_in(tasks))
+            .select(pl.col("task_id").alias("task"), pl.col("station").alias("id"))
+            .explode("id")
+            .drop_nulls()
+            .cast(schema)
+        )
+    rows = [
+        (task, str(station))
+        for task in tasks
+        if payloads.get(task)
+        for station in payloads[task]["station"]
+    ]
+    return pl.DataFrame(rows, schema=schema, orient="row")
+
+
+class StationResolver:
+    """
+    Matches the stations listed in Dext3r result files with the station ids, for many tasks at once.
+
+    The index of the station information (names, networks and integer coordinates, and which (network, name) pairs are
+    ambiguous) is built once. The metadata of any number of tasks is then resolved with a single join, with the same
+    rules as `join_station_id`: the stations of a task with payload are looked up among the requested ones, the others
+    by network and name, with the coordinates and elevation breaking the ties.
+
+    Args:
+        stations_metadata (pl.DataFrame): The station information, as returned by `list_available_stations`.
+    """
+
+    def __init__(self, stations_metadata: pl.DataFrame):
+        self.stations = stations_metadata.cast({"id": pl.Utf8()})
+        self.index = self.stations.select(
+            "id",
+            "network",
+            "name",
+            pl.col("lon").alias("int_lon"),
+            pl.col("lat").alias("int_lat"),
+            pl.col("height").cast(pl.Int32()).alias("int_elevation"),
+            pl.struct("network", "name").is_duplicated().alias("dubious"),
+        )
+
+    def resolve(self, metas: pl.DataFrame, payloads: Mapping[str, Any]) -> pl.DataFrame:
+        """
+        Resolves the station ids of the tasks.
+
+        Args:
+            metas (pl.DataFrame): The station metadata of the tasks, as read from the result files, with a "task" column.
+            payloads (Mapping[str, Any]): The payloads of the tasks.
+
+        Returns:
+            pl.DataFrame: The (task, name, id) of every station that could be matched.
+        """
+        duplicated = pl.col("name").is_duplicated().over("task")
+        for task in metas.filter(duplicated)["task"].unique(maintain_order=True):
+            print(
+                f"Warning: duplicated station names in task {task} metadata. Could not join those."
+            )
+        metas = metas.filter(~duplicated).select(
+            "task",
+            "network",
+            "name",
+            integer_coordinate("lon").alias("task_lon"),
+            integer_coordinate("lat").alias("task_lat"),
+            pl.col("elevation").cast(pl.Int32()).alias("task_elevation"),
+        )
+        requested = payload_stations(
+            payloads, metas["task"].unique(maintain_order=True).to_list()
+        )
+        candidates = metas.join(self.index, on=["network", "name"], how="inner")
+        with_payload = candidates.join(requested, on=["task", "id"], how="semi")
+        without_payload = candidates.join(requested, on="task", how="anti").filter(
+            ~pl.col("dubious")
+            | (
+                (pl.col("int_lon") == pl.col("task_lon"))
+                & (pl.col("int_lat") == pl.col("task_lat"))
+                & (pl.col("int_elevation") == pl.col("task_elevation"))
+            )
+        )
+        return pl.concat([with_payload, without_payload], how="vertical").select(
+            "task", "name", "id"
+        )
+
+    def resolve_tasks(
+        self, metas: pl.DataFrame, data: pl.DataFrame, payloads: Mapping[str, Any]
+    ) -> tuple[pl.DataFrame, pl.DataFrame]:
+        """
+        Resolves the station ids of results read without station information (see `read_dext3r_tables`).
+
+        Args:
+            metas (pl.DataFrame): The station metadata of the tasks, with a "task" column.
+            data (pl.DataFrame): The data of the tasks, with "name" and "task" columns.
+            payloads (Mapping[str, Any]): The payloads of the tasks.
+
+        Returns:
+            tuple[pl.DataFrame, pl.DataFrame]: The station information of the matched stations, with their task and
+                their place columns from the file (see `lib.spatial.PLACE_COLUMNS`), and their data, with the station ids
+                in place of the names.
+        """
+        ids = self.resolve(metas, payloads)
+        # The place of the stations is only known from the result files
+        places = metas.select(
+            "task", "name", *(c for c in PLACE_COLUMNS if c in metas.columns)
+        ).unique(["task", "name"])
+        return (
+            self.stations.join(ids, on=["id", "name"], how="inner").join(
+                places, on=["task", "name"], how="left"
+            ),
+            data.join(ids, on=["task", "name"], how="inner").select(
+                "start", "stop", "value", "variable", "id", "task"
+            ),
+        )
@@ -0,0 +1,413 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+import polars as pl
+
+DATA_SCHEMA = {
+    "start": pl.Datetime(time_unit="us", time_zone="UTC"),
+    "stop": pl.Datetime(time_unit="us", time_zone="UTC"),
+    "value": pl.Float64(),
+    "id": pl.Utf8(),
+    "task": pl.Utf8(),
+}
+PARTITION_SCHEMA = {
+    "variable": pl.Utf8(),
+    "agg_period": pl.Int32(),
+    "year": pl.Int32(),
+}
+# One entry per partition file and station: the first and last measurement, the rows, the null values and the tasks
+CATALOG_SCHEMA = PARTITION_SCHEMA | {
+    "id": pl.Utf8(),
+    "first": pl.Datetime(time_unit="us", time_zone="UTC"),
+    "last": pl.Datetime(time_unit="us", time_zone="UTC"),
+    "rows": pl.Int64(),
+    "nulls": pl.Int64(),
+    "tasks": pl.List(pl.Utf8()),
+    "file": pl.Utf8(),
+    "mtime_ns": pl.Int64(),
+}
+
+
+def partition_path(root: Path, variable: str, agg_period: int, year: int) -> Path:
+    return (
+        Path(root)
+        / f"variable={variable}"
+        / f"agg_period={agg_period}"
+        / f"year={year}"
+        / "data.parquet"
+    )
+
+
+def partition_values(path: Path) -> tuple[str, int, int]:
+    """
+    Returns the variable, the aggregation period and the year of a partition file.
+    """
+    return (
+        path.parent.parent.parent.name.split("=", 1)[1],
+        int(path.parent.parent.name.split("=", 1)[1]),
+        int(path.parent.name.split("=", 1)[1]),
+    )
+
+
+def with_partitions(data: pl.DataFrame) -> pl.DataFrame:
+    """
+    Adds the partition columns to data as returned by `read_dext3r_tables`. The aggregation period is the length of
+    the measurement interval, in seconds.
+    """
+    return data.with_columns(
+        (pl.col("stop") - pl.col("start"))
+        .dt.total_seconds()
+        .cast(pl.Int32())
+        .alias("agg_period"),
+        pl.col("start").dt.year().cast(pl.Int32()).alias("year"),
+    )
+
+
+def _merge(existing: Optional[pl.DataFrame], new: pl.DataFrame) -> pl.DataFrame:
+    # On duplicated keys, non-null values win over null ones, then the newest data wins
+    frames = [new.select(list(DATA_SCHEMA)).with_columns(pl.lit(1).alias("_order"))]
+    if existing is not None:
+        frames.insert(0, existing.with_columns(pl.lit(0).alias("_order")))
+    return (
+        pl.concat(frames, how="vertical_relaxed")
+        .sort("id", "start", pl.col("value").is_not_null(), "_order")
+        .unique(["id", "start"], keep="last", maintain_order=True)
+        .drop("_order")
+    )
+
+
+def _write_atomic(frame: pl.DataFrame, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".parquet.tmp")
+    frame.write_parquet(tmp_path, statistics=True)
+    os.replace(tmp_path, path)
+
+
+def write_measurements(
+    root: str | Path,
+    data: pl.DataFrame,
+    replaced_tasks: Optional[list[str]] = None,
+    replaced_files: Optional[list[str | Path]] = None,
+) -> list[Path]:
+    """
+    Merges measurements into the store, partitioned by variable, aggregation period and year. Each partition is a
+    single parquet file sorted by station and time, deduplicated on (id, start, variable). The catalog entries of the
+    written partitions are updated (see `read_catalog`).
+
+    The previous measurements of tasks read again can be replaced in the same pass: they are removed from their
+    partition files and from the written partitions, so that each file and the catalog are rewritten once.
+
+    Args:
+        root (str | Path): The root directory of the store.
+        data (pl.DataFrame): The measurements, as returned by `read_dext3r_tables`.
+        replaced_tasks (list[str], optional): The tasks whose previous measurements are removed. Defaults to None.
+        replaced_files (list[str | Path], optional): The partition files of the previous measurements of the replaced
+            tasks. Defaults to None.
+
+    Returns:
+        list[Path]: The partition files that were written.
+    """
+    parts: dict[Path, Optional[pl.DataFrame]] = {}
+    if not data.is_empty():
+        for (variable, agg_period, year), part in with_partitions(data).group_by(
+            list(PARTITION_SCHEMA)
+        ):
+            parts[partition_path(root, variable, agg_period, year)] = part
+    if replaced_tasks:
+        for path in map(Path, replaced_files or []):
+            parts.setdefault(path, None)
+    return _rewrite_partitions(root, parts, replaced_tasks)
+
+
+def _rewrite_partitions(
+    root: str | Path,
+    parts: dict[Path, Optional[pl.DataFrame]],
+    tasks: Optional[list[str]],
+) -> list[Path]:
+    # Removes the measurements of the tasks from each partition file and merges its new measurements, if any
+    written = []
+    entries = {}
+    for path, part in parts.items():
+        existing = pl.read_parquet(path) if path.exists() else None
+        if existing is not None and tasks:
+            existing = existing.filter(~pl.col("task").is_in(tasks))
+        if part is not None:
+            merged = _merge(existing, part)
+        elif existing is None:
+            continue
+        else:
+            merged = existing
+        if merged.is_empty():
+            path.unlink()
+            entries[path] = None
+            continue
+        _write_atomic(merged, path)
+        entries[path] = _catalog_entries(root, path, merged)
+        written.append(path)
+    update_catalog(root, entries)
+    return written
+
+
+def task_partitions(root: str | Path, data: pl.DataFrame) -> list[Path]:
+    """
+    Lists the partition files that the given measurements are written to.
+    """
+    return [
+        partition_path(root, *partition)
+        for partition in with_partitions(data)
+        .select(list(PARTITION_SCHEMA))
+        .unique()
+        .iter_rows()
+    ]
+
+
+def delete_tasks(root: str | Path, tasks: list[str], files: list[str | Path]):
+    """
+    Removes the measurements of the given tasks from the partition files, and updates their catalog entries.
+    """
+    _rewrite_partitions(root, dict.fromkeys(map(Path, files)), tasks)
+
+
+def metas_path(root: str | Path) -> Path:
+    return Path(root) / "stations.parquet"
+
+
+def write_task_metas(root: str | Path, metas: pl.DataFrame):
+    """
+    Merges the station metadata of the tasks, as returned by `read_dext3r_tables`, into the store.
+    """
+    path = metas_path(root)
+    if path.exists():
+        metas = pl.concat([pl.read_parquet(path), metas], how="diagonal_relaxed")
+    _write_atomic(
+        metas.unique(["task", "name"], keep="last", maintain_order=True), path
+    )
+
+
+def catalog_path(root: str | Path) -> Path:
+    return Path(root) / "catalog.parquet"
+
+
+def _relative(root: str | Path, path: Path) -> str:
+    return Path(path).relative_to(root).as_posix()
+
+
+def _catalog_entries(root: str | Path, path: Path, data: pl.DataFrame) -> pl.DataFrame:
+    # The entries of a partition file, from its content
+    variable, agg_period, year = partition_values(path)
+    return (
+        data.group_by("id")
+        .agg(
+            pl.col("start").min().alias("first"),
+            pl.col("start").max().alias("last"),
+            pl.len().alias("rows"),
+            pl.col("value").null_count().alias("nulls"),
+            pl.col("task").unique().sort().alias("tasks"),
+        )
+        .with_columns(
+            pl.lit(variable).alias("variable"),
+            pl.lit(agg_period).alias("agg_period"),
+            pl.lit(year).alias("year"),
+            pl.lit(_relative(root, path)).alias("file"),
+            pl.lit(path.stat().st_mtime_ns).alias("mtime_ns"),
+        )
+        .select(list(CATALOG_SCHEMA))
+        .cast(CATALOG_SCHEMA)
+    )
+
+
+def _read_catalog_file(root: str | Path) -> pl.DataFrame:
+    path = catalog_path(root)
+    if not path.exists():
+        return pl.DataFrame(schema=CATALOG_SCHEMA)
+    return pl.read_parquet(path)
+
+
+def update_catalog(root: str | Path, entries: dict[Path, Optional[pl.DataFrame]]):
+    """
+    Replaces the catalog entries of partition files.
+
+    Args:
+        root (str | Path): The root directory of the store.
+        entries (dict[Path, pl.DataFrame | None]): The new entries of each partition file, None if it was deleted.
+    """
+    if not entries:
+        return
+    files = [_relative(root, path) for path in entries]
+    catalog = _read_catalog_file(root).filter(~pl.col("file").is_in(files))
+    _write_atomic(
+        pl.concat(
+            [catalog] + [e for e in entries.values() if e is not None],
+            how="vertical",
+        ).sort("variable", "agg_period", "year", "id"),
+        catalog_path(root),
+    )
+
+
+def read_catalog(root: str | Path) -> pl.DataFrame:
+    """
+    Reads the catalog of the store: for each partition file and station, the first and last measurement start, the
+    rows, the null values and the tasks. It is kept up to date by `write_measurements` and `delete_tasks`; the entries
+    of the partition files changed otherwise (e.g. by an interrupted ingestion, or before the catalog existed) are
+    rebuilt from their content.
+
+    Returns:
+        pl.DataFrame: The catalog entries, with the CATALOG_SCHEMA columns.
+    """
+    root = Path(root)
+    catalog = _read_catalog_file(root)
+    current = {_relative(root, p): p for p in partition_files(root)}
+    cataloged = dict(catalog.select("file", "mtime_ns").unique("file").iter_rows())
+    entries = {
+        path: _catalog_entries(root, path, pl.read_parquet(path))
+        for file, path in current.items()
+        if cataloged.get(file) != path.stat().st_mtime_ns
+    } | {root / file: None for file in cataloged if file not in current}
+    if entries:
+        update_catalog(root, entries)
+        catalog = _read_catalog_file(root)
+    return catalog
+
+
+def series_catalog(root: str | Path) -> pl.DataFrame:
+    """
+    Summarizes the stored measurements of each series from the catalog (see `read_catalog`), without reading them.
+
+    Returns:
+        pl.DataFrame: The (id, variable, agg_period) series, with their first and last measurement start, their rows
+            and null values, and the partition files and tasks containing them.
+    """
+    return (
+        read_catalog(root)
+        .group_by("id", "variable", "agg_period")
+        .agg(
+            pl.col("first").min(),
+            pl.col("last").max(),
+            pl.col("rows").sum(),
+            pl.col("nulls").sum(),
+            pl.col("file").alias("files"),
+            pl.col("tasks").flatten().unique().sort(),
+        )
+        .sort("id", "variable", "agg_period")
+    )
+
+
+def _prune_files(
+    root: str | Path,
+    files: list[Path],
+    ids: Optional[list[str]],
+    from_date: Optional[date],
+    to_date: Optional[date],
+) -> list[Path]:
+    # Drops the partition files that the catalog says contain none of the stations in the date range. Files changed
+    # since they were cataloged are kept.
+    catalog = _read_catalog_file(root)
+    mtimes = dict(catalog.select("file", "mtime_ns").unique("file").iter_rows())
+    cataloged = {
+        _relative(root, path): path
+        for path in files
+        if mtimes.get(_relative(root, path)) == path.stat().st_mtime_ns
+    }
+    matching = catalog.filter(pl.col("file").is_in(list(cataloged)))
+    if ids is not None:
+        matching = matching.filter(pl.col("id").is_in(ids))
+    if from_date is not None:
+        matching = matching.filter(pl.col("last") >= _utc_midnight(from_date))
+    if to_date is not None:
+        matching = matching.filter(
+            pl.col("first") < _utc_midnight(to_date + timedelta(days=1))
+        )
+    keep = set(matching["file"].to_list())
+    return [
+        path
+        for path in files
+        if _relative(root, path) not in cataloged or _relative(root, path) in keep
+    ]
+
+
+def read_task_metas(root: str | Path) -> pl.DataFrame:
+    """
+    Reads the station metadata of the ingested tasks.
+    """
+    path = metas_path(root)
+    if not path.exists():
+        return pl.DataFrame(
+            schema={"task": pl.Utf8(), "name": pl.Utf8(), "id": pl.Utf8()}
+        )
+    return pl.read_parquet(path)
+
+
+def partition_files(
+    root: str | Path,
+    variable: Optional[str | list[str]] = None,
+    agg_period: Optional[int] = None,
+    years: Optional[tuple[int, int]] = None,
+) -> list[Path]:
+    """
+    Lists the partition files matching the given variables, aggregation period and (inclusive) year range.
+    """
+    if isinstance(variable, str):
+        variable = [variable]
+    files = []
+    for path in sorted(Path(root).glob("variable=*/agg_period=*/year=*/data.parquet")):
+        v, p, y = partition_values(path)
+        if variable is not None and v not in variable:
+            continue
+        if agg_period is not None and p != agg_period:
+            continue
+        if years is not None and not (years[0] <= y <= years[1]):
+            continue
+        files.append(path)
+    return files
+
+
+def _utc_midnight(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def query(
+    root: str | Path,
+    ids: Optional[list[str]] = None,
+    from_date: Optional[date] = None,
+    to_date: Optional[date] = None,
+    variable: Optional[str | list[str]] = None,
+    agg_period: Optional[int] = None,
+) -> pl.LazyFrame:
+    """
+    Queries the measurement store. Only the partitions matching the variables, the aggregation period and the years of
+    the date range are scanned, and the station and date filters are pushed down to the parquet reader. When stations
+    are given, the partitions that the catalog says do not contain them in the date range are skipped as well.
+
+    Args:
+        root (str | Path): The root directory of the store.
+        ids (list[str], optional): The station ids. Defaults to all.
+        from_date (date, optional): The first day of the measurements. Defaults to the beginning of the data.
+        to_date (date, optional): The last day of the measurements. Defaults to the end of the data.
+        variable (str | list[str], optional): The variables. Defaults to all.
+        agg_period (int, optional): The aggregation period in seconds. Defaults to all.
+
+    Returns:
+        pl.LazyFrame: The measurements, with the partition columns.
+    """
+    years = None
+    if from_date is not None or to_date is not None:
+        years = (
+            from_date.year if from_date is not None else 0,
+            to_date.year if to_date is not None else 9999,
+        )
+    files = partition_files(root, variable, agg_period, years)
+    if ids is not None and catalog_path(root).exists():
+        files = _prune_files(root, files, ids, from_date, to_date)
+    if not files:
+        return pl.LazyFrame(schema=DATA_SCHEMA | PARTITION_SCHEMA)
+    data = pl.scan_parquet(files, hive_partitioning=True, hive_schema=PARTITION_SCHEMA)
+    if ids is not None:
+        data = data.filter(pl.col("id").is_in(ids))
+    # Comparing with datetime literals keeps the filters usable with the parquet statistics
+    if from_date is not None:
+        data = data.filter(pl.col("start") >= _utc_midnight(from_date))
+    if to_date is not None:
+        data = data.filter(pl.col("start") < _utc_midnight(to_date + timedelta(days=1)))
+    return data
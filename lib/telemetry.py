@@ -0,0 +1,160 @@
+import json
+import math
+import os
+import threading
+from bisect import bisect_left
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+# Upper bounds of the histogram buckets, by metric name
+BUCKETS = {
+    "dext3r_request_seconds": [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+    "dext3r_request_lines": [1000, 2500, 5000, 10000, 15000, 18000, 20000, 25000],
+}
+DEFAULT_BUCKETS = [0.01, 0.1, 1, 10, 100, 1000, 10000]
+
+HELP = {
+    "dext3r_requests_total": "Data requests sent, by account and response status.",
+    "dext3r_request_seconds": "Latency of the data requests.",
+    "dext3r_request_lines": "Estimated lines of the data requests.",
+    "dext3r_request_errors_total": "Data requests that raised an exception, by exception type.",
+    "dext3r_tasks_total": "Tasks registered in the ledger.",
+    "dext3r_ingested_rows_total": "Data rows written to the measurement store.",
+    "dext3r_slices_abandoned_total": "Slices given up after the maximum number of tries.",
+    "dext3r_pause_seconds": "Current pause between requests, by account.",
+    "dext3r_queue_slices": "Slices still to be requested.",
+}
+
+
+def _labels(labels: dict[str, Any]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_value(value: float) -> str:
+    # Integers are written exactly and floats with the shortest repr that reads back as the same value
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...], **extra) -> str:
+    pairs = list(labels) + [(k, str(v)) for k, v in extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Telemetry:
+    """
+    Structured events and metrics of a download.
+
+    Events are appended to a JSON lines file, one object per line with its UTC time and kind. Counters, gauges and
+    histograms are kept in memory and can be exported in the Prometheus text format, e.g. to a file read by the
+    node_exporter textfile collector. The methods can be called from several threads.
+
+    Args:
+        events_path (str | Path, optional): The events file. Defaults to None, keeping only the metrics.
+        metrics_path (str | Path, optional): The file rewritten by `export`. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        events_path: Optional[str | Path] = None,
+        metrics_path: Optional[str | Path] = None,
+    ):
+        self.events_path = Path(events_path) if events_path is not None else None
+        self.metrics_path = Path(metrics_path) if metrics_path is not None else None
+        self.lock = threading.Lock()
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.gauges: dict[str, dict[tuple, float]] = {}
+        # name -> labels -> (bucket counts, sum, count)
+        self.histograms: dict[str, dict[tuple, list]] = {}
+
+    def event(self, kind: str, **fields):
+        """
+        Appends an event to the events file.
+        """
+        if self.events_path is None:
+            return
+        record = {"time": datetime.now(timezone.utc).isoformat(), "event": kind}
+        line = json.dumps(record | fields, default=str, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.events_path, "at") as f:
+                f.write(line)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = BUCKETS.get(name, DEFAULT_BUCKETS)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            state = series.setdefault(_labels(labels), [[0] * len(buckets), 0.0, 0])
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def prometheus(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name, series in sorted(metrics.items()):
+                    lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in sorted(series.items()):
+                        lines.append(
+                            f"{name}{_format_labels(labels)} {_format_value(value)}"
+                        )
+            for name, series in sorted(self.histograms.items()):
+                buckets = BUCKETS.get(name, DEFAULT_BUCKETS)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, (counts, total, count) in sorted(series.items()):
+                    cumulative = 0
+                    for bound, n in zip(buckets, counts):
+                        cumulative += n
+                        lines.append(
+                            f"{name}_bucket{_format_labels(labels, le=_format_value(bound))} {cumulative}"
+                        )
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels, le='+Inf')} {count}"
+                    )
+                    lines.append(
+                        f"{name}_sum{_format_labels(labels)} {_format_value(total)}"
+                    )
+                    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: Optional[str | Path] = None):
+        """
+        Atomically writes the metrics in the Prometheus text format to `path`, or to `metrics_path`.
+        """
+        path = Path(path) if path is not None else self.metrics_path
+        if path is None:
+            return
+        text = self.prometheus()
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with self.lock:
+            tmp_path.write_text(text)
+            os.replace(tmp_path, path)
@@ -0,0 +1,54 @@
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BASE_URL = "https://simc.arpae.it/meteozen"
+
+
+class Transport:
+    """
+    HTTP access to the Dext3r service through a pooled keep-alive session.
+
+    Args:
+        base_url (str, optional): The root of the service endpoints. Defaults to the production Dext3r service.
+        pool_size (int, optional): The number of connections kept alive. Defaults to 10.
+        timeout (float, optional): The timeout of each request in seconds. Defaults to 120.
+    """
+
+    def __init__(self, base_url: str = BASE_URL, pool_size: int = 10, timeout=120):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path: str, params=None, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(self.url(path), params=params, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_transport: Optional[Transport] = None
+
+
+def default_transport() -> Transport:
+    """
+    Returns the transport shared by the functions that are not given one, connected to the production service.
+    """
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = Transport()
+    return _default_transport
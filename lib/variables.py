@@ -0,0 +1,90 @@
+import re
+
+import polars as pl
+
+# Variables of the measurement store, by name: their B-table code, their aggregation code and a pattern matching the
+# header of their result tables, e.g. "Temperatura massima dell'aria (C)": the measured quantity first, then the
+# statistic. Headers are matched in this order.
+# ref: https://arpa-simc.github.io/dballe/general_ref/btable.html
+# ref: https://arpa-simc.github.io/dballe/general_ref/tranges.html
+VARIABLES = {
+    "T_MAX": ("B12101", 2, r"[Tt]emperatura\b.*\bmassima"),
+    "T_MIN": ("B12101", 3, r"[Tt]emperatura\b.*\bminima"),
+    "T_MEAN": ("B12101", 0, r"[Tt]emperatura\b.*\bmedia"),
+    # The cumulated precipitation, not its other statistics
+    "PREC": ("B13011", 1, r"[Pp]recipitazione\b(?!.*\b(?:massima|minima|media)\b)"),
+}
+
+_v_regex = re.compile(r"(\d+),[^/]*/[^/]*/(B\d{5})")
+
+
+def register_variable(name: str, code: str, agg_code: int, header_pattern: str):
+    """
+    Adds a variable to the registry, or replaces it.
+
+    Args:
+        name (str): The name of the variable in the measurement store, e.g. "T_MAX".
+        code (str): The B-table code, e.g. "B12101".
+        agg_code (int): The aggregation code, e.g. 2 for the maximum.
+        header_pattern (str): A regular expression matching the header of its result tables.
+    """
+    VARIABLES[name] = (code, int(agg_code), header_pattern)
+
+
+def variable_name(v: str) -> str:
+    """
+    Returns the name of a Dext3r variable, e.g. "T_MAX" for "2,0,86400/103,2000,-,-/B12101". Variables missing from
+    the registry are named after their B-table and aggregation codes, e.g. "B13003_0".
+    """
+    found = _v_regex.search(v)
+    if found is None:
+        raise ValueError(f"Not a Dext3r variable: {v}")
+    agg_code, code = int(found.group(1)), found.group(2)
+    for name, (registered_code, registered_agg_code, _) in VARIABLES.items():
+        if (registered_code, registered_agg_code) == (code, agg_code):
+            return name
+    return f"{code}_{agg_code}"
+
+
+def header_variable(header: str) -> str:
+    """
+    Returns the name of the variable of a result table from its header.
+
+    Raises:
+        ValueError: If the header matches no registered variable and contains no Dext3r variable.
+    """
+    for name, (_, _, pattern) in VARIABLES.items():
+        if re.search(pattern, header):
+            return name
+    if _v_regex.search(header):
+        return variable_name(header)
+    raise ValueError(f"Unknown variable in result table header: {header.strip()}")
+
+
+def with_variable_names(frame: pl.LazyFrame, column: str = "v") -> pl.LazyFrame:
+    """
+    Adds the "variable" column with the names of the Dext3r variables in `column`. See `variable_name`.
+    """
+    registry = pl.LazyFrame(
+        [(code, agg_code, name) for name, (code, agg_code, _) in VARIABLES.items()],
+        schema={"_code": pl.Utf8(), "_agg_code": pl.Int64(), "variable": pl.Utf8()},
+        orient="row",
+    )
+    return (
+        frame.with_columns(
+            pl.col(column)
+            .str.extract(r"^(\d+),", 1)
+            .cast(pl.Int64())
+            .alias("_agg_code"),
+            pl.col(column).str.extract(r"(B\d{5})$", 1).alias("_code"),
+        )
+        .join(registry, on=["_code", "_agg_code"], how="left")
+        .with_columns(
+            pl.col("variable").fill_null(
+                pl.concat_str(
+                    "_code", pl.col("_agg_code").cast(pl.Utf8()), separator="_"
+                )
+            )
+        )
+        .drop("_code", "_agg_code")
+    )
@@ -1,9 +1,7 @@
 from pathlib import Path
-import json
-from datetime import datetime
 from typing import Any
 
-import polars as pl
+from .ledger import TaskLedger
 
 
 def register_request_task(previous_requests: list[dict[str, Any]], station, task_id):
@@ -11,30 +9,15 @@ def register_request_task(previous_requests: list[dict[str, Any]], station, task
 
 
 def register_task_payload(task_id, payload, path):
-    if Path(path).exists():
-        with open(path, "rt") as f:
-            data = json.load(f)
-    else:
-        data = {}
-    data[task_id] = payload
-    data[task_id]["request_time"] = datetime.now().strftime(r"%Y-%m-%dT%H:%M:%SZ")
-    with open(path, "wt") as f:
-        json.dump(data, f)
+    TaskLedger(Path(path).with_name("requests.jsonl"), path).append_payload(
+        task_id, payload
+    )
 
 
 def register_task_content(task_id, stations, path):
-    if not Path(path).exists():
-        print(f"Requests file does not exist at {path}")
-        data = []
-    else:
-        data = (
-            pl.read_csv(path)
-            .with_columns(pl.col("from").str.to_date(), pl.col("to").str.to_date())
-            .to_dicts()
-        )
-    for station in stations:
-        register_request_task(data, station, task_id)
-    pl.from_dicts(data).write_csv(path)
+    TaskLedger(path, Path(path).with_name("payloads.jsonl")).append_requests(
+        task_id, stations
+    )
 
 
 def register_task(
@@ -43,5 +26,4 @@ def register_task(
     payload: dict[str, Any],
     paths: str | Path,
 ):
-    register_task_content(task_id, stations, paths[0])
-    register_task_payload(task_id, payload, paths[1])
+    TaskLedger(paths[0], paths[1]).append(task_id, stations, payload)
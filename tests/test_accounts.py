@@ -0,0 +1,125 @@
+import asyncio
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import lib.accounts
+from lib.accounts import AccountPool
+from lib.download_manager import Dext3rDownloader
+from lib.mock_server import MockDext3r
+from lib.transport import Transport
+
+
+def tomorrow() -> datetime:
+    return datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+
+
+def test_refused_account_cools_down_until_midnight(tmp_path):
+    pool = AccountPool(tmp_path / "accounts.json", ["a", "b"])
+
+    until = pool.record_error("a", 403, "Quota exceeded")
+
+    assert until == tomorrow()
+    assert pool.cooldown("a") > 0
+    assert pool.choose() == "b"
+    assert pool.choose(exclude=("b",)) is None
+    # The cooldown survives a restart
+    restarted = AccountPool(tmp_path / "accounts.json", ["a", "b"])
+    assert restarted.cooldown("a") > 0
+    assert restarted.usage["a"]["last_error"] == "403: Quota exceeded"
+
+
+def test_retry_after_cools_down_for_its_duration(tmp_path):
+    pool = AccountPool(tmp_path / "accounts.json", ["a"])
+
+    pool.record_error("a", 429, retry_after=60)
+
+    assert 0 < pool.cooldown("a") <= 60
+    assert pool.choose() is None
+    assert 0 < pool.wait_time() <= 60
+    # A later error without Retry-After does not shorten the cooldown
+    assert pool.record_error("a", 500) is None
+    assert pool.cooldown("a") > 0
+
+
+def test_used_budget_cools_down_until_midnight(tmp_path):
+    pool = AccountPool(tmp_path / "accounts.json", ["a", "b"], daily_requests=2)
+
+    assert pool.record_success("a", 100) is None
+    assert pool.remaining("a") == 1
+    assert pool.record_success("a", 100) == tomorrow()
+
+    assert pool.remaining("a") == 0
+    assert pool.choose() == "b"
+    assert pool.usage["a"]["total_lines"] == 200
+
+
+def test_daily_counts_restart_on_a_new_day(tmp_path):
+    pool = AccountPool(tmp_path / "accounts.json", ["a"], daily_requests=2)
+    pool.record_success("a", 100)
+    pool.usage["a"]["day"] = (date.today() - timedelta(days=1)).isoformat()
+
+    assert pool.remaining("a") == 2
+    assert pool.usage["a"]["total_requests"] == 1
+
+
+@pytest.mark.parametrize("daily_requests", [None, 10])
+def test_choose_rotates_over_the_accounts(tmp_path, daily_requests):
+    pool = AccountPool(tmp_path / "accounts.json", ["a", "b", "c"], daily_requests)
+
+    chosen = []
+    for _ in range(6):
+        account = pool.choose()
+        chosen.append(account)
+        pool.record_success(account, 10)
+
+    # Every account sends as many requests, the least used first
+    assert sorted(chosen) == ["a", "a", "b", "b", "c", "c"]
+    assert len(set(chosen[:3])) == 3
+    assert pool.choose(exclude=("a", "b")) == "c"
+
+
+def test_choose_prefers_the_most_remaining_budget(tmp_path):
+    pool = AccountPool(tmp_path / "accounts.json", ["a", "b"], daily_requests=5)
+    pool.record_success("b", 10)
+    pool.record_success("b", 10)
+    pool.record_success("a", 10)
+
+    assert pool.choose() == "a"
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_slice_refused_by_every_account_is_abandoned(tmp_path, monkeypatch, concurrent):
+    # The refused accounts are available again after a second instead of the next day
+    monkeypatch.setattr(
+        lib.accounts, "_next_midnight", lambda now: now + timedelta(seconds=1)
+    )
+    stations = [{"id": "1", "name": "S", "network": "n", "lon": 1, "lat": 1}]
+    queue_slice = [
+        {
+            "name": "S",
+            "id": "1",
+            "v": "3,0,86400/103,2000,-,-/B12101",
+            "from": date(2000, 1, 1),
+            "to": date(2000, 1, 10),
+            "count": 10,
+            "timeline_section": 0,
+            "agg_period": 86400,
+        }
+    ]
+    with MockDext3r(stations, [], quota=0) as mock:
+        downloader = Dext3rDownloader(
+            tmp_path,
+            date(2000, 1, 1),
+            transport=Transport(mock.base_url),
+            progress="none",
+        )
+        if concurrent:
+            asyncio.run(
+                downloader.send_slices_async([queue_slice], ["a", "b"], 0, max_tries=2)
+            )
+        else:
+            downloader.send_slices([queue_slice], ["a", "b"], 0, max_tries=2)
+
+    # One free refusal per account, then the tries
+    assert [status for _, status in mock.log] == [403] * 4
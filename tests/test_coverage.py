@@ -0,0 +1,207 @@
+from datetime import date, datetime, timedelta, timezone
+
+import polars as pl
+import pytest
+
+from lib.coverage import (
+    INTERVAL_SCHEMA,
+    coverage,
+    covered_days,
+    merge_intervals,
+    missing_parts,
+    split_elements,
+)
+from lib.ledger import TaskLedger
+from lib.store import write_measurements
+
+V = "3,0,86400/103,2000,-,-/B12101"
+OTHER_V = "2,0,86400/103,2000,-,-/B12101"
+
+
+def intervals(rows) -> pl.DataFrame:
+    return pl.DataFrame(rows, schema=INTERVAL_SCHEMA, orient="row")
+
+
+def element(id, start, end, v=V, agg_period=86400) -> dict:
+    return {
+        "name": f"Station {id}",
+        "id": id,
+        "v": v,
+        "from": start,
+        "to": end,
+        "count": ((end - start).days + 1) * 86400 // agg_period,
+        "timeline_section": 0,
+        "agg_period": agg_period,
+    }
+
+
+def daily_rows(id, task, first_day, days) -> list[dict]:
+    # Dext3r daily measurements start one hour before midnight UTC of their day
+    rows = []
+    for i in range(days):
+        start = datetime.combine(
+            first_day + timedelta(days=i), datetime.min.time(), timezone.utc
+        ) - timedelta(hours=1)
+        rows.append(
+            {
+                "start": start,
+                "stop": start + timedelta(days=1),
+                "value": 1.0,
+                "variable": "T_MIN",
+                "id": id,
+                "task": task,
+            }
+        )
+    return rows
+
+
+def test_merge_intervals_joins_adjacent_and_overlapping_intervals():
+    merged = merge_intervals(
+        intervals(
+            [
+                ("a", V, 86400, date(2000, 1, 6), date(2000, 1, 10)),
+                ("a", V, 86400, date(2000, 1, 1), date(2000, 1, 5)),
+                ("a", V, 86400, date(2000, 1, 3), date(2000, 1, 4)),
+                ("a", V, 86400, date(2000, 1, 12), date(2000, 1, 15)),
+                ("a", V, 86400, date(2000, 1, 14), date(2000, 1, 20)),
+                ("b", V, 86400, date(2000, 1, 11), date(2000, 1, 11)),
+            ]
+        ).lazy()
+    ).collect()
+
+    assert merged.sort("id", "from").rows() == [
+        ("a", V, 86400, date(2000, 1, 1), date(2000, 1, 10)),
+        # A day without data between two intervals keeps them apart
+        ("a", V, 86400, date(2000, 1, 12), date(2000, 1, 20)),
+        ("b", V, 86400, date(2000, 1, 11), date(2000, 1, 11)),
+    ]
+
+
+def test_missing_parts_cuts_elements_to_the_holes():
+    queue = pl.LazyFrame(
+        [
+            element("a", date(2000, 1, 1), date(2000, 1, 31)),
+            element("b", date(2000, 1, 1), date(2000, 1, 10)),
+            element("c", date(2000, 1, 1), date(2000, 1, 10)),
+        ]
+    )
+    covered = intervals(
+        [
+            ("a", V, 86400, date(2000, 1, 5), date(2000, 1, 10)),
+            ("a", V, 86400, date(2000, 1, 20), date(2000, 1, 29)),
+            ("b", V, 86400, date(1999, 1, 1), date(2001, 1, 1)),
+            # Another variable of the station does not cover it
+            ("c", OTHER_V, 86400, date(2000, 1, 1), date(2000, 1, 10)),
+        ]
+    )
+
+    parts = missing_parts(queue, covered).sort("id", "from").collect()
+
+    assert parts.select("id", "from", "to", "count").rows() == [
+        ("a", date(2000, 1, 1), date(2000, 1, 4), 4),
+        ("a", date(2000, 1, 11), date(2000, 1, 19), 9),
+        ("a", date(2000, 1, 30), date(2000, 1, 31), 2),
+        ("c", date(2000, 1, 1), date(2000, 1, 10), 10),
+    ]
+    shortest = missing_parts(queue, covered, min_gap_days=3).collect()
+    assert date(2000, 1, 30) not in shortest["from"].to_list()
+
+
+@pytest.mark.parametrize(
+    "agg_period, max_count, lengths",
+    [
+        (86400, 4, [4, 4, 2]),
+        (86400, 10, [10]),
+        (3600, 48, [2, 2, 2, 2, 2]),
+        # An element is split in whole days, even if a day does not fit
+        (3600, 10, [1] * 10),
+    ],
+)
+def test_split_elements(agg_period, max_count, lengths):
+    queue = pl.LazyFrame(
+        [element("a", date(2000, 1, 1), date(2000, 1, 10), agg_period=agg_period)]
+    )
+
+    pieces = split_elements(queue, max_count).collect()
+
+    days = [(end - start).days + 1 for start, end in pieces.select("from", "to").rows()]
+    assert days == lengths
+    assert pieces["from"][0] == date(2000, 1, 1)
+    assert pieces["to"][-1] == date(2000, 1, 10)
+    assert all(
+        next_start == end + timedelta(days=1)
+        for end, next_start in zip(pieces["to"], pieces["from"][1:])
+    )
+    assert pieces["count"].to_list() == [d * 86400 // agg_period for d in days]
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    ledger = TaskLedger(tmp_path / "requests.jsonl", tmp_path / "payloads.jsonl")
+    ledger.append_requests("t1", [element("a", date(2000, 1, 1), date(2000, 1, 10))])
+    ledger.append_requests("t2", [element("a", date(2000, 2, 1), date(2000, 2, 10))])
+    # Days 1 to 5 of t1, and rows of a task that is not in the ledger
+    write_measurements(
+        tmp_path / "data",
+        pl.DataFrame(
+            daily_rows("a", "t1", date(2000, 1, 1), 5)
+            + daily_rows("a", "unknown", date(2000, 1, 20), 3)
+        ),
+    )
+    return tmp_path / "data", ledger
+
+
+def test_covered_days_are_the_days_after_the_start_hour(workspace):
+    data_path, ledger = workspace
+
+    days = covered_days(data_path, ledger).sort("day").collect()
+
+    # The first row starts at 23:00 on December 31st: it is the measurement of January 1st
+    assert days["day"].to_list() == [date(2000, 1, d) for d in range(1, 6)]
+    assert days.select("id", "v", "agg_period").unique().rows() == [("a", V, 86400)]
+
+
+@pytest.mark.parametrize(
+    "ingested, invalid, partial, expected",
+    [
+        # A complete task covers its whole requested period, a pending one too
+        (
+            ["t1"],
+            [],
+            [],
+            [
+                (date(2000, 1, 1), date(2000, 1, 10)),
+                (date(2000, 2, 1), date(2000, 2, 10)),
+            ],
+        ),
+        # A partial or invalid task only covers its days with data
+        (
+            ["t1"],
+            [],
+            ["t1"],
+            [
+                (date(2000, 1, 1), date(2000, 1, 5)),
+                (date(2000, 2, 1), date(2000, 2, 10)),
+            ],
+        ),
+        (
+            ["t1"],
+            ["t1"],
+            [],
+            [
+                (date(2000, 1, 1), date(2000, 1, 5)),
+                (date(2000, 2, 1), date(2000, 2, 10)),
+            ],
+        ),
+        # An invalid task that was never ingested is not pending
+        (["t1"], ["t1", "t2"], [], [(date(2000, 1, 1), date(2000, 1, 5))]),
+    ],
+)
+def test_coverage_of_complete_partial_and_pending_tasks(
+    workspace, ingested, invalid, partial, expected
+):
+    data_path, ledger = workspace
+
+    covered = coverage(data_path, ledger, ingested, invalid, partial)
+
+    assert covered.sort("from").select("from", "to").rows() == expected
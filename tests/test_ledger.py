@@ -0,0 +1,131 @@
+import json
+from datetime import date
+
+import polars as pl
+
+from lib.ledger import TaskLedger
+
+
+def element(name: str, section: int = 0) -> dict:
+    return {
+        "name": name,
+        "id": name.lower(),
+        "v": "3,0,86400/103,2000,-,-/B12101",
+        "from": date(2000, 1, 1),
+        "to": date(2000, 12, 31),
+        "count": 366,
+        "timeline_section": section,
+        "agg_period": 86400,
+    }
+
+
+def payload(station: str) -> dict:
+    return {
+        "email": "a@b.c",
+        "begin_datetime": "1999-12-31T23:00:00Z",
+        "end_datetime": "2001-01-01T00:00:00Z",
+        "variable": ["3,0,86400/103,2000,-,-/B12101"],
+        "station": [station],
+        "fmt": "csv",
+    }
+
+
+def new_ledger(path) -> TaskLedger:
+    return TaskLedger(path / "requests.jsonl", path / "payloads.jsonl")
+
+
+def test_torn_last_line_is_dropped_when_opening(tmp_path):
+    ledger = new_ledger(tmp_path)
+    ledger.append("t1", [element("A"), element("B")], payload("a"))
+    ledger.append("t2", [element("C")], payload("c"))
+    # A crash in the middle of the appends of a third task
+    with open(ledger.requests_path, "ab") as f:
+        f.write(b'{"task_id": "t3", "name": "D", "id": "d", "v": "3,0,86')
+    with open(ledger.payloads_path, "ab") as f:
+        f.write(b'{"task_id": "t3", "email": "a@b.c", "station": ["' + b"x" * 10000)
+
+    ledger = new_ledger(tmp_path)
+
+    assert ledger.scan_requests().collect()["name"].to_list() == ["A", "B", "C"]
+    assert list(ledger.read_payloads()) == ["t1", "t2"]
+    # The next records are appended after the last complete line
+    ledger.append("t3", [element("D")], payload("d"))
+    assert ledger.scan_requests().collect()["task_id"].to_list() == [
+        "t1",
+        "t1",
+        "t2",
+        "t3",
+    ]
+    assert ledger.read_payloads()["t3"]["station"] == ["d"]
+
+
+def test_torn_first_line_empties_the_file(tmp_path):
+    ledger = new_ledger(tmp_path)
+    ledger.requests_path.write_bytes(b'{"task_id": "t1", "name"')
+
+    ledger = new_ledger(tmp_path)
+
+    assert ledger.requests_path.read_bytes() == b""
+    assert ledger.scan_requests().collect().is_empty()
+
+
+def test_compact_drops_duplicates_and_replaced_payloads(tmp_path):
+    ledger = new_ledger(tmp_path)
+    ledger.append("t1", [element("A"), element("B")], payload("a"))
+    # A retried append duplicates the records of a task, and a later payload replaces the first one
+    ledger.append("t1", [element("A")], payload("b"))
+    ledger.append("t2", [element("A", section=1)], payload("c"))
+
+    dropped = ledger.compact()
+
+    assert dropped == {"requests": 1, "payloads": 1}
+    requests = ledger.scan_requests().collect()
+    assert requests.select("task_id", "name", "timeline_section").rows() == [
+        ("t1", "B", 0),
+        ("t1", "A", 0),
+        ("t2", "A", 1),
+    ]
+    payloads = ledger.read_payloads()
+    assert list(payloads) == ["t1", "t2"]
+    assert payloads["t1"]["station"] == ["b"]
+    assert not ledger.requests_path.with_suffix(".jsonl.tmp").exists()
+    assert new_ledger(tmp_path).compact() == {"requests": 0, "payloads": 0}
+
+
+def write_legacy(path):
+    pl.DataFrame(
+        [{"task_id": "t1"} | element("A"), {"task_id": "t2"} | element("B")]
+    ).write_csv(path / "requests.csv")
+    (path / "payloads.json").write_text(
+        json.dumps({"t1": payload("a"), "t2": payload("b")})
+    )
+
+
+def test_import_legacy(tmp_path):
+    write_legacy(tmp_path)
+    ledger = new_ledger(tmp_path)
+
+    ledger.import_legacy(tmp_path / "requests.csv", tmp_path / "payloads.json")
+
+    requests = ledger.scan_requests().collect()
+    assert requests.select("task_id", "name", "from").rows() == [
+        ("t1", "A", date(2000, 1, 1)),
+        ("t2", "B", date(2000, 1, 1)),
+    ]
+    assert ledger.read_payloads()["t2"]["station"] == ["b"]
+    # Once imported, the legacy files are ignored
+    ledger.append("t3", [element("C")], payload("c"))
+    ledger.import_legacy(tmp_path / "requests.csv", tmp_path / "payloads.json")
+    assert len(ledger.scan_requests().collect()) == 3
+
+
+def test_interrupted_import_legacy_is_done_again(tmp_path):
+    write_legacy(tmp_path)
+    ledger = new_ledger(tmp_path)
+    # The requests file was moved in place, not the payloads file
+    ledger.requests_path.write_text('{"task_id": "t1", "name": "A"}\n')
+
+    ledger.import_legacy(tmp_path / "requests.csv", tmp_path / "payloads.json")
+
+    assert ledger.scan_requests().collect()["name"].to_list() == ["A", "B"]
+    assert list(ledger.read_payloads()) == ["t1", "t2"]
@@ -0,0 +1,113 @@
+import os
+
+import polars as pl
+import pytest
+
+from lib.manifest import (
+    StationDigests,
+    file_hash,
+    payload_digest,
+    read_manifest,
+    select_sources,
+    write_manifest,
+)
+
+TASK = "0b8a2f4e-1c3d-4e5f-9a6b-7c8d9e0f1a2b"
+STATIONS = pl.DataFrame(
+    {"id": ["1", "2"], "name": ["A", "B"], "lon": [1100000, 1200000]}
+)
+PAYLOAD = {
+    "station": ["1"],
+    "variable": ["3,0,86400/103,2000,-,-/B12101"],
+    "begin_datetime": "1999-12-31T23:00:00Z",
+    "end_datetime": "2001-01-01T00:00:00Z",
+    "request_time": "2024-01-01T00:00:00Z",
+}
+
+
+@pytest.fixture
+def ingested(tmp_path):
+    # An archive ingested with the payload and station metadata above
+    source = tmp_path / f"dexter-{TASK}.zip"
+    source.write_bytes(b"archive content")
+    stat = source.stat()
+    manifest = {
+        TASK: {
+            "task": TASK,
+            "source": str(source),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": file_hash(source),
+            "payload_digest": payload_digest(PAYLOAD),
+            "stations_digest": StationDigests(STATIONS)(PAYLOAD),
+            "partitions": [],
+            "rows": 10,
+            "status": "ok",
+            "error": None,
+        }
+    }
+    write_manifest(tmp_path / "manifest.parquet", manifest)
+    return source, read_manifest(tmp_path / "manifest.parquet")
+
+
+def select(source, manifest, payload=PAYLOAD, stations=STATIONS):
+    return select_sources([source], manifest, {TASK: payload}, StationDigests(stations))
+
+
+def test_unchanged_source_is_skipped(ingested):
+    source, manifest = ingested
+
+    assert select(source, manifest) == ([], [TASK])
+    # The request time does not change how a task is read
+    assert select(source, manifest, PAYLOAD | {"request_time": "later"}) == (
+        [],
+        [TASK],
+    )
+    # Nor the metadata of the stations the task did not request
+    other = STATIONS.with_columns(
+        pl.when(pl.col("id") == "2").then(0).otherwise(pl.col("lon")).alias("lon")
+    )
+    assert select(source, manifest, stations=other) == ([], [TASK])
+
+
+def test_touched_source_is_skipped_by_its_hash(ingested):
+    source, manifest = ingested
+    stat = source.stat()
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+
+    assert select(source, manifest) == ([], [TASK])
+    # The entry is refreshed, so that the hash is not computed again
+    assert manifest[TASK]["mtime"] == source.stat().st_mtime
+
+
+def test_changed_source_is_ingested(ingested):
+    source, manifest = ingested
+    source.write_bytes(b"archive CONTENT")
+    stat = source.stat()
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+
+    assert select(source, manifest) == ([source], [])
+
+
+def test_source_with_changed_payload_or_stations_is_ingested(ingested):
+    source, manifest = ingested
+    moved = STATIONS.with_columns(pl.col("lon") + 1)
+
+    assert select(source, manifest, PAYLOAD | {"station": ["1", "2"]}) == (
+        [source],
+        [],
+    )
+    assert select(source, manifest, stations=moved) == ([source], [])
+
+
+def test_new_or_moved_source_is_ingested(ingested, tmp_path):
+    source, manifest = ingested
+    moved = tmp_path / "zip" / source.name
+    moved.parent.mkdir()
+    moved.write_bytes(source.read_bytes())
+    new = tmp_path / "dexter-1b8a2f4e-1c3d-4e5f-9a6b-7c8d9e0f1a2b.zip"
+    new.write_bytes(b"other archive")
+
+    assert select_sources(
+        [moved, new], manifest, {TASK: PAYLOAD}, StationDigests(STATIONS)
+    ) == ([moved, new], [])
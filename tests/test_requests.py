@@ -0,0 +1,23 @@
+import pytest
+import requests
+
+from lib.requests import response_detail
+
+
+@pytest.mark.parametrize(
+    "content, detail",
+    [
+        (b'{"detail": "Quota exceeded"}', "Quota exceeded"),
+        (b'{"details": "Invalid request"}', "Invalid request"),
+        (b'{"task": "t"}', None),
+        # An error page of a proxy is not JSON
+        (b"<html>502 Bad Gateway</html>", "<html>502 Bad Gateway</html>"),
+        (b"", None),
+    ],
+)
+def test_response_detail(content, detail):
+    response = requests.Response()
+    response.status_code = 502
+    response._content = content
+
+    assert response_detail(response) == detail
@@ -0,0 +1,272 @@
+import copy
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from lib.stack import (
+    PLAN_CANDIDATES,
+    clamp_slices,
+    plan_slices,
+    pop_biggest_slice,
+    request_elements,
+    slice_size,
+)
+from lib.variables import header_variable
+
+AGG_PERIODS = [3600, 86400]
+VARIABLES = ["1,0,3600/1,-,-,-/B13011", "254,0,0/103,2000,-,-/B12101"]
+
+
+def random_queue(rng: random.Random, n_elements: int, max_lines: int):
+    # Each station has at most one element per timeline section, so that every unit of the queue is one element
+    names = [f"Station {i}" for i in range(n_elements // 2 + 1)]
+    queue = []
+    seen = set()
+    while len(queue) < n_elements:
+        name = rng.choice(names)
+        section = rng.randrange(4)
+        if (name, section) in seen:
+            continue
+        seen.add((name, section))
+        agg_period = rng.choice(AGG_PERIODS)
+        max_days = max(max_lines * agg_period // 86400, 1)
+        start = date(2000, 1, 1) + timedelta(days=rng.randrange(3000))
+        end = start + timedelta(days=rng.randrange(min(max_days, 400)))
+        queue.append(
+            {
+                # Names differing only by case or spaces are the same station for the planners
+                "name": rng.choice([name, name.upper(), f" {name} "]),
+                "id": str(names.index(name)),
+                "v": rng.choice(VARIABLES),
+                "from": start,
+                "to": end,
+                "count": slice_size(start, end, 1, agg_period),
+                "timeline_section": section,
+                "agg_period": agg_period,
+            }
+        )
+    queue.sort(key=lambda s: (s["count"], s["timeline_section"]), reverse=True)
+    return queue
+
+
+def reference_plan(queue, max_lines):
+    queue = copy.deepcopy(queue)
+    slices = []
+    while queue:
+        slices.append(pop_biggest_slice(queue, max_lines))
+    return slices
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("max_lines", [2000, 18000])
+def test_greedy_plan_matches_pop_biggest_slice(seed, max_lines):
+    rng = random.Random(seed)
+    queue = random_queue(rng, rng.randrange(1, 120), max_lines)
+
+    slices = plan_slices(queue, max_lines, "greedy")
+
+    assert slices == reference_plan(queue, max_lines)
+    assert all(request_elements(s) <= max_lines for s in slices)
+    assert sorted(e["name"] for s in slices for e in s) == sorted(
+        e["name"] for e in queue
+    )
+
+
+def test_plan_slices_rejects_elements_that_do_not_fit():
+    queue = [
+        {
+            "name": "Station",
+            "id": "1",
+            "v": VARIABLES[0],
+            "from": date(2000, 1, 1),
+            "to": date(2000, 12, 31),
+            "count": 8784,
+            "timeline_section": 0,
+            "agg_period": 3600,
+        }
+    ]
+    with pytest.raises(ValueError):
+        plan_slices(queue, 1000, "greedy")
+
+
+def multi_variable_queue(
+    rng: random.Random, n_stations: int, max_lines: int, weighted: bool
+):
+    # Every station has consecutive timeline sections, with one or both variables in each, so that the units of the
+    # queue have several variables and adjacent sections of the same series can be merged
+    queue = []
+    for station in range(n_stations):
+        agg_period = rng.choice(AGG_PERIODS)
+        weight = rng.choice([0.5, 1.0, 2.0]) if weighted else 1.0
+        # A unit of both variables fits in a request
+        max_days = max(int(max_lines * agg_period // 86400 / (2 * weight)), 1)
+        start = date(2000, 1, 1) + timedelta(days=rng.randrange(1000))
+        for section in range(rng.randrange(1, 4)):
+            end = start + timedelta(days=rng.randrange(max_days))
+            variables = rng.choice([VARIABLES, VARIABLES[:1], VARIABLES[1:]])
+            for v in variables:
+                element = {
+                    "name": f"Station {station}",
+                    "id": str(station),
+                    "v": v,
+                    "from": start,
+                    "to": end,
+                    "count": slice_size(start, end, 1, agg_period),
+                    "timeline_section": section,
+                    "agg_period": agg_period,
+                }
+                if weighted:
+                    element["weight"] = weight
+                queue.append(element)
+            start = end + timedelta(days=1)
+    queue.sort(key=lambda s: (s["count"], s["timeline_section"]), reverse=True)
+    return queue
+
+
+def element_key(element):
+    return (element["id"], element["v"], element["timeline_section"])
+
+
+def check_plan(queue, slices, max_lines):
+    assert all(request_elements(s) <= max_lines for s in slices)
+    planned = [element_key(e) for s in slices for e in s]
+    assert sorted(planned) == sorted(element_key(e) for e in queue)
+    for s in slices:
+        # A slice has one set of variables and aggregation period
+        assert len({e["agg_period"] for e in s}) == 1
+
+
+@pytest.mark.parametrize("strategy", list(PLAN_CANDIDATES))
+@pytest.mark.parametrize("weighted", [False, True])
+@pytest.mark.parametrize("seed", range(10))
+def test_plans_of_multi_variable_queues_fit(strategy, weighted, seed):
+    rng = random.Random(seed)
+    max_lines = rng.choice([2000, 5000, 18000])
+    queue = multi_variable_queue(rng, rng.randrange(1, 40), max_lines, weighted)
+
+    check_plan(queue, plan_slices(queue, max_lines, strategy), max_lines)
+
+
+@pytest.mark.parametrize("strategy", list(PLAN_CANDIDATES))
+@pytest.mark.parametrize("seed", range(10))
+def test_plans_of_single_variable_queues_fit(strategy, seed):
+    rng = random.Random(seed)
+    queue = random_queue(rng, rng.randrange(1, 120), 18000)
+
+    check_plan(queue, plan_slices(queue, 18000, strategy), 18000)
+
+
+@pytest.mark.parametrize("strategy", list(PLAN_CANDIDATES))
+def test_adjacent_sections_of_two_variables(strategy):
+    # Two variables over two 5 year daily sections: each section fits, the merged sections do not
+    queue = [
+        {
+            "name": "Station",
+            "id": "1",
+            "v": v,
+            "from": start,
+            "to": end,
+            "count": slice_size(start, end, 1, 86400),
+            "timeline_section": section,
+            "agg_period": 86400,
+        }
+        for section, (start, end) in enumerate(
+            [
+                (date(2000, 1, 1), date(2004, 12, 31)),
+                (date(2005, 1, 1), date(2009, 12, 31)),
+            ]
+        )
+        for v in VARIABLES
+    ]
+
+    slices = plan_slices(queue, 5000, strategy)
+
+    check_plan(queue, slices, 5000)
+    assert [len(s) for s in slices] == [2, 2]
+
+
+def nominal_lines(queue_slice):
+    return request_elements([{**e, "weight": 1} for e in queue_slice])
+
+
+@pytest.mark.parametrize("strategy", list(PLAN_CANDIDATES))
+@pytest.mark.parametrize("seed", range(10))
+def test_weighted_plans_stay_within_the_nominal_limit(strategy, seed):
+    rng = random.Random(seed)
+    # Every unit fits the nominal limit, and counts for a quarter of its lines
+    queue = [
+        e | {"weight": 0.25}
+        for e in multi_variable_queue(rng, rng.randrange(1, 40), 5000, False)
+    ]
+
+    slices = plan_slices(queue, 5000, strategy, 5000)
+
+    check_plan(queue, slices, 5000)
+    assert all(nominal_lines(s) <= 5000 for s in slices)
+    # Without the limit, the weighted slices request more lines
+    unclamped = plan_slices(queue, 5000, strategy)
+    assert len(unclamped) <= len(slices)
+
+
+def test_clamp_splits_the_periods_of_a_single_station():
+    queue_slice = [
+        {
+            "name": "Station",
+            "id": "1",
+            "v": v,
+            "from": start,
+            "to": end,
+            "count": slice_size(start, end, 1, 86400),
+            "timeline_section": section,
+            "agg_period": 86400,
+            "weight": 0.25,
+        }
+        for section, (start, end) in enumerate(
+            [
+                (date(2000, 1, 1), date(2004, 12, 31)),
+                (date(2005, 1, 1), date(2009, 12, 31)),
+                (date(2010, 1, 1), date(2014, 12, 31)),
+            ]
+        )
+        for v in VARIABLES
+    ]
+
+    slices = clamp_slices([queue_slice], 8000)
+
+    assert [[e["timeline_section"] for e in s] for s in slices] == [
+        [0, 0, 1, 1],
+        [2, 2],
+    ]
+    assert all(nominal_lines(s) <= 8000 for s in slices)
+    # A single station and period cannot be split
+    assert clamp_slices([queue_slice[:2]], 1000) == [queue_slice[:2]]
+
+
+def test_best_keeps_the_plan_with_fewer_requests():
+    rng = random.Random(0)
+    queue = random_queue(rng, 100, 5000)
+
+    best = plan_slices(queue, 5000, "best")
+
+    assert len(best) == min(
+        len(plan_slices(queue, 5000, strategy)) for strategy in ("merge", "bfd")
+    )
+
+
+@pytest.mark.parametrize(
+    "header, name",
+    [
+        ("Inizio,Fine,Temperatura massima dell'aria (C)", "T_MAX"),
+        ("Inizio,Fine,Temperatura minima dell'aria (C)", "T_MIN"),
+        ("Inizio,Fine,Temperatura media dell'aria (C)", "T_MEAN"),
+        ("Inizio,Fine,Precipitazione cumulata (KG/M**2)", "PREC"),
+    ],
+)
+def test_header_variable(header, name):
+    assert header_variable(header) == name
+
+
+def test_header_variable_of_precipitation_maximum_is_not_a_temperature():
+    with pytest.raises(ValueError):
+        header_variable("Inizio,Fine,Precipitazione massima oraria (KG/M**2)")
@@ -0,0 +1,52 @@
+import polars as pl
+
+from lib.stations import StationResolver
+
+# Two stations of the same network and name, told apart by their coordinates, in the format of station_infos.json
+STATIONS = pl.DataFrame(
+    {
+        "id": ["-/1196964,4467123/simnbo", "-/1201000,4470000/simnbo"],
+        "name": ["Ponte", "Ponte"],
+        "network": ["simnbo", "simnbo"],
+        "lon": [1196964, 1201000],
+        "lat": [4467123, 4470000],
+        "height": [25.0, 25.0],
+    }
+)
+
+
+def task_meta(lon: float, lat: float) -> pl.DataFrame:
+    # The station metadata of a result file gives the coordinates in degrees
+    return pl.DataFrame(
+        {
+            "task": ["t"],
+            "network": ["simnbo"],
+            "name": ["Ponte"],
+            "lon": [lon],
+            "lat": [lat],
+            "elevation": [25.0],
+        }
+    )
+
+
+def test_resolver_matches_the_coordinates_of_the_station_ids():
+    resolver = StationResolver(STATIONS)
+
+    ids = resolver.resolve(task_meta(11.969637, 44.671228), {})
+
+    assert ids.rows() == [("t", "Ponte", "-/1196964,4467123/simnbo")]
+
+
+def test_resolver_looks_up_the_requested_stations():
+    resolver = StationResolver(STATIONS)
+    payloads = {"t": {"station": ["-/1201000,4470000/simnbo"]}}
+
+    ids = resolver.resolve(task_meta(0.0, 0.0), payloads)
+
+    assert ids.rows() == [("t", "Ponte", "-/1201000,4470000/simnbo")]
+
+
+def test_resolver_drops_ambiguous_stations_without_matching_coordinates():
+    resolver = StationResolver(STATIONS)
+
+    assert resolver.resolve(task_meta(11.5, 44.5), {}).is_empty()
@@ -0,0 +1,158 @@
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import polars as pl
+
+from lib.store import (
+    delete_tasks,
+    partition_path,
+    query,
+    read_catalog,
+    series_catalog,
+    write_measurements,
+)
+
+
+def daily_rows(id, task, first_day, days, value=1.0, variable="T_MIN"):
+    # Dext3r daily measurements start one hour before midnight UTC of their day
+    starts = [
+        datetime.combine(
+            first_day + timedelta(days=i), datetime.min.time(), timezone.utc
+        )
+        - timedelta(hours=1)
+        for i in range(days)
+    ]
+    return pl.DataFrame(
+        {
+            "start": starts,
+            "stop": [s + timedelta(days=1) for s in starts],
+            "value": [value] * days,
+            "variable": [variable] * days,
+            "id": [id] * days,
+            "task": [task] * days,
+        },
+        schema_overrides={"value": pl.Float64()},
+    )
+
+
+def stored(root, year, variable="T_MIN") -> pl.DataFrame:
+    return pl.read_parquet(partition_path(root, variable, 86400, year))
+
+
+def test_write_merges_into_existing_year_partitions(tmp_path):
+    # The measurement of January 1st starts on December 31st: it is in the partition of the previous year
+    write_measurements(tmp_path, daily_rows("a", "t1", date(2000, 12, 30), 5))
+
+    written = write_measurements(
+        tmp_path,
+        pl.concat(
+            [
+                daily_rows("a", "t2", date(2001, 1, 10), 3),
+                daily_rows("b", "t2", date(2001, 1, 5), 2),
+            ]
+        ),
+    )
+
+    assert written == [partition_path(tmp_path, "T_MIN", 86400, 2001)]
+    assert stored(tmp_path, 2000)["task"].to_list() == ["t1"] * 3
+    merged = stored(tmp_path, 2001)
+    assert (
+        merged.select("id", "task").rows()
+        == [("a", "t1")] * 2 + [("a", "t2")] * 3 + [("b", "t2")] * 2
+    )
+    # Each partition is sorted by station and time
+    assert merged.sort("id", "start").equals(merged)
+
+
+def test_duplicate_rows_across_tasks_are_stored_once(tmp_path):
+    write_measurements(tmp_path, daily_rows("a", "t1", date(2001, 2, 1), 10, value=1.0))
+    # An overlapping task: its values win, except the missing ones
+    newer = daily_rows("a", "t2", date(2001, 2, 6), 10, value=2.0).with_columns(
+        pl.when(pl.col("start").dt.day() == 6)
+        .then(None)
+        .otherwise(pl.col("value"))
+        .alias("value")
+    )
+    write_measurements(tmp_path, newer)
+
+    merged = stored(tmp_path, 2001)
+
+    assert merged.height == 15
+    assert merged.select("start", "id").is_duplicated().sum() == 0
+    values = dict(
+        zip(
+            (merged["start"] + timedelta(hours=1)).dt.day().to_list(),
+            merged.select("value", "task").rows(),
+        )
+    )
+    assert values[5] == (1.0, "t1")
+    # The null value of the newer task does not replace the stored one
+    assert values[7] == (1.0, "t1")
+    assert values[8] == (2.0, "t2")
+    assert values[15] == (2.0, "t2")
+
+
+def test_replaced_tasks_lose_their_previous_rows(tmp_path):
+    files = write_measurements(tmp_path, daily_rows("a", "t1", date(2001, 2, 1), 10))
+
+    write_measurements(
+        tmp_path, daily_rows("a", "t1", date(2001, 2, 1), 3), ["t1"], files
+    )
+
+    assert stored(tmp_path, 2001).height == 3
+
+
+def test_catalog_follows_the_writes(tmp_path):
+    write_measurements(
+        tmp_path,
+        pl.concat(
+            [
+                daily_rows("a", "t1", date(2000, 12, 25), 10),
+                daily_rows("b", "t1", date(2001, 3, 1), 2, value=None),
+            ]
+        ),
+    )
+    write_measurements(tmp_path, daily_rows("a", "t2", date(2001, 2, 1), 4))
+
+    catalog = read_catalog(tmp_path)
+
+    assert catalog.select("year", "id", "rows", "nulls", "tasks").rows() == [
+        (2000, "a", 8, 0, ["t1"]),
+        (2001, "a", 6, 0, ["t1", "t2"]),
+        (2001, "b", 2, 2, ["t1"]),
+    ]
+    series = series_catalog(tmp_path).filter(pl.col("id") == "a")
+    assert series["rows"].to_list() == [14]
+    assert series["tasks"].to_list() == [["t1", "t2"]]
+    assert series["first"][0] == datetime(2000, 12, 24, 23, tzinfo=timezone.utc)
+    assert series["last"][0] == datetime(2001, 2, 3, 23, tzinfo=timezone.utc)
+
+    delete_tasks(tmp_path, ["t2"], [partition_path(tmp_path, "T_MIN", 86400, 2001)])
+
+    catalog = read_catalog(tmp_path)
+    assert catalog.filter(pl.col("year") == 2001)["tasks"].to_list() == [
+        ["t1"],
+        ["t1"],
+    ]
+    assert series_catalog(tmp_path).filter(pl.col("id") == "a")["rows"].to_list() == [
+        10
+    ]
+
+
+def test_catalog_rebuilds_the_entries_of_files_changed_outside_the_store(tmp_path):
+    write_measurements(tmp_path, daily_rows("a", "t1", date(2001, 2, 1), 10))
+    path = partition_path(tmp_path, "T_MIN", 86400, 2001)
+    pl.read_parquet(path).head(4).write_parquet(path)
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    assert read_catalog(tmp_path)["rows"].to_list() == [4]
+    # The query skips the partition files that the catalog rules out, and reads the others
+    assert query(tmp_path, ids=["a"]).collect().height == 4
+    assert query(tmp_path, ids=["b"]).collect().height == 0
+    assert (
+        query(tmp_path, from_date=date(2001, 2, 3), to_date=date(2001, 2, 3))
+        .collect()
+        .height
+        == 1
+    )